@@ -0,0 +1,186 @@
+# 自适应批次：按邮件大小（RFC822.SIZE）划分FETCH批次，按每批耗时和错误调整批次字节数；入库按大小和时间合并提交
+import imaplib
+import random
+import time
+
+from script import metrics
+
+# 每批FETCH的初始/最小/最大字节数（按将要下载的字节估算）
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+MIN_BATCH_BYTES = 256 * 1024
+MAX_BATCH_BYTES = 32 * 1024 * 1024
+# 每批的最大邮件数，避免小邮件时一条命令的UID集合和响应条数过多
+MAX_BATCH_MESSAGES = 500
+# 每批的目标耗时（秒）：低于目标时逐步加大批次，明显超过时减半
+TARGET_BATCH_SECONDS = 5.0
+# 加性增加的步长占初始字节数的比例
+INCREASE_RATIO = 0.25
+# 同一封邮件最多重试的次数，超过后作为失败批次产出（同步位置不会越过它）
+MAX_RETRIES = 3
+# 失败后的退避时间（秒）：BACKOFF_BASE * 2^(连续失败次数-1)，带随机抖动，不超过BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# 每条 FETCH RFC822.SIZE 命令查询的UID数
+SIZE_FETCH_CHUNK = 2000
+# 取不到大小时每封邮件的估算字节数
+UNKNOWN_MESSAGE_BYTES = 64 * 1024
+# partial模式每封邮件的估算下载量上限：头部、BODYSTRUCTURE和截断的正文部分
+PARTIAL_MESSAGE_BYTES = 96 * 1024
+
+# 入库：缓冲的正文字节数、邮件数或缓冲时间超过任一阈值时提交一次
+FLUSH_BYTES = 8 * 1024 * 1024
+FLUSH_ROWS = 1000
+FLUSH_SECONDS = 10.0
+
+
+def fetch_message_sizes(client, uids):
+    """用 FETCH RFC822.SIZE 查询邮件大小，返回 {uid: 字节数}；服务器不支持或出错时返回已取到的部分"""
+    sizes = {}
+    for i in range(0, len(uids), SIZE_FETCH_CHUNK):
+        chunk = uids[i:i+SIZE_FETCH_CHUNK]
+        try:
+            with metrics.timer('imap_fetch_seconds', stage='size', backend='imapclient'):
+                data = client.fetch(chunk, ['RFC822.SIZE'])
+        except Exception as e:
+            if is_connection_error(e):
+                raise
+            metrics.warn("获取邮件大小失败，按估算大小分批: %s", e)
+            break
+        for uid, item in data.items():
+            size = item.get(b'RFC822.SIZE')
+            if size is not None:
+                sizes[uid] = int(size)
+    return sizes
+
+
+def is_connection_error(error):
+    """连接已断开（含asyncio读到EOF），在同一连接上重试没有意义"""
+    return isinstance(error, (imaplib.IMAP4.abort, OSError, EOFError))
+
+
+class AdaptiveBatcher:
+    """按字节预算从UID队列中切出批次，成功时加性增加预算、变慢或出错时减半（AIMD）
+
+    失败的批次放回队首，下一批最多取失败批次的一半邮件，反复失败的批次因此被逐步二分，
+    只有出问题的邮件会反复重试；单封邮件重试超过MAX_RETRIES次后放弃。
+    """
+
+    def __init__(self, uids, sizes=None, fetch_mode='partial', batch_bytes=DEFAULT_BATCH_BYTES,
+                 max_messages=MAX_BATCH_MESSAGES, target_seconds=TARGET_BATCH_SECONDS):
+        self.pending = list(uids)
+        self.sizes = sizes or {}
+        self.fetch_mode = fetch_mode
+        self.batch_bytes = batch_bytes
+        self.step = max(int(batch_bytes * INCREASE_RATIO), MIN_BATCH_BYTES)
+        self.max_messages = max_messages or MAX_BATCH_MESSAGES
+        self.target_seconds = target_seconds
+        self.attempts = {}
+        self.failures = 0
+        self.batch_no = 0
+        # 重试时每批的邮件数上限（二分失败的批次），之后每成功一批翻倍直到取消
+        self.split_limit = None
+
+    def estimated_bytes(self, uid):
+        """一封邮件的估算下载量：partial模式只下载头部和截断的正文部分"""
+        size = self.sizes.get(uid, UNKNOWN_MESSAGE_BYTES)
+        return min(size, PARTIAL_MESSAGE_BYTES) if self.fetch_mode == 'partial' else size
+
+    def remaining(self):
+        return len(self.pending)
+
+    def next_batch(self):
+        """从队首切出一批（至少一封），队列为空时返回None"""
+        if not self.pending:
+            return None
+        limit = min(self.max_messages, self.split_limit or self.max_messages)
+        total = 0
+        count = 0
+        for uid in self.pending:
+            size = self.estimated_bytes(uid)
+            if count and (total + size > self.batch_bytes or count >= limit):
+                break
+            total += size
+            count += 1
+        batch_ids = self.pending[:count]
+        del self.pending[:count]
+        self.batch_no += 1
+        metrics.observe('fetch_batch_bytes', total, fetch_mode=self.fetch_mode)
+        return batch_ids
+
+    def succeeded(self, batch_ids, seconds):
+        """记录一批成功的耗时并调整预算"""
+        self.failures = 0
+        if self.split_limit is not None:
+            self.split_limit = self.split_limit * 2 if self.split_limit * 2 < self.max_messages else None
+        for uid in batch_ids:
+            self.attempts.pop(uid, None)
+        if seconds > 2 * self.target_seconds:
+            self._shrink()
+        elif seconds <= self.target_seconds and len(batch_ids) < self.max_messages:
+            self.batch_bytes = min(self.batch_bytes + self.step, MAX_BATCH_BYTES)
+
+    def failed(self, batch_ids, error):
+        """记录一批失败，返回重试前应等待的秒数；返回None表示放弃这批（连接已断开或重试次数用尽）"""
+        self.failures += 1
+        self._shrink()
+        if is_connection_error(error):
+            return None
+        for uid in batch_ids:
+            self.attempts[uid] = self.attempts.get(uid, 0) + 1
+        if len(batch_ids) == 1 and self.attempts[batch_ids[0]] > MAX_RETRIES:
+            return None
+        self.split_limit = max(len(batch_ids) // 2, 1)
+        self.pending[:0] = batch_ids
+        metrics.count('fetch_batch_retries_total', fetch_mode=self.fetch_mode)
+        delay = min(BACKOFF_BASE * 2 ** (self.failures - 1), BACKOFF_MAX)
+        return delay * (0.5 + random.random() / 2)
+
+    def abandon(self):
+        """放弃队列中剩余的全部邮件并返回它们（连接断开后调用）"""
+        batch_ids, self.pending = self.pending, []
+        return batch_ids
+
+    def _shrink(self):
+        self.batch_bytes = max(self.batch_bytes // 2, MIN_BATCH_BYTES)
+
+
+def email_bytes(e):
+    """一封解析后的邮件在入库缓冲中的估算大小"""
+    return len(e['body'] or '') + len(e['subject'] or '') + 512
+
+
+class WriteBuffer:
+    """入库缓冲：累积多批邮件，正文字节数、邮件数或缓冲时间超过阈值时需要提交
+
+    调用方在提交期间不再从获取端取下一批，获取端因此被阻塞（异步后端最多预取pipeline_depth批），
+    缓冲的邮件量不会超过阈值加一批。
+    """
+
+    def __init__(self, flush_bytes=FLUSH_BYTES, flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS):
+        self.flush_bytes = flush_bytes
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.emails = []
+        self.nbytes = 0
+        self.started = None
+
+    def __len__(self):
+        return len(self.emails)
+
+    def add(self, emails):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.emails.extend(emails)
+        self.nbytes += sum(email_bytes(e) for e in emails)
+
+    def full(self):
+        return (self.nbytes >= self.flush_bytes or len(self.emails) >= self.flush_rows
+                or (self.started is not None and time.monotonic() - self.started >= self.flush_seconds))
+
+    def take(self):
+        """取出缓冲的邮件并清空"""
+        emails = self.emails
+        self.emails = []
+        self.nbytes = 0
+        self.started = None
+        return emails
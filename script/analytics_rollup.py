@@ -0,0 +1,245 @@
+# 数据分析页面的预聚合表：每日/每周邮件数、企业投递状态漏斗、首次回复耗时，由入库流程按批增量维护
+import argparse
+import datetime
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from script import metrics
+
+# 与 src/server.js 中的建表语句保持一致
+EMAIL_DAYS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS rollup_email_days (
+    day DATE NOT NULL PRIMARY KEY,
+    emails INT UNSIGNED NOT NULL
+) ENGINE=InnoDB
+"""
+
+# 周一为一周的开始（与MySQL的WEEKDAY一致）
+EMAIL_WEEKS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS rollup_email_weeks (
+    week_start DATE NOT NULL PRIMARY KEY,
+    emails INT UNSIGNED NOT NULL
+) ENGINE=InnoDB
+"""
+
+DELIVERY_FUNNEL_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS rollup_delivery_funnel (
+    company_name VARCHAR(255) NOT NULL,
+    position VARCHAR(255) NOT NULL,
+    status VARCHAR(100) NOT NULL,
+    deliveries INT UNSIGNED NOT NULL,
+    first_date DATETIME NOT NULL,
+    last_date DATETIME NOT NULL,
+    PRIMARY KEY (company_name, position, status)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# 每家企业从第一次投递到第一次收到回复（笔试、面试、拒信等）的耗时，未回复时responded_at为NULL
+RESPONSE_LATENCY_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS rollup_response_latency (
+    company_name VARCHAR(255) NOT NULL PRIMARY KEY,
+    applied_at DATETIME NOT NULL,
+    responded_at DATETIME DEFAULT NULL,
+    latency_hours INT UNSIGNED DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# 表示"已投递"的状态；除这些状态和未知状态外，其余状态都算企业的回复
+APPLIED_STATUSES = ('投递完成', '简历筛选中')
+NOT_RESPONSE_STATUSES = APPLIED_STATUSES + ('未知状态',)
+# 每条增量更新语句覆盖的日期/企业数
+ROLLUP_CHUNK_SIZE = 200
+
+# 各预聚合表的来源查询，{where} 为按键限定的条件，不限定时为 1=1；
+# 投递相关的表按企业重新统计、rebuild写入、check比较的是同一个查询的结果，邮件数平时按增量维护；
+# 自动识别后尚未确认的投递记录（candidate）不计入统计
+EMAIL_DAYS_SOURCE = """
+SELECT DATE(send_ts), COUNT(*) FROM all_emails
+WHERE send_ts IS NOT NULL AND ({where}) GROUP BY DATE(send_ts)
+"""
+
+EMAIL_WEEKS_SOURCE = """
+SELECT DATE_SUB(DATE(send_ts), INTERVAL WEEKDAY(send_ts) DAY), COUNT(*) FROM all_emails
+WHERE send_ts IS NOT NULL AND ({where}) GROUP BY 1
+"""
+
+DELIVERY_FUNNEL_SOURCE = """
+SELECT company_name, COALESCE(position, ''), status, COUNT(*), MIN(delivery_date), MAX(delivery_date)
+FROM {database}.deliveries WHERE candidate = FALSE AND ({where})
+GROUP BY company_name, COALESCE(position, ''), status
+"""
+
+RESPONSE_LATENCY_SOURCE = f"""
+SELECT a.company_name, a.applied_at, MIN(d.delivery_date), TIMESTAMPDIFF(HOUR, a.applied_at, MIN(d.delivery_date))
+FROM (
+    SELECT company_name, MIN(delivery_date) AS applied_at FROM {{database}}.deliveries
+    WHERE candidate = FALSE AND status IN ({', '.join(repr(status) for status in APPLIED_STATUSES)}) AND ({{where}})
+    GROUP BY company_name
+) a
+LEFT JOIN {{database}}.deliveries d ON d.company_name = a.company_name AND d.delivery_date >= a.applied_at
+    AND d.candidate = FALSE AND d.status NOT IN ({', '.join(repr(status) for status in NOT_RESPONSE_STATUSES)})
+GROUP BY a.company_name, a.applied_at
+"""
+
+# 表名 -> (主键列数, 来源查询, 插入的列)
+ROLLUPS = {
+    'rollup_email_days': (1, EMAIL_DAYS_SOURCE, 'day, emails'),
+    'rollup_email_weeks': (1, EMAIL_WEEKS_SOURCE, 'week_start, emails'),
+    'rollup_delivery_funnel': (3, DELIVERY_FUNNEL_SOURCE,
+                               'company_name, position, status, deliveries, first_date, last_date'),
+    'rollup_response_latency': (1, RESPONSE_LATENCY_SOURCE, 'company_name, applied_at, responded_at, latency_hours'),
+}
+
+
+def ensure_rollup_tables(cursor):
+    """创建/检查预聚合表"""
+    cursor.execute(EMAIL_DAYS_TABLE_SQL)
+    cursor.execute(EMAIL_WEEKS_TABLE_SQL)
+    cursor.execute(DELIVERY_FUNNEL_TABLE_SQL)
+    cursor.execute(RESPONSE_LATENCY_TABLE_SQL)
+
+
+def week_start(day):
+    """day所在周的周一"""
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def _replace(cursor, table, key_column, keys, where, params, database=None):
+    """删除keys对应的旧行，再按来源查询重新计算这些键；来源中已没有的键随之消失"""
+    _, source, columns = ROLLUPS[table]
+    cursor.execute(f"DELETE FROM {table} WHERE {key_column} IN ({','.join(['%s'] * len(keys))})", keys)
+    cursor.execute(f"INSERT INTO {table} ({columns}) {source.format(where=where, database=database)}", params)
+
+
+def _add_counts(cursor, table, key_column, counts):
+    """按键增减预聚合表的emails列（counts: {键: 增量}），按键排序加锁；减到0的行删除"""
+    increments = sorted((key, n) for key, n in counts.items() if n > 0)
+    decrements = sorted((key, -n) for key, n in counts.items() if n < 0)
+    if increments:
+        cursor.executemany(
+            f"INSERT INTO {table} ({key_column}, emails) VALUES (%s, %s) "
+            "ON DUPLICATE KEY UPDATE emails = emails + VALUES(emails)",
+            increments
+        )
+    if decrements:
+        cursor.executemany(
+            f"UPDATE {table} SET emails = GREATEST(CAST(emails AS SIGNED) - %s, 0) WHERE {key_column} = %s",
+            [(n, key) for key, n in decrements]
+        )
+        keys = [key for key, _ in decrements]
+        cursor.execute(f"DELETE FROM {table} WHERE emails = 0 AND {key_column} IN ({','.join(['%s'] * len(keys))})", keys)
+
+
+def add_email_days(cursor, day_counts):
+    """在写入或删除all_emails的同一个事务中调用，按日期增减每日和每周的邮件数（day_counts: {日期: 增量}）
+
+    只按主键锁住预聚合表中这些日期和周的行，不扫描all_emails，不会与并发入库的事务互相等待范围锁；
+    发送时间被改写的邮件不会从原来的日期移走，由 check / rebuild 修正。
+    """
+    days = {}
+    weeks = {}
+    for day, n in day_counts.items():
+        if day and n:
+            days[day] = days.get(day, 0) + n
+            weeks[week_start(day)] = weeks.get(week_start(day), 0) + n
+    if not days:
+        return
+    with metrics.timer('rollup_seconds', table='emails'):
+        _add_counts(cursor, 'rollup_email_days', 'day', days)
+        _add_counts(cursor, 'rollup_email_weeks', 'week_start', weeks)
+
+
+def update_delivery_rollups(cursor, companies, delivery_database):
+    """重新统计指定企业的投递漏斗和首次回复耗时，会对这些企业的投递记录加锁，只在短事务中调用"""
+    companies = sorted({company for company in companies if company})
+    with metrics.timer('rollup_seconds', table='deliveries'):
+        for i in range(0, len(companies), ROLLUP_CHUNK_SIZE):
+            chunk = companies[i:i+ROLLUP_CHUNK_SIZE]
+            where = f"company_name IN ({','.join(['%s'] * len(chunk))})"
+            for table in ('rollup_delivery_funnel', 'rollup_response_latency'):
+                _replace(cursor, table, 'company_name', chunk, where, chunk, delivery_database)
+
+
+def rebuild(connection, delivery_database):
+    """在一个事务中清空并重新计算全部预聚合表，返回 {表名: 行数}"""
+    counts = {}
+    with connection.cursor() as cursor:
+        ensure_rollup_tables(cursor)
+        connection.begin()
+        try:
+            for table, (_, source, columns) in ROLLUPS.items():
+                cursor.execute(f"DELETE FROM {table}")
+                cursor.execute(f"INSERT INTO {table} ({columns}) {source.format(where='1=1', database=delivery_database)}")
+                counts[table] = cursor.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+    return counts
+
+
+def check(connection, delivery_database):
+    """按来源表重新计算并与预聚合表逐行比较，返回 {表名: [差异描述]}（一致的表不在结果中）"""
+    differences = {}
+    with connection.cursor() as cursor:
+        for table, (key_size, source, columns) in ROLLUPS.items():
+            cursor.execute(source.format(where='1=1', database=delivery_database))
+            expected = {row[:key_size]: row[key_size:] for row in cursor.fetchall()}
+            cursor.execute(f"SELECT {columns} FROM {table}")
+            actual = {row[:key_size]: row[key_size:] for row in cursor.fetchall()}
+            problems = []
+            for key in sorted(expected.keys() | actual.keys(), key=str):
+                if key not in actual:
+                    problems.append(f"缺少 {key}: 应为 {expected[key]}")
+                elif key not in expected:
+                    problems.append(f"多余 {key}: {actual[key]}")
+                elif expected[key] != actual[key]:
+                    problems.append(f"不一致 {key}: 应为 {expected[key]}，实际为 {actual[key]}")
+            if problems:
+                differences[table] = problems
+    return differences
+
+
+def main():
+    """主函数"""
+    import script.config as config
+    from script.email_classifier import DELIVERY_DATABASE
+    from script.qq_email_imap import connect_email_db, ensure_email_tables
+
+    parser = argparse.ArgumentParser(description='重建或检查数据分析页面使用的预聚合表')
+    parser.add_argument('command', choices=['rebuild', 'check'],
+                        help='rebuild 按全部邮件和投递记录重新计算；check 与来源表比较，不一致时以非零状态退出')
+    parser.add_argument('--limit', type=int, default=20, help='check时每张表最多打印的差异数')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args(config.config.get('metrics'), args)
+
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+    with connect_email_db(db_config) as connection:
+        with connection.cursor() as cursor:
+            ensure_email_tables(cursor)
+        if args.command == 'rebuild':
+            for table, count in rebuild(connection, DELIVERY_DATABASE).items():
+                print(f"{table}: {count} 行")
+            return
+        differences = check(connection, DELIVERY_DATABASE)
+    if not differences:
+        print("预聚合表与来源表一致")
+        return
+    for table, problems in differences.items():
+        print(f"{table}: {len(problems)} 处不一致")
+        for problem in problems[:args.limit]:
+            print(f"  {problem}")
+    print("运行 python script/analytics_rollup.py rebuild 重新计算")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
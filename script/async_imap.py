@@ -0,0 +1,402 @@
+# 基于asyncio的IMAP获取后端：在一个连接上流水线式发送多条UID FETCH命令
+import asyncio
+import itertools
+import queue
+import re
+import ssl
+import threading
+
+from imapclient import imap_utf7
+from imapclient.response_parser import parse_fetch_response
+
+from script import imap_budget, metrics
+from script.adaptive_batch import SIZE_FETCH_CHUNK, TARGET_BATCH_SECONDS, AdaptiveBatcher, is_connection_error
+
+# 同时在途的批次数，每个批次对应一条或几条UID FETCH命令
+DEFAULT_PIPELINE_DEPTH = 4
+# 单行响应的最大长度（BODYSTRUCTURE很复杂的邮件一行可能很长）
+STREAM_LIMIT = 16 * 1024 * 1024
+
+_LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n$')
+_TAGGED_RE = re.compile(rb'^(A\d+) (OK|NO|BAD)\b ?(.*)', re.DOTALL)
+_FETCH_RE = re.compile(rb'^\* (\d+) FETCH ', re.IGNORECASE)
+_SELECT_CODE_RE = re.compile(rb'\[(UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) (\d+)\]', re.IGNORECASE)
+_EXISTS_RE = re.compile(rb'^\* (\d+) EXISTS', re.IGNORECASE)
+
+
+class IMAPCommandError(Exception):
+    """IMAP命令返回NO或BAD"""
+
+
+def _quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _uid_set(uids):
+    """把UID列表压缩成IMAP序列集，如 1:5,7,9:12"""
+    ranges = []
+    for _, group in itertools.groupby(enumerate(sorted(uids)), lambda item: item[1] - item[0]):
+        group = [uid for _, uid in group]
+        ranges.append(str(group[0]) if len(group) == 1 else f'{group[0]}:{group[-1]}')
+    return ','.join(ranges)
+
+
+class _Command:
+    def __init__(self, tag, future, uids=None, on_message=None):
+        self.tag = tag
+        self.future = future
+        self.uids = uids
+        self.on_message = on_message
+        self.untagged = []
+        self.fetched = {}
+
+
+class AsyncIMAPConnection:
+    """最小化的异步IMAP客户端，只实现获取邮件需要的命令
+
+    命令发出后不等待完成即可发出下一条，由读取协程按标签分派响应。
+    UID FETCH的未标记响应按UID归属到对应的命令，每封邮件到达时即可处理，
+    解析结果与IMAPClient.fetch的返回格式一致。
+    """
+
+    def __init__(self, host, port=993, ssl_context=None, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.ssl_context = (ssl_context or ssl.create_default_context()) if use_ssl else None
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._tags = itertools.count(1)
+        self._pending = {}
+        self._fetch_owners = {}
+        self._last_command = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context, limit=STREAM_LIMIT
+        )
+        greeting = await self._read_response()
+        if not greeting or not greeting[-1].startswith(b'* OK'):
+            raise IMAPCommandError(f'服务器拒绝连接: {greeting!r}')
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def _read_response(self):
+        """读取一条完整的响应，格式与imaplib相同：字面量部分为 (前缀, 字面量) 元组"""
+        parts = []
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError('IMAP连接已断开')
+        while True:
+            match = _LITERAL_RE.search(line)
+            if not match:
+                parts.append(line.rstrip(b'\r\n'))
+                return parts
+            literal = await self._reader.readexactly(int(match.group(1)))
+            parts.append((line[:-2], literal))
+            line = await self._reader.readline()
+            if not line:
+                raise ConnectionError('IMAP连接已断开')
+
+    async def _read_loop(self):
+        try:
+            while True:
+                self._dispatch(await self._read_response())
+        except Exception as e:
+            for command in self._pending.values():
+                if not command.future.done():
+                    command.future.set_exception(ConnectionError(f'IMAP连接已断开: {e}'))
+            self._pending.clear()
+
+    def _dispatch(self, response):
+        first = response[0][0] if isinstance(response[0], tuple) else response[0]
+        tagged = _TAGGED_RE.match(first) if len(response) == 1 else None
+        if tagged:
+            command = self._pending.pop(tagged.group(1).decode(), None)
+            if command is None:
+                return
+            for uid in command.uids or ():
+                self._fetch_owners.pop(uid, None)
+            if tagged.group(2) == b'OK':
+                command.future.set_result(command)
+            else:
+                command.future.set_exception(IMAPCommandError(tagged.group(3).decode('utf-8', 'ignore')))
+            return
+
+        fetch = _FETCH_RE.match(first)
+        if fetch:
+            # 去掉 "* " 和 "FETCH "，得到imaplib格式的 "序号 (...)"
+            strip = len(fetch.group(0))
+            head = fetch.group(1) + b' ' + first[strip:]
+            data = [(head, response[0][1])] if isinstance(response[0], tuple) else [head]
+            parsed = parse_fetch_response(data + response[1:], True, True)
+            for uid, item in parsed.items():
+                command = self._fetch_owners.get(uid)
+                if command is None:
+                    continue
+                command.fetched[uid] = item
+                if command.on_message:
+                    command.on_message(uid, item)
+            return
+
+        # 其他未标记响应（如SELECT的UIDVALIDITY）归属于最近发出的命令
+        if self._last_command is not None:
+            self._last_command.untagged.append(response)
+
+    async def command(self, text, uids=None, on_message=None):
+        """发送一条命令并等待完成；多个command可以并发调用以实现流水线"""
+        tag = f'A{next(self._tags):04d}'
+        command = _Command(tag, asyncio.get_running_loop().create_future(), uids, on_message)
+        self._pending[tag] = command
+        for uid in uids or ():
+            self._fetch_owners[uid] = command
+        self._last_command = command
+        self._writer.write(f'{tag} {text}\r\n'.encode('utf-8'))
+        await self._writer.drain()
+        return await command.future
+
+    async def login(self, user, password):
+        await self.command(f'LOGIN {_quote(user)} {_quote(password)}')
+
+    async def examine(self, folder='INBOX'):
+        """只读方式选择文件夹，返回与IMAPClient.select_folder相同键名的字典"""
+        # 非ASCII文件夹名使用IMAP修改版UTF-7编码
+        command = await self.command(f"EXAMINE {_quote(imap_utf7.encode(folder).decode('ascii'))}")
+        info = {}
+        for response in command.untagged:
+            line = response[-1] if isinstance(response[-1], bytes) else response[-1][0]
+            for key, value in _SELECT_CODE_RE.findall(line):
+                info[key.upper()] = int(value)
+            exists = _EXISTS_RE.match(line)
+            if exists:
+                info[b'EXISTS'] = int(exists.group(1))
+        return info
+
+    async def uid_fetch(self, uids, items, on_message=None, stage='rfc822'):
+        """UID FETCH，返回 {uid: {数据项: 值}}；on_message(uid, 数据) 在每封邮件到达时调用
+
+        stage只用于指标标签（header/body/rfc822），流水线中的耗时包含排队等待前面命令的时间。
+        """
+        with metrics.timer('imap_fetch_seconds', stage=stage, backend='asyncio'):
+            command = await self.command(f"UID FETCH {_uid_set(uids)} ({' '.join(items)})", set(uids), on_message)
+        if metrics.is_enabled():
+            from script.qq_email_imap import record_fetched
+            record_fetched(command.fetched, stage, backend='asyncio')
+        return command.fetched
+
+    async def logout(self):
+        try:
+            await asyncio.wait_for(self.command('LOGOUT'), 10)
+        except Exception:
+            pass
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._writer:
+            self._writer.close()
+
+
+class AsyncFetchBackend:
+    """给同步代码使用的流水线获取后端
+
+    iter_batches与qq_email_imap.iter_email_batches产出相同的 (batch_ids, 邮件列表, 错误)，
+    内部在后台线程中运行事件循环：最多pipeline_depth个批次同时在途，
+    完整邮件经共享内存交给解析进程池（parse_pool.ParsePool），事件循环本身不做解析。
+    未提供parse_pool时每次iter_batches按parse_workers创建并在结束时关闭。
+    """
+
+    def __init__(self, email_addr, password, imap_server, pipeline_depth=DEFAULT_PIPELINE_DEPTH, parse_workers=None,
+                 port=993, use_ssl=True, folder='INBOX', parse_pool=None):
+        self.email_addr = email_addr
+        self.password = password
+        self.imap_server = imap_server
+        self.port = port
+        self.use_ssl = use_ssl
+        self.folder = folder
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.parse_workers = parse_workers
+        self.parse_pool = parse_pool
+
+    def iter_batches(self, email_ids, fetch_mode='partial', batch_size=None, cache=None, uidvalidity=None):
+        results = queue.Queue(maxsize=self.pipeline_depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # 消费端处理慢时在这里等待，向获取端施加背压；消费端提前退出时放弃
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        def run():
+            try:
+                asyncio.run(self._produce(email_ids, fetch_mode, batch_size, cache, uidvalidity, put, stop))
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    async def _produce(self, email_ids, fetch_mode, batch_size, cache, uidvalidity, put, stop):
+        from script.parse_pool import ParsePool
+
+        loop = asyncio.get_running_loop()
+        # 与IMAPClient连接共用账号的连接名额（见 imap_budget.py）
+        await loop.run_in_executor(None, imap_budget.acquire, self.email_addr)
+        try:
+            conn = AsyncIMAPConnection(self.imap_server, self.port, use_ssl=self.use_ssl)
+            await conn.connect()
+        except BaseException:
+            imap_budget.release(self.email_addr)
+            raise
+        pool = self.parse_pool or ParsePool(self.parse_workers)
+        try:
+            await conn.login(self.email_addr, self.password)
+            info = await conn.examine(self.folder)
+            if uidvalidity is not None and info.get(b'UIDVALIDITY') not in (None, uidvalidity):
+                raise IMAPCommandError(f"UIDVALIDITY已变化 ({uidvalidity} -> {info.get(b'UIDVALIDITY')})")
+
+            sizes = await self._message_sizes(conn, email_ids)
+            # 流水线中每批的耗时包含排在前面的批次，目标耗时按流水线深度放宽
+            batcher = AdaptiveBatcher(email_ids, sizes, fetch_mode, max_messages=batch_size,
+                                      target_seconds=TARGET_BATCH_SECONDS * self.pipeline_depth)
+            in_flight = []
+            while not stop.is_set():
+                while len(in_flight) < self.pipeline_depth:
+                    batch_ids = batcher.next_batch()
+                    if batch_ids is None:
+                        break
+                    print(f"正在处理第 {batcher.batch_no} 批邮件（{len(batch_ids)} 封），"
+                          f"邮件ID范围 {min(batch_ids)}-{max(batch_ids)}，剩余 {batcher.remaining()} 封")
+                    in_flight.append((batch_ids, loop.time(), asyncio.create_task(
+                        self._fetch_batch(conn, loop, pool, batch_ids, fetch_mode, cache, uidvalidity)
+                    )))
+                if not in_flight:
+                    break
+                # 按发出的顺序等待；失败的批次放回队列重试，调用方按连续提交的UID推进断点
+                done_ids, started, task = in_flight.pop(0)
+                try:
+                    item = (done_ids, await task, None)
+                    batcher.succeeded(done_ids, loop.time() - started)
+                except Exception as e:
+                    delay = batcher.failed(done_ids, e)
+                    if delay is not None:
+                        print(f"处理邮件ID {min(done_ids)}-{max(done_ids)} 时出错，{delay:.1f} 秒后重试: {e}")
+                        await asyncio.sleep(delay)
+                        continue
+                    print(f"处理邮件ID {min(done_ids)}-{max(done_ids)} 时出错: {e}")
+                    item = (done_ids, [], e)
+                    if is_connection_error(e):
+                        # 连接已断开，在途和剩余的邮件都留到下次运行
+                        for _, _, other in in_flight:
+                            other.cancel()
+                        rest = [uid for ids, _, _ in in_flight for uid in ids] + batcher.abandon()
+                        in_flight = []
+                        await loop.run_in_executor(None, put, item)
+                        if rest:
+                            await loop.run_in_executor(None, put, (sorted(rest), [], e))
+                        break
+                await loop.run_in_executor(None, put, item)
+            for _, _, task in in_flight:
+                task.cancel()
+        finally:
+            try:
+                if pool is not self.parse_pool:
+                    await loop.run_in_executor(None, pool.close)
+                await conn.logout()
+            finally:
+                imap_budget.release(self.email_addr)
+
+    async def _message_sizes(self, conn, email_ids):
+        """UID FETCH RFC822.SIZE，返回 {uid: 字节数}；出错时返回已取到的部分，按估算大小分批"""
+        sizes = {}
+        for i in range(0, len(email_ids), SIZE_FETCH_CHUNK):
+            try:
+                data = await conn.uid_fetch(email_ids[i:i+SIZE_FETCH_CHUNK], ['RFC822.SIZE'], stage='size')
+            except IMAPCommandError as e:
+                metrics.warn("获取邮件大小失败，按估算大小分批: %s", e)
+                break
+            sizes.update((uid, int(item[b'RFC822.SIZE'])) for uid, item in data.items() if b'RFC822.SIZE' in item)
+        return sizes
+
+    async def _fetch_batch(self, conn, loop, pool, batch_ids, fetch_mode, cache, uidvalidity):
+        if fetch_mode == 'partial':
+            return await self._fetch_batch_partial(conn, loop, pool, batch_ids, cache, uidvalidity)
+        return await self._fetch_batch_rfc822(conn, loop, pool, batch_ids, cache, uidvalidity)
+
+    async def _fetch_batch_rfc822(self, conn, loop, pool, batch_ids, cache, uidvalidity):
+        cached = await loop.run_in_executor(None, cache.get_many, uidvalidity, batch_ids) if cache else {}
+        parsing = [asyncio.ensure_future(_parse(loop, pool, list(cached.items())))] if cached else []
+
+        def on_message(uid, item):
+            raw = item.get(b'RFC822')
+            if raw is None:
+                return
+            # 每封邮件一到达就提交解析，不等整条FETCH命令完成
+            parsing.append(asyncio.ensure_future(_parse(loop, pool, [(uid, raw)])))
+            if cache:
+                loop.run_in_executor(None, _cache_put, cache, raw, uidvalidity, uid)
+
+        missing = [uid for uid in batch_ids if uid not in cached]
+        if missing:
+            await conn.uid_fetch(missing, ['RFC822'], on_message)
+        records = {record['imap_id']: record for task in parsing for record in await task}
+        for uid in batch_ids:
+            if uid not in records:
+                print(f"未找到邮件ID {uid} 的数据")
+        return [records[uid] for uid in batch_ids if uid in records]
+
+    async def _fetch_batch_partial(self, conn, loop, pool, batch_ids, cache, uidvalidity):
+        from script.qq_email_imap import (HEADER_FIELDS_ITEM, fill_partial_bodies, partial_body_item,
+                                          partial_records)
+
+        cached = await loop.run_in_executor(None, cache.get_many, uidvalidity, batch_ids) if cache else {}
+        parsing = asyncio.ensure_future(_parse(loop, pool, list(cached.items()))) if cached else None
+        remaining = [uid for uid in batch_ids if uid not in cached]
+        records = {}
+        if remaining:
+            headers = await conn.uid_fetch(remaining, [HEADER_FIELDS_ITEM, 'BODYSTRUCTURE', 'INTERNALDATE'],
+                                           stage='header')
+            records, sections, fallback_ids = await loop.run_in_executor(None, partial_records, headers, remaining)
+            # 不同section的第二阶段FETCH同时发出
+            fetches = [
+                conn.uid_fetch([uid for uid, _ in parts], [partial_body_item(section)], stage='body')
+                for section, parts in sections.items()
+            ]
+            if fallback_ids:
+                fetches.append(conn.uid_fetch(fallback_ids, ['RFC822']))
+            results = await asyncio.gather(*fetches)
+            for (section, parts), bodies in zip(sections.items(), results):
+                await loop.run_in_executor(None, fill_partial_bodies, records, parts, bodies, section)
+            if fallback_ids:
+                items = [(uid, item[b'RFC822']) for uid, item in results[-1].items() if b'RFC822' in item]
+                records.update((record['imap_id'], record) for record in await _parse(loop, pool, items))
+        if parsing is not None:
+            records.update((record['imap_id'], record) for record in await parsing)
+        return [records[uid] for uid in batch_ids if uid in records]
+
+
+async def _parse(loop, pool, items):
+    """把 (uid, 原始邮件) 交给解析池；槽位用完时在线程中等待，不阻塞事件循环"""
+    future = await loop.run_in_executor(None, pool.submit, items)
+    return await asyncio.wrap_future(future)
+
+
+def _cache_put(cache, raw, uidvalidity, uid):
+    try:
+        cache.put(raw, uidvalidity, uid)
+    except Exception as e:
+        metrics.warn("写入原始邮件缓存失败: %s", e)
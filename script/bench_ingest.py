@@ -0,0 +1,847 @@
+# 邮件入库全流程性能测试：合成邮箱 + 进程内IMAP服务器 + 可替换的数据库后端，结果输出为可比较的JSON
+import argparse
+import asyncio
+import contextlib
+import datetime
+import email
+import email.utils
+import io
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from email.header import Header
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script.qq_email_imap as qq_email_imap
+from script.search_index import document_terms
+
+# 结果JSON的格式版本，字段含义变化时递增，--compare只比较同一版本的结果
+RESULT_VERSION = 1
+BENCH_ACCOUNT = 'bench@localhost'
+BENCH_UIDVALIDITY = 1
+# 延迟百分位
+PERCENTILES = (50, 90, 95, 99)
+
+# ---------------------------------------------------------------------------
+# 合成邮箱
+# ---------------------------------------------------------------------------
+
+COMPANIES = ['字节跳动', '腾讯', '阿里巴巴', '美团', '京东', '网易', '百度', 'Microsoft', 'Shopee', '米哈游']
+POSITIONS = ['后端开发工程师', '前端开发工程师', '算法工程师', '测试开发工程师', 'Software Engineer']
+SUBJECTS = [
+    '【{company}】{position}面试邀请',
+    '{company}校园招聘 - 简历投递成功',
+    '{company}笔试通知：{position}',
+    '感谢您投递{company}的{position}职位',
+    '{company} Offer Letter - {position}',
+    'Your application to {company} has been received',
+    '每周精选 | 求职技巧与行业资讯',
+]
+PARAGRAPH_SIMPLIFIED = '感谢您投递我司{position}岗位，我们诚挚地邀请您参加面试，请于三日内确认时间。'
+PARAGRAPH_TRADITIONAL = '感謝您應徵本公司職位，我們誠摯地邀請您參加面試，請於三日內確認時間。'
+PARAGRAPH_LATIN = 'Thank you for applying. We would like to invite you to an interview next week. '
+
+# 邮件类型及其占比
+MESSAGE_KINDS = (
+    ('plain_utf8', 20),
+    ('plain_gbk', 10),
+    ('plain_gb18030', 5),
+    ('plain_big5', 5),
+    ('plain_latin1', 5),
+    ('html_only', 20),
+    ('alternative', 20),
+    ('nested', 10),
+    ('attachment', 5),
+)
+
+
+def _text(rng, paragraph, position, repeat_range):
+    return paragraph.format(position=position) * rng.randint(*repeat_range)
+
+
+def _html(body_text):
+    return ('<html><head><style>p {color: #333}</style><script>var track = 1;</script></head><body>'
+            + ''.join(f'<p>{line}&nbsp;&amp;</p>' for line in body_text.split('。') if line)
+            + '<table><tr><td>退订</td></tr></table></body></html>')
+
+
+def build_message(rng, kind, position, attachment_kb):
+    """按类型生成一封邮件（不含邮件头）"""
+    if kind == 'plain_utf8':
+        return MIMEText(_text(rng, PARAGRAPH_SIMPLIFIED, position, (2, 60)), 'plain', 'utf-8')
+    if kind == 'plain_gbk':
+        return MIMEText(_text(rng, PARAGRAPH_SIMPLIFIED, position, (2, 60)), 'plain', 'gbk')
+    if kind == 'plain_gb18030':
+        return MIMEText(_text(rng, PARAGRAPH_SIMPLIFIED, position, (2, 60)), 'plain', 'gb18030')
+    if kind == 'plain_big5':
+        return MIMEText(PARAGRAPH_TRADITIONAL * rng.randint(2, 60), 'plain', 'big5')
+    if kind == 'plain_latin1':
+        return MIMEText(PARAGRAPH_LATIN * rng.randint(2, 60) + 'Café, naïve résumé.', 'plain', 'iso-8859-1')
+    if kind == 'html_only':
+        return MIMEText(_html(_text(rng, PARAGRAPH_SIMPLIFIED, position, (20, 400))), 'html', 'utf-8')
+    if kind == 'alternative':
+        msg = MIMEMultipart('alternative')
+        text = _text(rng, PARAGRAPH_SIMPLIFIED, position, (5, 100))
+        msg.attach(MIMEText(text, 'plain', 'gb2312'))
+        msg.attach(MIMEText(_html(text), 'html', 'utf-8'))
+        return msg
+    if kind == 'nested':
+        # mixed[alternative[plain, related[html, 图片]], 附件]
+        text = _text(rng, PARAGRAPH_SIMPLIFIED, position, (5, 100))
+        related = MIMEMultipart('related')
+        related.attach(MIMEText(_html(text) + '<img src="cid:logo">', 'html', 'utf-8'))
+        image = MIMEImage(rng.randbytes(4 * 1024), 'png')
+        image.add_header('Content-ID', '<logo>')
+        related.attach(image)
+        alternative = MIMEMultipart('alternative')
+        alternative.attach(MIMEText(text, 'plain', 'utf-8'))
+        alternative.attach(related)
+        msg = MIMEMultipart('mixed')
+        msg.attach(alternative)
+        attachment = MIMEApplication(rng.randbytes(32 * 1024), 'pdf')
+        attachment.add_header('Content-Disposition', 'attachment', filename='jd.pdf')
+        msg.attach(attachment)
+        return msg
+    # 大附件：附件在前、HTML正文在后
+    msg = MIMEMultipart('mixed')
+    attachment = MIMEApplication(rng.randbytes(attachment_kb * 1024), 'pdf')
+    attachment.add_header('Content-Disposition', 'attachment', filename='resume.pdf')
+    msg.attach(attachment)
+    msg.attach(MIMEText(_html(_text(rng, PARAGRAPH_SIMPLIFIED, position, (5, 100))), 'html', 'utf-8'))
+    return msg
+
+
+def generate_mailbox(count, seed=1, attachment_kb=512):
+    """生成合成邮箱，相同的参数总是生成相同的邮件
+
+    Returns:
+        list: [(uid, 原始邮件字节（CRLF换行）, INTERNALDATE)]，UID从1开始连续
+    """
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in MESSAGE_KINDS]
+    weights = [weight for _, weight in MESSAGE_KINDS]
+    start = datetime.datetime(2024, 1, 1, 9, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=8)))
+    messages = []
+    for uid in range(1, count + 1):
+        kind = rng.choices(kinds, weights)[0]
+        company = rng.choice(COMPANIES)
+        position = rng.choice(POSITIONS)
+        msg = build_message(rng, kind, position, attachment_kb)
+        subject = rng.choice(SUBJECTS).format(company=company, position=position)
+        subject_charset = 'gbk' if kind in ('plain_gbk', 'alternative') else 'utf-8'
+        msg['Subject'] = Header(subject, subject_charset)
+        msg['From'] = email.utils.formataddr((str(Header(f'{company}招聘', 'utf-8')), f'hr{uid % 13}@company{uid % 7}.com'))
+        msg['To'] = BENCH_ACCOUNT
+        sent = start + datetime.timedelta(minutes=97 * uid)
+        msg['Date'] = email.utils.format_datetime(sent)
+        msg['Message-ID'] = f'<bench-{seed}-{uid}@localhost>'
+        raw = re.sub(rb'\r?\n', b'\r\n', msg.as_bytes())
+        messages.append((uid, raw, sent))
+    return messages
+
+
+# ---------------------------------------------------------------------------
+# 进程内IMAP服务器
+# ---------------------------------------------------------------------------
+
+_LITERAL_RE = re.compile(rb'\{(\d+)\+?\}\r\n$')
+_FETCH_ITEM_RE = re.compile(r'(BODY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?|[A-Z0-9.]+')
+
+
+NEWLINE = b'\n'
+
+
+def _quote(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _part_body(part):
+    """MIME部分的原始（未解码）正文字节"""
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, list):
+        return b''
+    return payload.encode('ascii', errors='surrogateescape')
+
+
+def _params(part):
+    params = part.get_params()
+    if not params or len(params) < 2:
+        return 'NIL'
+    return '(' + ' '.join(f'{_quote(name)} {_quote(value)}' for name, value in params[1:]) + ')'
+
+
+def _bodystructure(part):
+    """按RFC 3501生成BODYSTRUCTURE（含扩展字段）"""
+    if part.is_multipart():
+        children = ''.join(_bodystructure(child) for child in part.get_payload())
+        return f'({children} {_quote(part.get_content_subtype())} {_params(part)} NIL NIL NIL)'
+    body = _part_body(part)
+    encoding = part.get('Content-Transfer-Encoding', '7bit')
+    disposition = 'NIL'
+    if part.get_content_disposition():
+        filename = part.get_filename()
+        params = f'({_quote("filename")} {_quote(filename)})' if filename else 'NIL'
+        disposition = f'({_quote(part.get_content_disposition())} {params})'
+    fields = (f'{_quote(part.get_content_maintype())} {_quote(part.get_content_subtype())} {_params(part)} '
+              f'NIL NIL {_quote(encoding)} {len(body)}')
+    if part.get_content_maintype() == 'text':
+        fields += f' {body.count(NEWLINE)}'
+    return f'({fields} NIL {disposition} NIL NIL)'
+
+
+class MailboxMessage:
+    """服务器端的一封邮件，预先计算BODYSTRUCTURE和正文部分，避免服务器在测量期间解析邮件"""
+
+    __slots__ = ('uid', 'raw', 'internaldate', 'header', 'bodystructure', 'text_sections')
+
+    def __init__(self, uid, raw, internaldate):
+        self.uid = uid
+        self.raw = raw
+        self.internaldate = internaldate
+        self.header = raw[:raw.find(b'\r\n\r\n') + 4]
+        msg = email.message_from_bytes(raw)
+        self.bodystructure = _bodystructure(msg).encode('utf-8')
+        self.text_sections = {}
+        for section, part in self._leaves(msg, ''):
+            if part.get_content_maintype() == 'text':
+                self.text_sections[section] = _part_body(part)
+
+    @classmethod
+    def _leaves(cls, part, section):
+        if not part.is_multipart():
+            yield section or '1', part
+            return
+        for index, child in enumerate(part.get_payload(), start=1):
+            yield from cls._leaves(child, f'{section}.{index}' if section else str(index))
+
+    def section(self, section):
+        if section in self.text_sections:
+            return self.text_sections[section]
+        part = email.message_from_bytes(self.raw)
+        for index in section.split('.'):
+            if part.is_multipart():
+                part = part.get_payload()[int(index) - 1]
+        return _part_body(part)
+
+    def header_fields(self, names, exclude=False):
+        fields = []
+        for line in self.header[:-2].split(b'\r\n'):
+            if line[:1] in (b' ', b'\t') and fields:
+                fields[-1][1].append(line)
+            else:
+                fields.append((line.split(b':', 1)[0].strip().upper(), [line]))
+        selected = [b'\r\n'.join(lines) + b'\r\n' for name, lines in fields if (name in names) != exclude]
+        return b''.join(selected) + b'\r\n'
+
+
+class LocalIMAPServer:
+    """在后台线程中运行的最小IMAP服务器（明文，只读），实现同步和获取邮件用到的命令
+
+    支持 CAPABILITY、LOGIN、SELECT/EXAMINE、[UID] SEARCH（ALL、UID、SINCE、BEFORE）、
+    [UID] FETCH（RFC822、BODYSTRUCTURE、BODY[...]<偏移.长度>、HEADER.FIELDS等）。
+    latency为模拟的网络往返时间：响应延迟发送，但不阻塞同一连接上后续命令的处理，流水线客户端可以重叠等待。
+    """
+
+    def __init__(self, messages, host='127.0.0.1', port=0, latency=0.0, uidvalidity=BENCH_UIDVALIDITY):
+        self.messages = [MailboxMessage(uid, raw, internaldate) for uid, raw, internaldate in messages]
+        self.by_uid = {message.uid: message for message in self.messages}
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.uidvalidity = uidvalidity
+        self.bytes_sent = 0
+        self.commands = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port, limit=16 * 1024 * 1024)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+
+        def send(data):
+            self.bytes_sent += len(data)
+            if self.latency:
+                loop.call_later(self.latency, writer.write, data)
+            else:
+                writer.write(data)
+
+        writer.write(b'* OK [CAPABILITY IMAP4rev1] bench server ready\r\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # 客户端发送的字面量（如含特殊字符的密码），非同步字面量 {n+} 不需要等待继续响应
+                while (match := _LITERAL_RE.search(line)):
+                    if b'+}' not in match.group(0):
+                        writer.write(b'+ go ahead\r\n')
+                        await writer.drain()
+                    line = line[:match.start()] + await reader.readexactly(int(match.group(1))) + await reader.readline()
+                self.commands += 1
+                tag, _, rest = line.decode('utf-8', errors='replace').rstrip('\r\n').partition(' ')
+                command, _, args = rest.partition(' ')
+                command = command.upper()
+                if command == 'LOGOUT':
+                    send(b'* BYE bench server logging out\r\n' + f'{tag} OK LOGOUT completed\r\n'.encode())
+                    break
+                send(self._dispatch(tag, command, args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            writer.close()
+
+    def _dispatch(self, tag, command, args):
+        uid_mode = False
+        if command == 'UID':
+            uid_mode = True
+            command, _, args = args.partition(' ')
+            command = command.upper()
+        if command == 'CAPABILITY':
+            return f'* CAPABILITY IMAP4rev1 UIDPLUS\r\n{tag} OK CAPABILITY completed\r\n'.encode()
+        if command in ('LOGIN', 'NOOP', 'CLOSE', 'ENABLE', 'ID', 'CHECK'):
+            return f'{tag} OK {command} completed\r\n'.encode()
+        if command in ('SELECT', 'EXAMINE'):
+            uidnext = (self.messages[-1].uid if self.messages else 0) + 1
+            mode = 'READ-ONLY' if command == 'EXAMINE' else 'READ-WRITE'
+            return (f'* {len(self.messages)} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen)\r\n'
+                    f'* OK [UIDVALIDITY {self.uidvalidity}] UIDs valid\r\n* OK [UIDNEXT {uidnext}] next UID\r\n'
+                    f'{tag} OK [{mode}] {command} completed\r\n').encode()
+        if command == 'SEARCH':
+            found = self._search(args, uid_mode)
+            return f'* SEARCH {" ".join(map(str, found))}\r\n{tag} OK SEARCH completed\r\n'.encode()
+        if command == 'FETCH':
+            return self._fetch(tag, args, uid_mode)
+        return f'{tag} BAD unsupported command {command}\r\n'.encode()
+
+    def _resolve_set(self, sequence_set, uid_mode):
+        """解析序列集，返回 [(序号, 邮件)]"""
+        if not self.messages:
+            return []
+        highest = self.messages[-1].uid if uid_mode else len(self.messages)
+        wanted = set()
+        for item in sequence_set.split(','):
+            low, _, high = item.partition(':')
+            low = highest if low == '*' else int(low)
+            high = low if not high else (highest if high == '*' else int(high))
+            low, high = min(low, high), max(low, high)
+            wanted.update(range(low, min(high, highest) + 1))
+        if uid_mode:
+            return [(seq, message) for seq, message in enumerate(self.messages, start=1) if message.uid in wanted]
+        return [(seq, self.messages[seq - 1]) for seq in sorted(wanted) if seq >= 1]
+
+    def _search(self, args, uid_mode):
+        tokens = args.replace('(', ' ').replace(')', ' ').split()
+        matches = list(enumerate(self.messages, start=1))
+        i = 0
+        while i < len(tokens):
+            key = tokens[i].upper()
+            if key == 'CHARSET':
+                i += 2
+                continue
+            if key == 'UID' and i + 1 < len(tokens):
+                allowed = {id(message) for _, message in self._resolve_set(tokens[i + 1], True)}
+                matches = [(seq, message) for seq, message in matches if id(message) in allowed]
+                i += 2
+                continue
+            if key in ('SINCE', 'BEFORE') and i + 1 < len(tokens):
+                day = datetime.datetime.strptime(tokens[i + 1].strip('"'), '%d-%b-%Y').date()
+                if key == 'SINCE':
+                    matches = [(seq, m) for seq, m in matches if m.internaldate.date() >= day]
+                else:
+                    matches = [(seq, m) for seq, m in matches if m.internaldate.date() < day]
+                i += 2
+                continue
+            i += 1
+        return [message.uid if uid_mode else seq for seq, message in matches]
+
+    def _fetch(self, tag, args, uid_mode):
+        sequence_set, _, items = args.partition(' ')
+        items = items.strip()
+        if items.startswith('(') and items.endswith(')'):
+            items = items[1:-1]
+        requested = [match for match in _FETCH_ITEM_RE.finditer(items.upper())]
+        out = []
+        for seq, message in self._resolve_set(sequence_set, uid_mode):
+            parts = [f'UID {message.uid}'.encode()]
+            for match in requested:
+                name = match.group(0)
+                if match.group(1):
+                    section, start, length = match.group(2), match.group(3), match.group(4)
+                    data = self._section_data(message, section)
+                    key = f'BODY[{section}]'
+                    if start is not None:
+                        offset = int(start)
+                        data = data[offset:offset + int(length)] if length else data[offset:]
+                        key += f'<{offset}>'
+                    parts.append(f'{key} {{{len(data)}}}\r\n'.encode() + data)
+                elif name in ('RFC822', 'BODY'):
+                    parts.append(f'RFC822 {{{len(message.raw)}}}\r\n'.encode() + message.raw)
+                elif name == 'RFC822.HEADER':
+                    parts.append(f'RFC822.HEADER {{{len(message.header)}}}\r\n'.encode() + message.header)
+                elif name == 'RFC822.SIZE':
+                    parts.append(f'RFC822.SIZE {len(message.raw)}'.encode())
+                elif name == 'BODYSTRUCTURE':
+                    parts.append(b'BODYSTRUCTURE ' + message.bodystructure)
+                elif name == 'INTERNALDATE':
+                    parts.append(f'INTERNALDATE "{message.internaldate.strftime("%d-%b-%Y %H:%M:%S %z")}"'.encode())
+                elif name == 'FLAGS':
+                    parts.append(b'FLAGS (\\Seen)')
+            out.append(f'* {seq} FETCH ('.encode() + b' '.join(parts) + b')\r\n')
+        out.append(f'{tag} OK FETCH completed\r\n'.encode())
+        return b''.join(out)
+
+    @staticmethod
+    def _section_data(message, section):
+        if section == '':
+            return message.raw
+        if section == 'HEADER':
+            return message.header
+        if section == 'TEXT':
+            return message.raw[len(message.header):]
+        if section.startswith('HEADER.FIELDS'):
+            names = {name.encode() for name in section[section.find('(') + 1:section.rfind(')')].split()}
+            return message.header_fields(names, exclude=section.startswith('HEADER.FIELDS.NOT'))
+        return message.section(section)
+
+
+# ---------------------------------------------------------------------------
+# 数据库后端
+# ---------------------------------------------------------------------------
+
+class SqliteSink:
+    """SQLite后端：与all_emails相同的列、去重键和搜索索引，不需要MySQL即可运行
+
+    SQL方言不同，测量的是行构造、指纹计算、建索引词和本地存储的开销，不能代替MySQL上的数值。
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:'):
+        self.path = path or ':memory:'
+        self.connection = None
+
+    def open(self):
+        if self.path != ':memory:' and os.path.exists(self.path):
+            os.remove(self.path)
+        self.connection = sqlite3.connect(self.path)
+        columns = ', '.join(f'{column} {"BLOB" if column.endswith("_hash") else "TEXT"}' for column in qq_email_imap.EMAIL_COLUMNS)
+        self.connection.execute(f"CREATE TABLE all_emails (id INTEGER PRIMARY KEY, {columns})")
+        self.connection.execute("CREATE UNIQUE INDEX uniq_message_id_hash ON all_emails (message_id_hash)")
+        self.connection.execute("CREATE INDEX idx_send_ts ON all_emails (send_ts)")
+        self.connection.execute(
+            "CREATE TABLE email_search_terms (term TEXT, email_id INTEGER, weight INTEGER, PRIMARY KEY (term, email_id))"
+        )
+        updates = ', '.join(f'{column}=excluded.{column}' for column in qq_email_imap.EMAIL_COLUMNS
+                            if column not in ('uidvalidity', 'uid', 'imap_id', 'delivered', 'account', 'folder'))
+        self.upsert_sql = (
+            f"INSERT INTO all_emails ({', '.join(qq_email_imap.EMAIL_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(qq_email_imap.EMAIL_COLUMNS))}) "
+            f"ON CONFLICT(message_id_hash) DO UPDATE SET {updates} "
+            f"WHERE all_emails.content_hash IS NOT excluded.content_hash"
+        )
+
+    def save(self, emails):
+        rows = []
+        for e in emails:
+            row = list(qq_email_imap.email_row(e, BENCH_UIDVALIDITY, BENCH_ACCOUNT, 'INBOX'))
+            row[8] = row[8].isoformat(' ') if row[8] else None
+            rows.append(row)
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(self.upsert_sql, rows)
+            changed = self.connection.total_changes - before
+            if changed:
+                hashes = [row[3] for row in rows]
+                cursor = self.connection.execute(
+                    f"SELECT id, subject, body FROM all_emails WHERE message_id_hash IN ({','.join('?' * len(hashes))})",
+                    hashes
+                )
+                for email_id, subject, body in cursor.fetchall():
+                    self.connection.execute("DELETE FROM email_search_terms WHERE email_id = ?", (email_id,))
+                    self.connection.executemany(
+                        "INSERT INTO email_search_terms (term, email_id, weight) VALUES (?, ?, ?)",
+                        [(term, email_id, weight) for term, weight in document_terms(subject, body).items()]
+                    )
+        return changed
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+
+
+class MySQLSink:
+    """MySQL后端：走真实的upsert_emails入库路径（含搜索索引），每批一个事务
+
+    写入单独的测试数据库，开始前清空；自动分类会写入投递/面试数据库，测试时关闭。
+    """
+
+    name = 'mysql'
+
+    def __init__(self, database):
+        if database == 'job_emails':
+            raise ValueError("不能在正式数据库 job_emails 上运行性能测试")
+        self.database = database
+        self.connection = None
+
+    def open(self):
+        import pymysql
+        import script.config as config
+
+        qq_email_imap.CLASSIFY_ON_INGEST = False
+        db = config.config['db']
+        with pymysql.connect(host=db['host'], user=db['user'], password=db['password'], charset=db['charset']) as server:
+            with server.cursor() as cursor:
+                cursor.execute(f"CREATE DATABASE IF NOT EXISTS {self.database}")
+        self.connection = qq_email_imap.connect_email_db({
+            'host': db['host'], 'user': db['user'], 'password': db['password'],
+            'database': self.database, 'charset': db['charset']
+        })
+        with self.connection.cursor() as cursor:
+            qq_email_imap.ensure_email_tables(cursor)
+            for table in ('all_emails', 'email_search_terms', 'email_search_docs'):
+                cursor.execute(f"TRUNCATE TABLE {table}")
+
+    def save(self, emails):
+        self.connection.begin()
+        with self.connection.cursor() as cursor:
+            changed = qq_email_imap.upsert_emails(cursor, emails, uidvalidity=BENCH_UIDVALIDITY, account=BENCH_ACCOUNT,
+                                    folder='INBOX')
+        self.connection.commit()
+        return changed
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+
+
+# 可用的数据库后端，--db 参数形如 sqlite、sqlite:/tmp/bench.db、mysql、mysql:job_emails_bench
+SINKS = {
+    'sqlite': SqliteSink,
+    'mysql': MySQLSink,
+}
+DEFAULT_SINK_TARGETS = {
+    'sqlite': ':memory:',
+    'mysql': 'job_emails_bench',
+}
+
+
+def open_sink(spec):
+    name, _, target = spec.partition(':')
+    if name not in SINKS:
+        raise ValueError(f"未知的数据库后端 {name}，可选: {', '.join(SINKS)}")
+    sink = SINKS[name](target or DEFAULT_SINK_TARGETS[name])
+    sink.open()
+    return sink
+
+
+# ---------------------------------------------------------------------------
+# 测量
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb():
+    """进程的峰值常驻内存（MB），不支持的平台返回None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux以KB为单位，macOS以字节为单位
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentile(sorted_values, pct):
+    """最近秩百分位"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def stage_result(unit, latencies, items, nbytes, seconds):
+    latencies = sorted(latencies)
+    result = {
+        'unit': unit,
+        'items': items,
+        'operations': len(latencies),
+        'seconds': round(seconds, 4),
+        'items_per_sec': round(items / seconds, 1) if seconds else None,
+        'mb_per_sec': round(nbytes / 1024 / 1024 / seconds, 2) if seconds and nbytes else None,
+        'latency_ms': {f'p{pct}': round(percentile(latencies, pct) * 1000, 3) for pct in PERCENTILES},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    result['latency_ms']['max'] = round(latencies[-1] * 1000, 3) if latencies else 0.0
+    return result
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """屏蔽被测代码的逐批日志"""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def bench_fetch(server, fetch_mode, batch_size, backend_name, pipeline_depth, parse_workers=0):
+    """fetch_emails 的获取与解析阶段（iter_email_batches），每批的延迟为相邻两批产出的间隔
+
+    parse_workers大于0时完整邮件交给解析进程池（进程启动时间计入本阶段）。
+    """
+    from imapclient import IMAPClient
+
+    client = IMAPClient(server.host, port=server.port, ssl=False)
+    client.login(BENCH_ACCOUNT, 'bench')
+    parse_pool = None
+    if parse_workers > 0:
+        from script.parse_pool import ParsePool
+        parse_pool = ParsePool(parse_workers)
+    try:
+        client.select_folder('INBOX', readonly=True)
+        uids = sorted(client.search(['ALL']))
+        backend = None
+        if backend_name == 'asyncio':
+            from script.async_imap import AsyncFetchBackend
+            backend = AsyncFetchBackend(BENCH_ACCOUNT, 'bench', server.host, pipeline_depth=pipeline_depth,
+                                        port=server.port, use_ssl=False, parse_workers=parse_workers or None,
+                                        parse_pool=parse_pool)
+        emails = []
+        latencies = []
+        sent_before = server.bytes_sent
+        started = last = time.perf_counter()
+        for batch_ids, batch_emails, error in qq_email_imap.iter_email_batches(client, uids, fetch_mode, batch_size,
+                                                                 backend=backend, parse_pool=parse_pool):
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+            if error is not None:
+                raise RuntimeError(f"获取邮件ID {min(batch_ids)}-{max(batch_ids)} 失败: {error}")
+            emails.extend(batch_emails)
+        result = stage_result('batch', latencies, len(emails), server.bytes_sent - sent_before, last - started)
+        result['wire_bytes'] = server.bytes_sent - sent_before
+        return emails, result
+    finally:
+        if parse_pool is not None:
+            parse_pool.close()
+        client.logout()
+
+
+def bench_parse(messages):
+    """get_email_body 阶段：每封完整邮件的解析与正文提取"""
+    latencies = []
+    for _, raw, _ in messages:
+        started = time.perf_counter()
+        qq_email_imap.get_email_body(email.message_from_bytes(raw))
+        latencies.append(time.perf_counter() - started)
+    return stage_result('message', latencies, len(messages), sum(len(raw) for _, raw, _ in messages), sum(latencies))
+
+
+def bench_save(sink, emails, batch_size):
+    """save_emails_to_database 阶段：按批写入，每批的延迟包含行构造、写入和索引"""
+    latencies = []
+    changed = 0
+    for i in range(0, len(emails), batch_size):
+        started = time.perf_counter()
+        changed += sink.save(emails[i:i+batch_size])
+        latencies.append(time.perf_counter() - started)
+    result = stage_result('batch', latencies, len(emails), 0, sum(latencies))
+    result['rows_changed'] = changed
+    return result
+
+
+def run_stages(args, messages):
+    """完整运行一轮各阶段"""
+    stages = {}
+    with LocalIMAPServer(messages, latency=args.latency_ms / 1000) as server:
+        with quiet(not args.verbose):
+            emails, stages['fetch_emails'] = bench_fetch(server, args.fetch_mode, args.batch_size, args.backend,
+                                                         args.pipeline_depth, args.parse_workers)
+        stages['fetch_emails']['server_commands'] = server.commands
+    stages['get_email_body'] = bench_parse(messages)
+    sink = open_sink(args.db)
+    try:
+        with quiet(not args.verbose):
+            stages['save_emails_to_database'] = bench_save(sink, emails, args.batch_size)
+            # 同一批邮件再次入库：测量去重/内容未变化时的开销
+            stages['save_reimport'] = bench_save(sink, emails, args.batch_size)
+    finally:
+        sink.close()
+    return stages
+
+
+def run_benchmark(args):
+    """运行args.repeat轮，每个阶段取吞吐量居中的一轮，减少单次波动对比较的影响"""
+    started = time.perf_counter()
+    messages = generate_mailbox(args.messages, args.seed, args.attachment_kb)
+    corpus_bytes = sum(len(raw) for _, raw, _ in messages)
+    runs = [run_stages(args, messages) for _ in range(max(1, args.repeat))]
+    stages = {}
+    for name in runs[0]:
+        ranked = sorted((run[name] for run in runs), key=lambda stage: stage['items_per_sec'] or 0)
+        stages[name] = ranked[len(ranked) // 2]
+
+    return {
+        'version': RESULT_VERSION,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'params': {
+            'messages': args.messages,
+            'seed': args.seed,
+            'attachment_kb': args.attachment_kb,
+            'fetch_mode': args.fetch_mode,
+            'backend': args.backend,
+            'pipeline_depth': args.pipeline_depth,
+            'parse_workers': args.parse_workers,
+            'batch_size': args.batch_size,
+            'latency_ms': args.latency_ms,
+            'db': args.db.partition(':')[0],
+            'repeat': max(1, args.repeat),
+        },
+        'corpus': {
+            'messages': len(messages),
+            'bytes': corpus_bytes,
+            'kinds': {kind: weight for kind, weight in MESSAGE_KINDS},
+        },
+        'stages': stages,
+        'total_seconds': round(time.perf_counter() - started, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def print_result(result):
+    corpus = result['corpus']
+    print(f"共 {corpus['messages']} 封邮件, {corpus['bytes'] / 1024 / 1024:.1f} MB, "
+          f"参数 {json.dumps(result['params'], ensure_ascii=False)}")
+    print(f"{'阶段':<24} {'封/秒':>10} {'MB/秒':>8} {'p50(ms)':>10} {'p95(ms)':>10} {'p99(ms)':>10} {'RSS(MB)':>9}")
+    for name, stage in result['stages'].items():
+        latency = stage['latency_ms']
+        mb_per_sec = f"{stage['mb_per_sec']:.2f}" if stage['mb_per_sec'] is not None else '-'
+        print(f"{name:<24} {stage['items_per_sec'] or 0:>10.1f} {mb_per_sec:>8} "
+              f"{latency['p50']:>10.3f} {latency['p95']:>10.3f} {latency['p99']:>10.3f} "
+              f"{stage['peak_rss_mb'] if stage['peak_rss_mb'] is not None else '-':>9}")
+    print(f"总耗时 {result['total_seconds']:.1f} 秒，峰值内存 {result['peak_rss_mb']} MB")
+
+
+def compare_results(baseline, result, max_regression=None):
+    """与基线结果比较各阶段的吞吐量和p95延迟
+
+    Returns:
+        list: 吞吐量下降超过max_regression（百分比）的阶段名
+    """
+    if baseline.get('version') != result['version']:
+        print(f"基线结果的格式版本 ({baseline.get('version')}) 与当前版本 ({result['version']}) 不同，无法比较")
+        return []
+    if baseline.get('params') != result['params']:
+        print("注意: 基线结果的测试参数与本次不同")
+    regressions = []
+    print(f"{'阶段':<24} {'吞吐量变化':>12} {'p95变化':>10}")
+    for name, stage in result['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if not base or not base.get('items_per_sec') or not stage['items_per_sec']:
+            continue
+        throughput = (stage['items_per_sec'] / base['items_per_sec'] - 1) * 100
+        base_p95 = base['latency_ms']['p95']
+        p95 = (stage['latency_ms']['p95'] / base_p95 - 1) * 100 if base_p95 else 0.0
+        print(f"{name:<24} {throughput:>+11.1f}% {p95:>+9.1f}%")
+        if max_regression is not None and throughput < -max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='邮件入库全流程性能测试（不需要真实邮箱）')
+    parser.add_argument('--messages', type=int, default=1000, help='合成邮箱中的邮件数')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子，相同种子生成相同的邮件')
+    parser.add_argument('--attachment-kb', type=int, default=512, help='大附件邮件的附件大小 (KB)')
+    parser.add_argument('--fetch-mode', choices=['partial', 'rfc822'], default='partial')
+    parser.add_argument('--backend', choices=['imapclient', 'asyncio'], default='imapclient')
+    parser.add_argument('--pipeline-depth', type=int, default=4, help='asyncio后端同时在途的批次数')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='解析进程数，0表示在获取线程中直接解析（asyncio后端为0时按CPU核数）')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='模拟的网络往返时间 (毫秒)')
+    parser.add_argument('--db', default='sqlite',
+                        help='数据库后端: sqlite[:文件路径] 或 mysql[:数据库名]（默认 job_emails_bench）')
+    parser.add_argument('--repeat', type=int, default=1, help='重复轮数，每个阶段取吞吐量的中位数')
+    parser.add_argument('--output', help='把结果JSON写入文件')
+    parser.add_argument('--compare', help='与之前保存的结果JSON比较')
+    parser.add_argument('--max-regression', type=float,
+                        help='与--compare一起使用：任一阶段吞吐量下降超过该百分比时以非零状态退出')
+    parser.add_argument('--verbose', action='store_true', help='显示被测代码的日志')
+    return parser.parse_args(argv)
+
+
+def main():
+    """主函数"""
+    args = parse_args()
+    result = run_benchmark(args)
+    print_result(result)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, result, args.max_regression)
+        if regressions:
+            print(f"吞吐量下降超过 {args.max_regression}% 的阶段: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
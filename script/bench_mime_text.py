@@ -0,0 +1,136 @@
+import argparse
+import email
+import os
+import re
+import sys
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mime_text import extract_body
+
+# 与入库时相同的截断长度
+BODY_MAX_CHARS = 10000
+
+
+def legacy_get_email_body(msg):
+    """改造前 qq_email_imap.get_email_body 的实现，作为性能基线"""
+    def decode_content(payload, charset=None):
+        if not payload:
+            return ""
+        if charset:
+            try:
+                return payload.decode(charset, errors='ignore')
+            except Exception:
+                pass
+        for encoding in ['utf-8', 'gbk', 'gb2312', 'latin1']:
+            try:
+                return payload.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+        return payload.decode('utf-8', errors='ignore')
+
+    body = ""
+    if msg.is_multipart():
+        for part in msg.walk():
+            if "attachment" in str(part.get("Content-Disposition", "")):
+                continue
+            content_type = part.get_content_type()
+            if content_type in ["text/plain", "text/html"]:
+                try:
+                    decoded = decode_content(part.get_payload(decode=True), part.get_content_charset())
+                    if content_type == "text/html":
+                        decoded = re.sub(r'<[^>]+>', '', decoded).strip()
+                        decoded = re.sub(r'\s+', ' ', decoded)
+                    body = decoded
+                    if content_type == "text/plain":
+                        break
+                except Exception:
+                    continue
+    else:
+        body = decode_content(msg.get_payload(decode=True), msg.get_content_charset())
+    return body[:BODY_MAX_CHARS] + "..." if len(body) > BODY_MAX_CHARS else body
+
+
+def current_get_email_body(msg):
+    body = extract_body(msg, BODY_MAX_CHARS + 1)
+    return body[:BODY_MAX_CHARS] + "..." if len(body) > BODY_MAX_CHARS else body
+
+
+def generate_corpus(directory, count):
+    """生成包含多种字符集、HTML正文和附件的示例邮件"""
+    os.makedirs(directory, exist_ok=True)
+    paragraph = '感谢您投递我司岗位，我们诚挚地邀请您参加面试。Thank you for applying. '
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            msg = MIMEText(paragraph * 200, 'plain', 'utf-8')
+        elif kind == 1:
+            html = ('<html><head><style>p {color: red}</style><script>var x = 1;</script></head><body>'
+                    + ''.join(f'<p>{paragraph}&nbsp;&amp;</p>' for _ in range(500)) + '</body></html>')
+            msg = MIMEText(html, 'html', 'gbk')
+        elif kind == 2:
+            msg = MIMEMultipart('alternative')
+            msg.attach(MIMEText(paragraph * 50, 'plain', 'gb2312'))
+            msg.attach(MIMEText(f'<div>{paragraph * 50}</div>', 'html', 'utf-8'))
+        else:
+            msg = MIMEMultipart('mixed')
+            msg.attach(MIMEText(f'<p>{paragraph * 2000}</p>', 'html', 'utf-8'))
+            attachment = MIMEApplication(os.urandom(512 * 1024), 'pdf')
+            attachment.add_header('Content-Disposition', 'attachment', filename='resume.pdf')
+            msg.attach(attachment)
+        msg['From'] = f'hr{i % 7}@company{i % 5}.com'
+        msg['Subject'] = f'面试邀请 {i}'
+        with open(os.path.join(directory, f'sample_{i:04d}.eml'), 'wb') as f:
+            f.write(msg.as_bytes())
+
+
+def load_corpus(directory):
+    messages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.eml'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                messages.append(f.read())
+    return messages
+
+
+def run(name, func, messages, repeat):
+    parsed = [email.message_from_bytes(raw) for raw in messages]
+    total_bytes = sum(len(raw) for raw in messages) * repeat
+    timings = []
+    for _ in range(repeat):
+        for msg in parsed:
+            started = time.perf_counter()
+            func(msg)
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    elapsed = sum(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1] if timings else 0
+    print(f"{name:<8} {len(timings) / elapsed:>10.1f} 封/秒 {total_bytes / 1024 / 1024 / elapsed:>8.1f} MB/秒 "
+          f"平均 {elapsed / len(timings) * 1e6:>9.1f} µs  p95 {p95 * 1e6:>9.1f} µs")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='邮件正文提取性能测试')
+    parser.add_argument('corpus', help='存放 .eml 示例邮件的目录')
+    parser.add_argument('--generate', type=int, default=0, help='先在目录中生成指定数量的示例邮件')
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_corpus(args.corpus, args.generate)
+    messages = load_corpus(args.corpus)
+    if not messages:
+        print(f"目录 {args.corpus} 中没有 .eml 文件", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"共 {len(messages)} 封邮件, {sum(len(raw) for raw in messages) / 1024 / 1024:.1f} MB, 重复 {args.repeat} 次")
+    run('legacy', legacy_get_email_body, messages, args.repeat)
+    run('current', current_get_email_body, messages, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+# 邮件正文的去重压缩存储：相同的正文只存一份（按正文哈希），用从自己的邮件中训练的预设字典做zlib压缩
+import argparse
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from script import metrics
+
+BODY_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS email_bodies (
+    body_hash BINARY(16) NOT NULL PRIMARY KEY,
+    dict_id INT UNSIGNED NOT NULL DEFAULT 0,
+    codec TINYINT UNSIGNED NOT NULL,
+    raw_size INT UNSIGNED NOT NULL,
+    data MEDIUMBLOB NOT NULL,
+    used_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB
+"""
+
+# 旧版本建的正文表缺少的列（由 qq_email_imap.ensure_email_tables 补上）
+BODY_TABLE_COLUMNS = {
+    'used_at': 'TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP',
+}
+
+DICT_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS email_body_dicts (
+    id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+    data BLOB NOT NULL,
+    samples INT UNSIGNED NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB
+"""
+
+# data的编码：原文（UTF-8，压缩后反而更大的短正文）或zlib（dict_id非0时带预设字典）
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+COMPRESS_LEVEL = 9
+# zlib的窗口为32KB，更长的预设字典只有末尾32KB有效
+DICT_MAX_BYTES = 32 * 1024
+# 训练字典时取最近的多少封邮件的正文
+DICT_SAMPLES = 2000
+# 参与字典训练的片段的最短长度（字符）
+DICT_MIN_SEGMENT = 8
+# 常驻进程重新读取最新字典的间隔（秒），训练新字典后无需重启
+DICT_REFRESH_SECONDS = 600
+# 迁移和清理时每次处理的行数
+CHUNK_SIZE = 500
+# 清理时只删除这么久（秒）没有被写入引用的正文，给还没提交的入库事务留出时间
+GC_GRACE_SECONDS = 3600
+
+# 读取正文时附加到查询中的列和连接（all_emails的别名须为a）：
+# 未压缩的行正文在a.body，压缩存储的行a.body为NULL，正文在email_bodies中；用read_body还原
+BODY_SELECT = "a.body, b.dict_id, b.codec, b.data"
+BODY_JOIN = "LEFT JOIN email_bodies b ON b.body_hash = a.body_hash"
+
+# 按行和句末标点切分正文，模板邮件中重复的往往是整行或整句
+_SEGMENT_RE = re.compile(r'[\r\n]+|(?<=[。！？!?])')
+
+
+def ensure_body_tables(cursor):
+    """创建/检查正文表和字典表"""
+    cursor.execute(BODY_TABLE_SQL)
+    cursor.execute(DICT_TABLE_SQL)
+
+
+def body_hash(body):
+    """正文的去重键"""
+    return hashlib.md5(body.encode('utf-8', errors='surrogatepass')).digest()
+
+
+def train_dictionary(samples, size=DICT_MAX_BYTES):
+    """从样本正文中挑出在多封邮件中重复出现的片段，拼成zlib预设字典
+
+    zlib没有字典训练器：按"出现的邮件数 × 长度"给每个片段打分，取得分最高的片段直到填满size，
+    得分越高的片段放得越靠后（离被压缩的数据越近，引用的距离编码越短）。
+    """
+    frequency = Counter()
+    for body in samples:
+        frequency.update({segment.strip() for segment in _SEGMENT_RE.split(body or '')
+                          if len(segment.strip()) >= DICT_MIN_SEGMENT})
+    scored = sorted(((count - 1) * len(segment.encode('utf-8', errors='surrogatepass')), segment)
+                    for segment, count in frequency.items() if count > 1)
+    chosen = []
+    total = 0
+    for _, segment in reversed(scored):
+        data = segment.encode('utf-8', errors='surrogatepass') + b'\n'
+        if total + len(data) > size:
+            continue
+        chosen.append(data)
+        total += len(data)
+    return b''.join(reversed(chosen))
+
+
+def compress(raw, dictionary=b''):
+    """压缩正文字节，返回 (codec, data)；压缩后不比原文小时保存原文"""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(COMPRESS_LEVEL)
+    data = compressor.compress(raw) + compressor.flush()
+    if len(data) >= len(raw):
+        return CODEC_RAW, raw
+    return CODEC_ZLIB, data
+
+
+def decompress(codec, data, dictionary=b''):
+    """还原正文字节"""
+    if codec == CODEC_RAW:
+        return bytes(data)
+    decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class BodyStore:
+    """email_bodies的读写，缓存预设字典；可以被多个线程共用（每次调用传入各自的游标）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dicts = {0: b''}
+        self._current = None
+        self._loaded_at = 0.0
+
+    def current_dictionary(self, cursor):
+        """写入时使用的字典 (dict_id, 字典)，没有训练过字典时为 (0, b'')"""
+        with self._lock:
+            if self._current is None or time.monotonic() - self._loaded_at > DICT_REFRESH_SECONDS:
+                cursor.execute("SELECT id, data FROM email_body_dicts ORDER BY id DESC LIMIT 1")
+                row = cursor.fetchone()
+                self._current = (row[0], bytes(row[1])) if row else (0, b'')
+                self._dicts[self._current[0]] = self._current[1]
+                self._loaded_at = time.monotonic()
+            return self._current
+
+    def dictionary(self, cursor, dict_id):
+        """按id取字典，旧字典压缩的正文仍然用旧字典解压"""
+        with self._lock:
+            dictionary = self._dicts.get(dict_id)
+        if dictionary is None:
+            cursor.execute("SELECT data FROM email_body_dicts WHERE id = %s", (dict_id,))
+            row = cursor.fetchone()
+            if row is None:
+                raise LookupError(f"正文字典 {dict_id} 不存在")
+            dictionary = bytes(row[0])
+            with self._lock:
+                self._dicts[dict_id] = dictionary
+        return dictionary
+
+    def add_dictionary(self, cursor, dictionary, samples):
+        """保存新训练的字典，之后写入的正文使用它；返回字典id"""
+        cursor.execute("INSERT INTO email_body_dicts (data, samples) VALUES (%s, %s)", (dictionary, samples))
+        dict_id = cursor.lastrowid
+        with self._lock:
+            self._dicts[dict_id] = dictionary
+            self._current = (dict_id, dictionary)
+            self._loaded_at = time.monotonic()
+        return dict_id
+
+    def put_many(self, cursor, bodies):
+        """写入一批正文（已存在的不重复压缩和写入），返回与bodies对应的body_hash列表，正文为None时为None
+
+        在写入引用这些正文的邮件的同一个事务中调用：已存在的正文刷新used_at并被本事务锁住，
+        collect_garbage在本事务提交（引用可见）之前不会删除它们。
+        """
+        hashes = [None if body is None else body_hash(body) for body in bodies]
+        unique = {h: body for h, body in zip(hashes, bodies) if h is not None}
+        if not unique:
+            return hashes
+        cursor.execute(
+            f"SELECT body_hash FROM email_bodies WHERE body_hash IN ({','.join(['%s'] * len(unique))})",
+            list(unique)
+        )
+        existing = [bytes(row[0]) for row in cursor.fetchall()]
+        if existing:
+            placeholders = ','.join(['%s'] * len(existing))
+            cursor.execute(f"UPDATE email_bodies SET used_at = CURRENT_TIMESTAMP WHERE body_hash IN ({placeholders})",
+                           existing)
+            if cursor.rowcount < len(existing):
+                # 查询之后被清理了（或used_at本来就是当前时间）：加锁重新确认，缺少的正文重新写入
+                cursor.execute(f"SELECT body_hash FROM email_bodies WHERE body_hash IN ({placeholders}) FOR UPDATE",
+                               existing)
+                existing = [bytes(row[0]) for row in cursor.fetchall()]
+        existing = set(existing)
+        dict_id, dictionary = self.current_dictionary(cursor)
+        rows = []
+        raw_bytes = stored_bytes = 0
+        for h, body in unique.items():
+            if h in existing:
+                continue
+            raw = body.encode('utf-8', errors='surrogatepass')
+            codec, data = compress(raw, dictionary)
+            rows.append((h, dict_id if codec == CODEC_ZLIB else 0, codec, len(raw), data))
+            raw_bytes += len(raw)
+            stored_bytes += len(data)
+        if rows:
+            # 并发写入同一正文时以先写入的为准，只刷新used_at
+            cursor.executemany(
+                "INSERT INTO email_bodies (body_hash, dict_id, codec, raw_size, data) VALUES (%s, %s, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE used_at = CURRENT_TIMESTAMP",
+                rows
+            )
+        metrics.count('body_store_dedup_total', len(bodies) - len(rows))
+        metrics.count('body_store_raw_bytes_total', raw_bytes)
+        metrics.count('body_store_stored_bytes_total', stored_bytes)
+        return hashes
+
+    def read(self, cursor, body, dict_id, codec, data):
+        """还原按BODY_SELECT查出的正文；两处都没有正文时返回None"""
+        if body is not None or data is None:
+            return body
+        dictionary = self.dictionary(cursor, dict_id) if dict_id else b''
+        return decompress(codec, data, dictionary).decode('utf-8', errors='surrogatepass')
+
+
+_store = BodyStore()
+
+
+def get_store():
+    """进程内共用的BodyStore"""
+    return _store
+
+
+def read_body(cursor, body, dict_id, codec, data):
+    """还原按BODY_SELECT查出的正文"""
+    return _store.read(cursor, body, dict_id, codec, data)
+
+
+def sample_bodies(cursor, limit=DICT_SAMPLES):
+    """最近入库的邮件正文，用于训练字典"""
+    cursor.execute(f"SELECT {BODY_SELECT} FROM all_emails a {BODY_JOIN} ORDER BY a.id DESC LIMIT %s", (limit,))
+    return [body for body in (read_body(cursor, *row) for row in cursor.fetchall()) if body]
+
+
+def train(connection, samples=DICT_SAMPLES):
+    """用最近的邮件训练一个新字典并保存，返回 (字典id, 字典大小)；样本中没有重复片段时返回 (None, 0)"""
+    with connection.cursor() as cursor:
+        bodies = sample_bodies(cursor, samples)
+        dictionary = train_dictionary(bodies)
+        if not dictionary:
+            return None, 0
+        return _store.add_dictionary(cursor, dictionary, len(bodies)), len(dictionary)
+
+
+def externalize(connection, chunk_size=CHUNK_SIZE, pause=0.0):
+    """把all_emails中未压缩的正文移到email_bodies，按id分段、每段一个事务，返回迁移的行数"""
+    moved = 0
+    last_id = 0
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(
+                "SELECT id, body FROM all_emails WHERE id > %s AND body IS NOT NULL ORDER BY id LIMIT %s",
+                (last_id, chunk_size)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            connection.begin()
+            try:
+                hashes = _store.put_many(cursor, [row[1] for row in rows])
+                cursor.executemany("UPDATE all_emails SET body = NULL, body_hash = %s WHERE id = %s",
+                                   [(h, row[0]) for h, row in zip(hashes, rows)])
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            moved += len(rows)
+            print(f"已迁移到 id={last_id}，共 {moved} 封邮件")
+            if pause:
+                time.sleep(pause)
+    return moved
+
+
+def inline(connection, chunk_size=CHUNK_SIZE):
+    """把压缩存储的正文写回all_emails.body（关闭压缩存储前使用），返回写回的行数"""
+    restored = 0
+    last_id = 0
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(
+                f"SELECT a.id, {BODY_SELECT} FROM all_emails a {BODY_JOIN} "
+                "WHERE a.id > %s AND a.body_hash IS NOT NULL ORDER BY a.id LIMIT %s",
+                (last_id, chunk_size)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = [(read_body(cursor, *row[1:]), row[0]) for row in rows]
+            cursor.executemany("UPDATE all_emails SET body = %s, body_hash = NULL WHERE id = %s", updates)
+            restored += len(updates)
+            print(f"已写回到 id={last_id}，共 {restored} 封邮件")
+    return restored
+
+
+def collect_garbage(connection, grace_seconds=GC_GRACE_SECONDS):
+    """删除没有邮件引用的正文（邮件被删除、内容变化或写回后遗留），返回删除的行数
+
+    只删除grace_seconds内没有被写入引用过的正文：入库时先写正文再写邮件，
+    正文已写入、引用它的邮件还没提交的这段时间内不会被删除。
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE b FROM email_bodies b LEFT JOIN all_emails a ON a.body_hash = b.body_hash "
+            "WHERE a.id IS NULL AND b.used_at < NOW() - INTERVAL %s SECOND",
+            (grace_seconds,)
+        )
+        return cursor.rowcount
+
+
+def storage_stats(connection):
+    """正文存储的大小统计"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0), COUNT(body_hash) FROM all_emails")
+        emails, inline_bytes, compressed_refs = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM email_bodies")
+        bodies, raw_bytes, stored_bytes = cursor.fetchone()
+        cursor.execute(
+            "SELECT COALESCE(SUM(b.raw_size), 0) FROM all_emails a JOIN email_bodies b ON b.body_hash = a.body_hash"
+        )
+        referenced_bytes = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM email_body_dicts")
+        dicts = cursor.fetchone()[0]
+    return {
+        'emails': emails, 'inline_bytes': int(inline_bytes), 'compressed_refs': compressed_refs,
+        'bodies': bodies, 'raw_bytes': int(raw_bytes), 'stored_bytes': int(stored_bytes),
+        'referenced_bytes': int(referenced_bytes), 'dicts': dicts,
+    }
+
+
+def main():
+    """主函数"""
+    import script.config as config
+    from script.qq_email_imap import connect_email_db, ensure_email_tables
+
+    parser = argparse.ArgumentParser(description='管理邮件正文的去重压缩存储')
+    parser.add_argument('command', choices=['train', 'compress', 'inline', 'gc', 'stats'],
+                        help='train 用最近的邮件训练压缩字典；compress 把未压缩的正文移到压缩存储（没有字典时先训练）；'
+                             'inline 把正文写回all_emails；gc 删除没有引用的正文；stats 查看存储大小')
+    parser.add_argument('--samples', type=int, default=DICT_SAMPLES, help='训练字典使用的邮件数')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='每次迁移的行数')
+    parser.add_argument('--pause', type=float, default=0.05, help='两次迁移之间的停顿（秒）')
+    parser.add_argument('--grace', type=int, default=GC_GRACE_SECONDS,
+                        help='清理时只删除这么久（秒）没有被引用过的正文')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args(config.config.get('metrics'), args)
+
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+    with connect_email_db(db_config) as connection:
+        with connection.cursor() as cursor:
+            ensure_email_tables(cursor)
+            untrained = _store.current_dictionary(cursor)[0] == 0
+        if args.command == 'train' or (args.command == 'compress' and untrained):
+            dict_id, size = train(connection, args.samples)
+            if dict_id is None:
+                print("样本中没有重复出现的片段，不使用预设字典")
+            else:
+                print(f"已训练字典 {dict_id}，大小 {size} 字节；之后写入的正文使用该字典")
+        if args.command == 'compress':
+            print(f"迁移完成，共 {externalize(connection, args.chunk_size, args.pause)} 封邮件")
+            print(f"删除没有引用的正文 {collect_garbage(connection, args.grace)} 条")
+        elif args.command == 'inline':
+            print(f"写回完成，共 {inline(connection, args.chunk_size)} 封邮件")
+            print(f"删除没有引用的正文 {collect_garbage(connection, args.grace)} 条")
+        elif args.command == 'gc':
+            print(f"删除没有引用的正文 {collect_garbage(connection, args.grace)} 条")
+        elif args.command == 'stats':
+            stats = storage_stats(connection)
+            ratio = stats['referenced_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] else 0
+            print(f"邮件 {stats['emails']} 封，其中压缩存储 {stats['compressed_refs']} 封，"
+                  f"未压缩正文 {stats['inline_bytes']} 字节")
+            print(f"正文表 {stats['bodies']} 条（去重后原文 {stats['raw_bytes']} 字节，"
+                  f"压缩后 {stats['stored_bytes']} 字节），字典 {stats['dicts']} 个")
+            print(f"压缩存储的邮件正文共 {stats['referenced_bytes']} 字节，去重加压缩后缩小为 1/{ratio:.1f}")
+    metrics.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,9 +13,36 @@ config = {
         'address': '',
         'password': '',
         'imap_server': 'imap.qq.com'
+    },
+    # 原始邮件本地缓存（见 raw_cache.py），默认关闭
+    'cache': {
+        'enabled': False,
+        'dir': '',
+        'max_mb': 512
+    },
+    # 多账号/多文件夹同步（见 sync_scheduler.py），为空时只同步email中的账号的收件箱
+    # 每项: {"address", "password", "imap_server", "folders": ["INBOX", ...], "max_connections": 2}
+    'accounts': [],
+    # 入库时按规则自动识别招聘邮件，生成待确认的投递和面试记录（见 email_classifier.py）
+    'classify': {
+        'enabled': True
+    },
+    # 正文去重压缩存储（见 body_store.py）：开启后新邮件的正文按哈希存入email_bodies，旧邮件用 body_store.py compress 迁移
+    'storage': {
+        'compress_bodies': False
+    },
+    # 日志级别和分阶段指标（见 metrics.py）；path非空时把指标写入该文件，format为ndjson或prometheus
+    'metrics': {
+        'enabled': False,
+        'format': 'ndjson',
+        'path': '',
+        'log_level': 'INFO'
     }
 }
 
+# 每个账号默认的最大并发连接数，QQ邮箱对同一账号的并发登录数有限制
+DEFAULT_MAX_CONNECTIONS = 2
+
 def load_config():
     """从config.json文件加载配置"""
     try:
@@ -30,9 +57,33 @@ def load_config():
         # 更新配置
         config['db'].update(loaded_config.get('db', {}))
         config['email'].update(loaded_config.get('email', {}))
+        config['cache'].update(loaded_config.get('cache', {}))
+        config['accounts'] = loaded_config.get('accounts') or []
+        config['classify'].update(loaded_config.get('classify', {}))
+        config['storage'].update(loaded_config.get('storage', {}))
+        config['metrics'].update(loaded_config.get('metrics', {}))
     except Exception as err:
         # print(f'配置文件加载失败: {err}')
         pass
 
+def get_accounts():
+    """返回需要同步的账号列表，缺省字段已补齐
+    
+    未配置accounts时使用email中的账号，文件夹取email.folders（默认只有INBOX）。
+    """
+    accounts = config['accounts'] or ([config['email']] if config['email'].get('address') else [])
+    result = []
+    for account in accounts:
+        if not account.get('address') or not account.get('password'):
+            continue
+        result.append({
+            'address': account['address'],
+            'password': account['password'],
+            'imap_server': account.get('imap_server') or 'imap.qq.com',
+            'folders': list(account.get('folders') or ['INBOX']),
+            'max_connections': max(1, int(account.get('max_connections') or DEFAULT_MAX_CONNECTIONS))
+        })
+    return result
+
 # 在模块导入时自动加载配置
 load_config()
\ No newline at end of file
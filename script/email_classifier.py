@@ -0,0 +1,400 @@
+# 招聘邮件自动分类：按预编译的关键词/正则规则识别投递、笔试、面试、offer和拒信，批量生成投递和面试记录
+import argparse
+import datetime
+import email.utils
+import os
+import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from script import metrics
+from script.analytics_rollup import ensure_rollup_tables
+from script.body_store import BODY_JOIN, BODY_SELECT, read_body
+
+# 投递汇总页面的状态（public/deliveries.html），按优先级从高到低排列：
+# 同一封邮件命中多条规则时取优先级最高的，如拒信里常见的"感谢投递"不会被识别为投递完成
+STATUS_RULES = [
+    ('offer', 'offer发放', [
+        r'\boffer\s*(?:letter|发放|通知)', r'录用(?:通知|意向)', r'拟录用', r'意向书', r'恭喜您.{0,10}(?:通过|录用|获得)',
+    ]),
+    ('rejected', '流程已结束', [
+        r'很遗憾', r'遗憾地通知', r'未能(?:进入|通过)', r'暂时无法(?:进入|安排|匹配)', r'不太?匹配', r'进入(?:我们的)?人才库',
+        r'\bunfortunately\b', r'\bregret to inform\b', r'\bnot (?:be )?moving forward\b',
+    ]),
+    ('interview', '面试流程中', [
+        r'面试(?:邀请|通知|安排|确认)', r'邀请您参加.{0,12}面试', r'\binterview invitation\b', r'\binvite you to (?:an? )?interview\b',
+    ]),
+    ('written_test', '笔试', [
+        r'笔试(?:邀请|通知|安排)', r'在线笔试', r'\bonline assessment\b', r'\bcoding (?:test|challenge)\b',
+    ]),
+    ('assessment', '测评', [
+        r'测评(?:邀请|通知)', r'(?:性格|职业|在线)测[评试]', r'\bassessment invitation\b',
+    ]),
+    ('screening', '简历筛选中', [
+        r'简历(?:正在)?(?:筛选|评估|审核)中', r'正在(?:筛选|评估|审核)您的简历',
+    ]),
+    ('applied', '投递完成', [
+        r'感谢(?:您的)?投递', r'投递成功', r'已收到(?:您的)?(?:简历|申请)', r'申请已提交',
+        r'\bthank you for (?:your )?(?:applying|application)\b', r'\bapplication (?:has been )?received\b',
+    ]),
+]
+RULE_PRIORITY = {rule: index for index, (rule, _, _) in enumerate(STATUS_RULES)}
+RULE_STATUS = {rule: status for rule, status, _ in STATUS_RULES}
+# 所有规则合并成一个带命名分组的正则，每封邮件只扫描一遍
+STATUS_RE = re.compile(
+    '|'.join(f"(?P<{rule}>{'|'.join(patterns)})" for rule, _, patterns in STATUS_RULES),
+    re.IGNORECASE
+)
+
+# 面试轮次（interviews.preparation）
+STAGE_RULES = [
+    ('HR面', re.compile(r'HR\s*面|人力面')),
+    ('终面', re.compile(r'终面|三面|总监面')),
+    ('二面', re.compile(r'二面|复试|第二轮')),
+    ('一面', re.compile(r'一面|初试|初面|第一轮')),
+]
+DEFAULT_STAGE = '一面'
+INTERVIEW_PENDING = '等待面试开始'
+
+# 面试时间：2025年3月5日 下午2:30 / 2025-03-05 14:30 / 3月5日 14点
+INTERVIEW_TIME_RE = re.compile(
+    r'(?:(?P<year>20\d{2})\s*[年/.-]\s*)?(?P<month>1[0-2]|0?[1-9])\s*[月/.-]\s*(?P<day>3[01]|[12]\d|0?[1-9])\s*[日号]?'
+    r'(?:\s*[（(]?(?:周|星期)[一二三四五六日天][）)]?)?'
+    r'\s*(?P<ampm>上午|下午|晚上|中午)?\s*(?P<hour>[01]?\d|2[0-3])\s*[:：点时]\s*(?P<minute>[0-5]\d|半)?'
+)
+
+# 公司名称：主题中的【】、以公司后缀结尾的词、发件人名称
+BRACKET_RE = re.compile(r'[【\[]([^】\]]{2,30})[】\]]')
+COMPANY_RE = re.compile(
+    r'([\u4e00-\u9fffA-Za-z0-9·&（）()]{2,30}?(?:股份有限公司|有限责任公司|有限公司|集团|公司|银行|研究院))'
+)
+COMPANY_PREFIX_RE = re.compile(r'^(?:感谢您?|欢迎|您好|你好|尊敬的|关注|投递|应聘|申请|加入|参加|对|的)+')
+SENDER_SUFFIX_RE = re.compile(
+    r'(?:校园招聘|社会招聘|校招|社招|招聘团队|招聘中心|招聘|人力资源部?|人事部?|HR|hr|Recruiting|Recruitment|Careers|Talent(?: Acquisition)?|Team)\s*$'
+)
+# 主题【】中的这些词不是公司名
+NOT_COMPANY_RE = re.compile(r'通知|邀请|提醒|确认|面试|笔试|测评|投递|简历|offer|招聘$', re.IGNORECASE)
+# 常见招聘邮件的发件域名
+KNOWN_COMPANY_DOMAINS = {
+    'tencent.com': '腾讯', 'alibaba-inc.com': '阿里巴巴', 'alibaba.com': '阿里巴巴', 'antgroup.com': '蚂蚁集团',
+    'bytedance.com': '字节跳动', 'meituan.com': '美团', 'jd.com': '京东', 'baidu.com': '百度',
+    'huawei.com': '华为', 'xiaomi.com': '小米', 'netease.com': '网易', 'kuaishou.com': '快手',
+    'pinduoduo.com': '拼多多', 'didiglobal.com': '滴滴', 'microsoft.com': 'Microsoft', 'google.com': 'Google',
+}
+
+POSITION_RES = [
+    re.compile(r'(?:投递|应聘|申请)(?:的|了)?\s*[「“"【]?([^「」“”"【】，。,\n]{2,30}?)[」”"】]?\s*(?:岗位|职位)'),
+    re.compile(r'(?:岗位|职位)(?:名称)?\s*[:：]\s*([^\s，。,；;]{2,30})'),
+    re.compile(r'\b(?:position|role) of ([A-Za-z0-9 /+#.-]{2,50}?)(?:[,.;]|\s+at\b|$)', re.IGNORECASE),
+    re.compile(r'\bfor the ([A-Za-z0-9 /+#.-]{2,50}?) (?:position|role)\b', re.IGNORECASE),
+]
+
+# 规则只看主题和正文的前一部分，招聘模板的关键句都在开头
+SCAN_CHARS = 3000
+# 每次分类的邮件数
+CLASSIFY_CHUNK_SIZE = 500
+
+CLASSIFICATIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS email_classifications (
+    email_id INT PRIMARY KEY,
+    rule VARCHAR(32) DEFAULT NULL,
+    status VARCHAR(100) DEFAULT NULL,
+    company VARCHAR(255) DEFAULT NULL,
+    position VARCHAR(255) DEFAULT NULL,
+    interview_time DATETIME DEFAULT NULL,
+    classified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_status (status)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# 与 src/server.js 中的建表语句保持一致
+DELIVERIES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {database}.deliveries (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    company_name VARCHAR(255) NOT NULL,
+    position VARCHAR(255),
+    delivery_date DATETIME NOT NULL,
+    status VARCHAR(100) NOT NULL,
+    notes TEXT,
+    email_id INT DEFAULT NULL,
+    candidate BOOLEAN NOT NULL DEFAULT FALSE,
+    UNIQUE KEY unique_delivery (company_name, delivery_date, status)
+)
+"""
+
+INTERVIEWS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {database}.interviews (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    company VARCHAR(255) NOT NULL,
+    position VARCHAR(255) NOT NULL,
+    datetime DATETIME,
+    preparation VARCHAR(50) DEFAULT '',
+    completion VARCHAR(50) DEFAULT '',
+    notes TEXT,
+    email_id INT DEFAULT NULL,
+    candidate BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uniq_email_id (email_id)
+)
+"""
+
+DELIVERY_DATABASE = 'job_deliveries'
+INTERVIEW_DATABASE = 'interview_schedule'
+
+
+def _clean_company(name):
+    name = COMPANY_PREFIX_RE.sub('', (name or '').strip())
+    name = SENDER_SUFFIX_RE.sub('', name).strip(' -_|·')
+    return name if len(name) >= 2 else None
+
+
+def extract_company(subject, sender, text):
+    """依次从主题的【】、公司全称、发件人名称、发件域名中识别公司名"""
+    for match in BRACKET_RE.finditer(subject or ''):
+        candidate = match.group(1).strip()
+        if not NOT_COMPANY_RE.search(candidate):
+            company = _clean_company(candidate)
+            if company:
+                return company
+    match = COMPANY_RE.search(subject or '') or COMPANY_RE.search(text)
+    if match:
+        company = _clean_company(match.group(1))
+        if company:
+            return company
+    name, address = email.utils.parseaddr(sender or '')
+    if name and '@' not in name:
+        company = _clean_company(name)
+        if company and not NOT_COMPANY_RE.search(company):
+            return company
+    domain = address.rpartition('@')[2].lower()
+    for known, company in KNOWN_COMPANY_DOMAINS.items():
+        if domain == known or domain.endswith('.' + known):
+            return company
+    return None
+
+
+def extract_position(text):
+    for pattern in POSITION_RES:
+        match = pattern.search(text)
+        if match:
+            return match.group(1).strip()[:255]
+    return None
+
+
+def extract_interview_time(text, send_ts=None):
+    """从正文中识别面试时间，没有年份时按邮件发送时间推断"""
+    for match in INTERVIEW_TIME_RE.finditer(text):
+        hour = int(match.group('hour'))
+        minute = 30 if match.group('minute') == '半' else int(match.group('minute') or 0)
+        if match.group('ampm') in ('下午', '晚上') and hour < 12:
+            hour += 12
+        month, day = int(match.group('month')), int(match.group('day'))
+        if match.group('year'):
+            year = int(match.group('year'))
+        elif send_ts:
+            # 12月发出的邮件约1月面试时跨年
+            year = send_ts.year + (1 if month < send_ts.month - 6 else 0)
+        else:
+            continue
+        try:
+            return datetime.datetime(year, month, day, hour, minute)
+        except ValueError:
+            continue
+    return None
+
+
+def classify(subject, sender, body, send_ts=None):
+    """对一封邮件应用规则
+
+    Returns:
+        dict | None: {'rule', 'status', 'company', 'position', 'interview_time', 'stage'}，不是招聘邮件时返回None
+    """
+    text = f"{subject or ''}\n{(body or '')[:SCAN_CHARS]}"
+    rules = {match.lastgroup for match in STATUS_RE.finditer(text)}
+    if not rules:
+        return None
+    rule = min(rules, key=RULE_PRIORITY.get)
+    result = {
+        'rule': rule,
+        'status': RULE_STATUS[rule],
+        'company': extract_company(subject, sender, text),
+        'position': extract_position(text),
+        'interview_time': None,
+        'stage': None,
+    }
+    if rule == 'interview':
+        result['interview_time'] = extract_interview_time(text, send_ts)
+        result['stage'] = next((stage for stage, pattern in STAGE_RULES if pattern.search(text)), DEFAULT_STAGE)
+    return result
+
+
+def classify_batch(rows):
+    """对一批邮件分类，rows为 [(id, subject, sender, body, send_ts)]，返回 [(id, send_ts, 结果或None)]"""
+    return [(email_id, send_ts, classify(subject, sender, body, send_ts))
+            for email_id, subject, sender, body, send_ts in rows]
+
+
+def ensure_classification_tables(cursor, delivery_database=DELIVERY_DATABASE, interview_database=INTERVIEW_DATABASE):
+    """创建/检查分类结果表以及投递、面试表（DDL会隐式提交，需在事务之外调用）"""
+    cursor.execute(CLASSIFICATIONS_TABLE_SQL)
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS {delivery_database}")
+    cursor.execute(DELIVERIES_TABLE_SQL.format(database=delivery_database))
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS {interview_database}")
+    cursor.execute(INTERVIEWS_TABLE_SQL.format(database=interview_database))
+    ensure_rollup_tables(cursor)
+    # 旧版本的面试表没有email_id列，用于避免重复生成面试记录
+    if not _has_column(cursor, interview_database, 'interviews', 'email_id'):
+        metrics.debug("为表 %s.interviews 添加列 email_id", interview_database)
+        cursor.execute(f"ALTER TABLE {interview_database}.interviews "
+                       "ADD COLUMN email_id INT DEFAULT NULL, ADD UNIQUE KEY uniq_email_id (email_id)")
+    # 自动识别的记录标记为待确认，用户在页面上确认后才计入统计
+    for database, table in ((delivery_database, 'deliveries'), (interview_database, 'interviews')):
+        if not _has_column(cursor, database, table, 'candidate'):
+            metrics.debug("为表 %s.%s 添加列 candidate", database, table)
+            cursor.execute(f"ALTER TABLE {database}.{table} ADD COLUMN candidate BOOLEAN NOT NULL DEFAULT FALSE")
+
+
+def _has_column(cursor, database, table, column):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (database, table, column)
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def _unclassified_rows(cursor, where, params, suffix=''):
+    cursor.execute(
+        f"SELECT a.id, a.subject, a.sender, a.send_ts, {BODY_SELECT} FROM all_emails a "
+        "LEFT JOIN email_classifications c ON c.email_id = a.id "
+        f"{BODY_JOIN} "
+        f"WHERE {where} AND c.email_id IS NULL {suffix}",
+        params
+    )
+    return [(email_id, subject, sender, read_body(cursor, *body), send_ts)
+            for email_id, subject, sender, send_ts, *body in cursor.fetchall()]
+
+
+def store_classifications(cursor, results, delivery_database=DELIVERY_DATABASE,
+                          interview_database=INTERVIEW_DATABASE):
+    """批量写入分类结果，识别出公司的邮件生成待确认的投递记录（面试邀请同时生成待确认的面试记录）
+
+    待确认的记录不计入预聚合统计，也不把邮件标记为已投递，由用户在投递/面试页面确认或删除。
+
+    Returns:
+        dict: {'classified', 'deliveries', 'interviews'}
+    """
+    counts = {'classified': len(results), 'deliveries': 0, 'interviews': 0}
+    if not results:
+        return counts
+    cursor.executemany(
+        "INSERT IGNORE INTO email_classifications (email_id, rule, status, company, position, interview_time) "
+        "VALUES (%s, %s, %s, %s, %s, %s)",
+        [(email_id, r and r['rule'], r and r['status'], r and r['company'], r and r['position'],
+          r and r['interview_time']) for email_id, _, r in results]
+    )
+
+    deliveries = [
+        (r['company'][:255], r['position'] or '', send_ts, r['status'], f"自动识别（{r['rule']}）", email_id)
+        for email_id, send_ts, r in results if r and r['company'] and send_ts
+    ]
+    if deliveries:
+        cursor.executemany(
+            f"INSERT IGNORE INTO {delivery_database}.deliveries "
+            "(company_name, position, delivery_date, status, notes, email_id, candidate) "
+            "VALUES (%s, %s, %s, %s, %s, %s, TRUE)",
+            deliveries
+        )
+        counts['deliveries'] = cursor.rowcount
+
+    interviews = [
+        (r['company'][:255], r['position'] or '', r['interview_time'], r['stage'], INTERVIEW_PENDING,
+         f"自动识别自邮件 #{email_id}", email_id)
+        for email_id, _, r in results if r and r['rule'] == 'interview' and r['company']
+    ]
+    if interviews:
+        cursor.executemany(
+            f"INSERT IGNORE INTO {interview_database}.interviews "
+            "(company, position, datetime, preparation, completion, notes, email_id, candidate) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, TRUE)",
+            interviews
+        )
+        counts['interviews'] = cursor.rowcount
+    return counts
+
+
+def classify_emails(cursor, message_id_hashes=None, ids=None, delivery_database=DELIVERY_DATABASE,
+                    interview_database=INTERVIEW_DATABASE):
+    """对指定邮件中尚未分类的邮件分类并批量写入结果（每封邮件只分类一次）
+
+    在写入all_emails的同一个事务中调用。用户删除的自动记录不会因重新导入而再次生成。
+
+    Returns:
+        dict: {'classified', 'deliveries', 'interviews'}
+    """
+    totals = {'classified': 0, 'deliveries': 0, 'interviews': 0}
+    for column, values in (('a.message_id_hash', message_id_hashes), ('a.id', ids)):
+        values = list(dict.fromkeys(values or ()))
+        for i in range(0, len(values), CLASSIFY_CHUNK_SIZE):
+            chunk = values[i:i+CLASSIFY_CHUNK_SIZE]
+            rows = _unclassified_rows(cursor, f"{column} IN ({','.join(['%s'] * len(chunk))})", chunk)
+            counts = store_classifications(cursor, classify_batch(rows), delivery_database, interview_database)
+            for key in totals:
+                totals[key] += counts[key]
+    return totals
+
+
+def main():
+    """主函数：对已入库的邮件批量分类"""
+    import script.config as config
+    from script.qq_email_imap import connect_email_db
+
+    parser = argparse.ArgumentParser(description='按规则批量识别招聘邮件，生成投递和面试记录')
+    parser.add_argument('--since', help='只处理该日期 (YYYY-MM-DD) 之后发送的邮件')
+    parser.add_argument('--dry-run', action='store_true', help='只输出识别结果，不写入数据库')
+    parser.add_argument('--reclassify', action='store_true', help='清空已有的分类结果后重新分类（已生成的记录不会删除）')
+    args = parser.parse_args()
+
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+    totals = {'classified': 0, 'deliveries': 0, 'interviews': 0}
+    with connect_email_db(db_config) as connection:
+        with connection.cursor() as cursor:
+            ensure_classification_tables(cursor)
+            if args.reclassify and not args.dry_run:
+                cursor.execute("TRUNCATE TABLE email_classifications")
+            last_id = 0
+            while True:
+                where, params = "a.id > %s", [last_id]
+                if args.since:
+                    where += " AND a.send_ts >= %s"
+                    params.append(args.since)
+                rows = _unclassified_rows(cursor, where, params, f"ORDER BY a.id LIMIT {CLASSIFY_CHUNK_SIZE}")
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                results = classify_batch(rows)
+                if args.dry_run:
+                    for email_id, send_ts, r in results:
+                        if r:
+                            print(f"{email_id}\t{send_ts}\t{r['status']}\t{r['company'] or '-'}\t{r['position'] or '-'}"
+                                  f"\t{r['interview_time'] or ''}")
+                    continue
+                connection.begin()
+                counts = store_classifications(cursor, results)
+                connection.commit()
+                for key in totals:
+                    totals[key] += counts[key]
+                print(f"已处理到 id={last_id}，分类 {totals['classified']} 封")
+    if not args.dry_run:
+        print(f"分类 {totals['classified']} 封邮件，新增投递记录 {totals['deliveries']} 条，"
+              f"面试记录 {totals['interviews']} 条")
+
+
+if __name__ == "__main__":
+    main()
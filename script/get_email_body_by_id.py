@@ -2,19 +2,26 @@ import email
 from email.header import decode_header
 import sys
 import os
+import argparse
+import json
 import logging
-from imapclient import IMAPClient
 
 # 导入配置模块
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-import config
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script.config as config
+from script.mime_text import extract_body
+from script.raw_cache import open_cache
+from script.imap_budget import BudgetedIMAPClient
 
 # 配置日志
 # logging.basicConfig(level=logging.INFO)
 # logger = logging.getLogger(__name__)
 
+# 批量获取时每条UID FETCH命令包含的邮件数
+FETCH_CHUNK_SIZE = 50
+
 def connect_to_qq_mail(email_addr, password, imap_server):
-    """连接到邮箱并登录
+    """连接到邮箱并登录，占用该账号的一个连接名额（见 imap_budget.py），logout时归还
     
     Args:
         email_addr (str): 邮箱地址
@@ -26,173 +33,173 @@ def connect_to_qq_mail(email_addr, password, imap_server):
     """
     # 创建一个安全的SSL连接
     import ssl
-    mail = IMAPClient(imap_server, ssl=True, ssl_context=ssl.create_default_context())
+    mail = BudgetedIMAPClient(imap_server, ssl=True, ssl_context=ssl.create_default_context())
     
     # 使用邮箱地址和授权码登录
     mail.login(email_addr, password)
     
     return mail
 
-def decode_payload(payload, charset=None):
-    """解码邮件内容
+def get_email_body(msg):
+    """获取邮件正文内容
     
     Args:
-        payload (bytes): 邮件内容
-        charset (str, optional): 字符集
+        msg (email.message.Message): 邮件消息对象
         
     Returns:
-        str: 解码后的邮件内容
+        str: 邮件正文内容（HTML正文保持原样，由前端渲染）
     """
-    # 如果没有指定字符集，尝试多种常见编码
-    if charset is None:
-        # 尝试多种常见编码，优先使用UTF-8
-        for encoding in ['utf-8', 'gbk', 'gb2312', 'latin1']:
-            try:
-                return payload.decode(encoding)
-            except UnicodeDecodeError:
-                continue
-        # 如果所有编码都失败，使用错误处理模式
-        return payload.decode('utf-8', errors='ignore')
-    else:
-        # 如果有明确的字符集，直接使用
-        try:
-            return payload.decode(charset, errors='ignore')
-        except Exception as e:
-            # 如果指定的字符集无法解码，尝试其他常见编码
-            for encoding in ['utf-8', 'gbk', 'gb2312', 'latin1']:
-                try:
-                    return payload.decode(encoding)
-                except UnicodeDecodeError:
-                    continue
-            # 如果所有编码都失败，使用错误处理模式
-            return payload.decode('utf-8', errors='ignore')
+    return extract_body(msg, html_as_text=False)
 
+def get_cached_email_body(cache, imap_id, uidvalidity=None, message_id_hash=None):
+    """从原始邮件缓存中获取邮件正文，未缓存时返回None"""
+    if cache is None:
+        return None
+    try:
+        raw = cache.get(uidvalidity, int(imap_id), message_id_hash)
+    except (TypeError, ValueError):
+        return None
+    if raw is None:
+        return None
+    return get_email_body(email.message_from_bytes(raw))
 
-def get_email_body(msg):
-    """获取邮件正文内容
+def fetch_email_bodies(mail, imap_ids, cache=None, folder='INBOX'):
+    """批量获取邮件正文：只选择一次文件夹，未缓存的邮件按UID集合分批FETCH
     
-    Args:
-        msg (email.message.Message): 邮件消息对象
-        
-    Returns:
-        str: 邮件正文内容
+    逐封产出 (imap_id, 正文)，缓存命中的邮件先产出，其余按FETCH完成的顺序产出；
+    格式无效或服务器上不存在的ID正文为None。FETCH出错时异常向上抛出，
+    由调用方区分连接断开和邮件不存在。下载的邮件会写入cache。
     """
-    body = ""
+    select_info = mail.select_folder(folder)
+    uidvalidity = select_info.get(b'UIDVALIDITY') if select_info else None
     
-    if msg.is_multipart():
-        # 处理多部分邮件
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition"))
-            
-            # 跳过附件
-            if "attachment" in content_disposition:
-                continue
-            
-            # 只处理文本内容
-            if content_type in ["text/plain", "text/html"]:
-                try:
-                    # 获取内容和字符集
-                    payload = part.get_payload(decode=True)
-                    charset = part.get_content_charset()
-                    
-                    # 解码内容
-                    body = decode_payload(payload, charset)
-                    
-                    # 优先获取纯文本内容
-                    if content_type == "text/plain":
-                        break
-                except Exception as e:
-                    # logger.warning(f"解码多部分邮件内容时出错: {e}")
-                    continue
-    else:
-        # 处理单部分邮件
+    # 同一UID可能被请求多次
+    requested = {}
+    for imap_id in imap_ids:
         try:
-            payload = msg.get_payload(decode=True)
-            charset = msg.get_content_charset()
-            
-            # 解码内容
-            body = decode_payload(payload, charset)
-        except Exception as e:
-            # logger.warning(f"解码单部分邮件内容时出错: {e}")
-            body = ""
+            uid = int(imap_id)
+        except (TypeError, ValueError):
+            yield imap_id, None
+            continue
+        requested.setdefault(uid, []).append(imap_id)
     
-    return body
+    cached = cache.get_many(uidvalidity, list(requested)) if cache is not None else {}
+    for uid, raw in cached.items():
+        body = get_email_body(email.message_from_bytes(raw))
+        for imap_id in requested[uid]:
+            yield imap_id, body
+    
+    missing = [uid for uid in requested if uid not in cached]
+    for i in range(0, len(missing), FETCH_CHUNK_SIZE):
+        chunk = missing[i:i+FETCH_CHUNK_SIZE]
+        msg_data = mail.fetch(chunk, ['RFC822'])
+        for uid in chunk:
+            raw = msg_data.get(uid, {}).get(b'RFC822')
+            body = None
+            if isinstance(raw, bytes):
+                if cache is not None and uidvalidity is not None:
+                    try:
+                        cache.put(raw, uidvalidity, uid)
+                    except Exception:
+                        pass
+                body = get_email_body(email.message_from_bytes(raw))
+            for imap_id in requested[uid]:
+                yield imap_id, body
 
-def fetch_email_body_by_imap_id(mail, imap_id):
-    """根据IMAP ID获取邮件正文"""
+def fetch_email_body_by_imap_id(mail, imap_id, cache=None, folder='INBOX'):
+    """根据IMAP ID获取邮件正文
+    
+    提供cache（raw_cache.MailboxCache，限定在该账号的folder中）时先按当前UIDVALIDITY查找原始邮件缓存，
+    下载的邮件也会写入缓存。
+    imap_id是folder中的UID。出错或邮件不存在时返回None。
+    """
     try:
-        # 选择收件箱
-        mail.select_folder('INBOX')
-        
-        # 尝试将imap_id转换为整数
-        try:
-            imap_id_int = int(imap_id)
-        except ValueError:
-            # logger.error(f"Invalid IMAP ID format: {imap_id}")
-            return None
-        
-        # 获取邮件的原始数据
+        for _, body in fetch_email_bodies(mail, [imap_id], cache, folder):
+            return body
+    except Exception:
+        pass
+    return None
+
+def read_imap_ids(args, stream):
+    """批量模式的IMAP ID：命令行参数、--file指定的文件（-为标准输入），都没有时读取标准输入
+    
+    文件中的ID以空白或逗号分隔。
+    """
+    imap_ids = [part for arg in args.imap_ids for part in arg.split(',') if part]
+    if args.file and args.file != '-':
+        with open(args.file, 'r', encoding='utf-8') as f:
+            text = f.read()
+    elif args.file == '-' or not imap_ids:
+        text = stream.read()
+    else:
+        text = ''
+    imap_ids.extend(text.replace(',', ' ').split())
+    return imap_ids
+
+def run_batch(argv):
+    """批量模式：一个连接、一次SELECT获取多封邮件的正文，每封邮件输出一行JSON
+    
+    输出格式: {"imap_id": "123", "ok": true, "body": "..."}
+    或 {"imap_id": "123", "ok": false, "error": "..."}；连接失败时以非零状态退出。
+    """
+    parser = argparse.ArgumentParser(
+        description='批量获取邮件正文，每封邮件输出一行JSON',
+        usage='python get_email_body_by_id.py --batch [imap_id ...] [--file PATH|-] [选项]'
+    )
+    parser.add_argument('--batch', action='store_true', help='批量模式')
+    parser.add_argument('imap_ids', nargs='*', help='IMAP ID（UID），可用逗号分隔')
+    parser.add_argument('--file', help='从文件读取IMAP ID，-表示标准输入（未提供任何ID时默认读取标准输入）')
+    parser.add_argument('--folder', default='INBOX', help='邮件所在的文件夹（默认INBOX）')
+    parser.add_argument('--email', default=config.config['email']['address'], help='邮箱地址（默认取配置）')
+    parser.add_argument('--password', default=config.config['email']['password'], help='邮箱授权码（默认取配置）')
+    parser.add_argument('--imap-server', default=config.config['email']['imap_server'] or 'imap.qq.com',
+                        help='IMAP服务器地址（默认取配置）')
+    args = parser.parse_args(argv)
+    
+    if not args.email or not args.password or not args.imap_server:
+        print("缺少必要的邮箱配置信息，请提供邮箱地址、授权码和IMAP服务器地址", file=sys.stderr)
+        sys.exit(1)
+    imap_ids = read_imap_ids(args, sys.stdin)
+    if not imap_ids:
+        return
+    
+    try:
+        mail = connect_to_qq_mail(args.email, args.password, args.imap_server)
+    except Exception as e:
+        print(f"连接邮箱失败: {e}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        failed = False
         try:
-            msg_data = mail.fetch([imap_id_int], ['RFC822'])
+            cache = open_cache(config.config.get('cache'))
+            if cache is not None:
+                cache = cache.for_mailbox(args.email, args.folder)
+            for imap_id, body in fetch_email_bodies(mail, imap_ids, cache, args.folder):
+                if body is None:
+                    line = {'imap_id': str(imap_id), 'ok': False,
+                            'error': f"无法获取邮件正文，IMAP ID {imap_id} 可能不存在或已删除"}
+                else:
+                    line = {'imap_id': str(imap_id), 'ok': True, 'body': body}
+                print(json.dumps(line, ensure_ascii=False), flush=True)
         except Exception as e:
-            # logger.error(f"无法从服务器获取邮件数据，IMAP ID: {imap_id_int}, 错误: {e}")
-            # 尝试获取邮箱中的邮件列表进行调试
-            try:
-                all_ids = mail.search(['ALL'])
-                # logger.info(f"邮箱中可用的IMAP ID数量: {len(all_ids)}")
-                if len(all_ids) > 0:
-                    # logger.info(f"最近的10个IMAP ID: {sorted(all_ids, reverse=True)[:10]}")
-                    pass
-            except Exception as search_error:
-                # logger.error(f"无法获取邮箱中的邮件列表: {search_error}")
-                pass
-            return None
-        
-        # 检查数据
-        if not msg_data:
-            # logger.error(f"No message data returned from server for IMAP ID: {imap_id_int}")
-            # 尝试获取邮箱中的邮件列表进行调试
-            try:
-                all_ids = mail.search(['ALL'])
-                # logger.info(f"邮箱中可用的IMAP ID数量: {len(all_ids)}")
-                if len(all_ids) > 0:
-                    # logger.info(f"最近的10个IMAP ID: {sorted(all_ids, reverse=True)[:10]}")
-                    pass
-            except Exception as search_error:
-                # logger.error(f"无法获取邮箱中的邮件列表: {search_error}")
-                pass
-            return None
-        
-        # 检查返回的数据中是否包含请求的ID
-        if imap_id_int not in msg_data:
-            # logger.error(f"Requested IMAP ID {imap_id_int} not found in response. Available IDs: {list(msg_data.keys())}")
-            return None
-            
-        # 获取邮件内容
-        msg_content = msg_data[imap_id_int][b'RFC822']
-        
-        if not isinstance(msg_content, bytes):
-            # logger.error(f"Message content is not bytes: {type(msg_content)}")
-            return None
-            
-        msg = email.message_from_bytes(msg_content)
-        
-        # 获取邮件正文
-        body = get_email_body(msg)
-        
-        return body
-    except Exception as e:
-        # logger.error(f"获取邮件正文时出错: {e}")
-        # 添加更多调试信息
-        import traceback
-        # logger.error(f"Traceback: {traceback.format_exc()}")
-        return None
+            print(f"获取邮件正文时出错: {e}", file=sys.stderr)
+            failed = True
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+    if failed:
+        sys.exit(1)
 
 def main():
     """主函数"""
+    if '--batch' in sys.argv[1:]:
+        run_batch(sys.argv[1:])
+        return
     if len(sys.argv) < 2:
         print("用法: python get_email_body_by_id.py <imap_id> [email] [password] [imap_server]", file=sys.stderr)
+        print("      python get_email_body_by_id.py --batch [imap_id ...] [--file PATH|-]", file=sys.stderr)
         sys.exit(1)
     
     imap_id = sys.argv[1]
@@ -221,7 +228,8 @@ def main():
         # logger.info(f"正在获取IMAP ID为 {imap_id} 的邮件")
         
         # 获取邮件正文
-        body = fetch_email_body_by_imap_id(mail, imap_id)
+        cache = open_cache(config.config.get('cache'))
+        body = fetch_email_body_by_imap_id(mail, imap_id, cache.for_mailbox(email, 'INBOX') if cache else None)
         
         # 关闭连接
         try:
@@ -0,0 +1,404 @@
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+# 导入配置模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script.config as config
+from script.qq_email_imap import (
+    build_search_criteria,
+    bulk_save_emails,
+    connect_email_db,
+    connect_to_qq_mail,
+    ensure_email_tables,
+    fetch_emails_partial,
+    fetch_raw_messages,
+    get_known_uids,
+    load_sync_state,
+    save_emails_to_database,
+    select_folder_for_sync,
+    upsert_emails,
+    write_sync_state,
+)
+from script.adaptive_batch import is_connection_error
+from script.parse_pool import ParsePool
+from script.raw_cache import open_cache
+from script import imap_budget, metrics
+
+# 同时打开的IMAP连接数上限，超过服务器限制会导致登录失败
+MAX_IMAP_CONNECTIONS = 8
+DEFAULT_CONNECTIONS = 4
+# 每次FETCH的邮件数量
+FETCH_BATCH_SIZE = 50
+# 解析结果队列的长度（单位：批），队列满时抓取线程会阻塞等待
+RESULT_QUEUE_SIZE = 16
+# 每次写入数据库的邮件数量
+WRITE_BATCH_SIZE = 500
+# 每个抓取线程在连接断开后最多重新连接的次数，超过后线程退出，剩余批次由其他连接处理
+MAX_RECONNECTS = 2
+
+
+class BackfillStats:
+    """回填过程的吞吐量统计"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.messages = 0
+        self.bytes = 0
+        self.failed_uids = []
+        self._lock = threading.Lock()
+
+    def add(self, messages, nbytes):
+        with self._lock:
+            self.messages += messages
+            self.bytes += nbytes
+
+    def add_failed(self, uids):
+        with self._lock:
+            self.failed_uids.extend(uids)
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (f"已下载 {self.messages} 封邮件, {self.bytes / 1024 / 1024:.1f} MB, "
+                f"{self.messages / elapsed:.1f} 封/秒, {self.bytes / 1024 / 1024 / elapsed:.2f} MB/秒")
+
+
+def _connect_fetcher(email_addr, password, imap_server, folder):
+    """抓取线程的连接：登录并以只读方式选择文件夹"""
+    client = connect_to_qq_mail(email_addr, password, imap_server)
+    try:
+        client.select_folder(folder, readonly=True)
+    except Exception:
+        _logout(client)
+        raise
+    return client
+
+
+def _logout(client):
+    try:
+        client.logout()
+    except Exception:
+        pass
+
+
+def _fetch_worker(email_addr, password, imap_server, batches, results, parse_pool, fetch_mode, stats,
+                  cache=None, uidvalidity=None, folder='INBOX'):
+    """抓取线程：使用独立的IMAP连接从任务队列中取批次下载，已缓存的原始邮件不再下载
+
+    连接断开时把批次放回队列并重新连接，重连失败或超过MAX_RECONNECTS次后退出，不再从队列中取批次。
+    """
+    try:
+        client = _connect_fetcher(email_addr, password, imap_server, folder)
+    except Exception as e:
+        print(f"抓取线程连接邮箱失败: {e}")
+        return
+    reconnects = 0
+    try:
+        while True:
+            try:
+                batch_ids = batches.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if fetch_mode == 'partial':
+                    records = fetch_emails_partial(client, batch_ids, on_bytes=lambda n: stats.add(0, n))
+                    stats.add(len(records), 0)
+                    future = Future()
+                    future.set_result(records)
+                else:
+                    items = fetch_raw_messages(client, batch_ids, cache, uidvalidity)
+                    stats.add(len(items), sum(len(raw) for _, raw in items))
+                    future = parse_pool.submit(items)
+                # 队列已满时阻塞，向抓取端施加背压
+                results.put((batch_ids, future))
+            except Exception as e:
+                if not is_connection_error(e):
+                    print(f"下载邮件ID {min(batch_ids)}-{max(batch_ids)} 时出错: {e}")
+                    stats.add_failed(batch_ids)
+                    continue
+                # 连接已断开：批次交还给其他连接，本线程重新连接后继续
+                batches.put(batch_ids)
+                _logout(client)
+                client = None
+                if reconnects >= MAX_RECONNECTS:
+                    print(f"抓取线程的连接已断开 {reconnects + 1} 次，停止该线程: {e}")
+                    break
+                reconnects += 1
+                print(f"抓取线程的连接已断开，重新连接（第 {reconnects} 次）: {e}")
+                try:
+                    client = _connect_fetcher(email_addr, password, imap_server, folder)
+                except Exception as e:
+                    print(f"抓取线程重新连接失败，停止该线程: {e}")
+                    break
+    finally:
+        if client is not None:
+            _logout(client)
+
+
+def run_backfill(email_addr, password, imap_server, db_config, start_date=None, end_date=None,
+                 connections=DEFAULT_CONNECTIONS, parse_workers=None, fetch_mode='rfc822', bulk=False, cache=None,
+                 folder='INBOX', parse_pool=None):
+    """使用多个IMAP连接并发回填邮件
+
+    UID按批次放入共享任务队列，由connections个连接并发下载；rfc822模式的原始邮件经共享内存交给解析进程池
+    （未提供parse_pool时按parse_workers创建），解析结果通过有界队列按批次流向数据库写入端（调用线程）。
+    bulk为True时使用bulk_save_emails在一个事务内暂存并合并全部邮件；否则每WRITE_BATCH_SIZE封一个事务，
+    同步位置与邮件在同一个事务中提交，只推进到连续提交的UID，写入失败时停止回填并抛出异常。
+    提供cache时rfc822模式先查原始邮件缓存。
+
+    Returns:
+        tuple: (处理的邮件数, 新增的邮件数)
+    """
+    # 不超过账号的连接数上限，多出的线程只会等待其他线程归还名额
+    connections = max(1, min(connections, MAX_IMAP_CONNECTIONS, imap_budget.limit(email_addr)))
+    sync_state = load_sync_state(db_config, email_addr, folder)
+    if cache is not None:
+        cache = cache.for_mailbox(email_addr, folder)
+
+    control = connect_to_qq_mail(email_addr, password, imap_server)
+    try:
+        _, full_resync, _ = select_folder_for_sync(control, folder, sync_state)
+        search_criteria = build_search_criteria(start_date, end_date)
+        windowed = search_criteria != ['ALL']
+        email_ids = sorted(control.search(search_criteria))
+    finally:
+        _logout(control)
+    print(f"找到 {len(email_ids)} 封邮件")
+
+    if not full_resync:
+        known_uids = get_known_uids(db_config, email_ids, sync_state['uidvalidity'], email_addr, folder)
+        if known_uids:
+            print(f"跳过 {len(known_uids)} 封已保存的邮件")
+            email_ids = [uid for uid in email_ids if uid not in known_uids]
+    if not email_ids:
+        save_emails_to_database([], db_config, sync_state)
+        return 0, 0
+
+    batches = queue.Queue()
+    for i in range(0, len(email_ids), FETCH_BATCH_SIZE):
+        batches.put(email_ids[i:i+FETCH_BATCH_SIZE])
+    connections = min(connections, batches.qsize())
+    print(f"开始回填 {len(email_ids)} 封邮件，使用 {connections} 个IMAP连接")
+
+    results = queue.Queue(maxsize=RESULT_QUEUE_SIZE)
+    stats = BackfillStats()
+    processed_count = 0
+    inserted_count = 0
+
+    # partial模式在抓取线程中直接解析，不需要解析进程池
+    own_pool = parse_pool is None and fetch_mode != 'partial'
+    if own_pool:
+        parse_pool = ParsePool(parse_workers)
+    try:
+        fetchers = [
+            threading.Thread(
+                target=_fetch_worker,
+                args=(email_addr, password, imap_server, batches, results, parse_pool, fetch_mode, stats,
+                      cache, sync_state['uidvalidity'], folder),
+                daemon=True
+            )
+            for _ in range(connections)
+        ]
+        for fetcher in fetchers:
+            fetcher.start()
+
+        def _close_results():
+            for fetcher in fetchers:
+                fetcher.join()
+            # 所有连接都异常退出时，剩余批次记为失败
+            while True:
+                try:
+                    stats.add_failed(batches.get_nowait())
+                except queue.Empty:
+                    break
+            results.put(None)
+        threading.Thread(target=_close_results, daemon=True).start()
+
+        def _iter_batches():
+            """按完成顺序产出 (batch_ids, 解析后的邮件)，下载或解析失败的批次不产出"""
+            last_report = time.monotonic()
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                batch_ids, future = item
+                try:
+                    records = future.result()
+                except Exception as e:
+                    print(f"解析邮件ID {min(batch_ids)}-{max(batch_ids)} 时出错: {e}")
+                    stats.add_failed(batch_ids)
+                    continue
+                yield batch_ids, records
+                if time.monotonic() - last_report >= 5:
+                    print(stats.report())
+                    last_report = time.monotonic()
+            if stats.failed_uids:
+                print(f"有 {len(stats.failed_uids)} 封邮件下载或解析失败，将在下次同步时重试")
+
+        def _iter_parsed():
+            """逐封产出解析后的邮件；结束后把同步位置推进到第一个失败的UID之前"""
+            for _, records in _iter_batches():
+                yield from records
+            if not windowed:
+                first_failed_uid = min(stats.failed_uids) if stats.failed_uids else None
+                synced_uids = [uid for uid in email_ids if first_failed_uid is None or uid < first_failed_uid]
+                if synced_uids:
+                    sync_state['last_uid'] = max(sync_state['last_uid'], max(synced_uids))
+
+        def _abort():
+            """停止回填：丢弃未开始的批次，并取走已下载的结果让抓取线程退出"""
+            while True:
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    break
+            while results.get() is not None:
+                pass
+
+        # 数据库写入在当前线程进行
+        if bulk:
+            # 批量模式：全部邮件流入暂存表，一个事务内合并，最后写入同步状态
+            counter = _Counter()
+            inserted_count = bulk_save_emails(counter.wrap(_iter_parsed()), db_config, sync_state)
+            processed_count = counter.count
+        else:
+            writer = _CheckpointWriter(db_config, sync_state, email_ids, windowed, email_addr, folder)
+            try:
+                with writer:
+                    for batch_ids, records in _iter_batches():
+                        writer.add(batch_ids, records)
+                    writer.flush()
+            except Exception as e:
+                print(f"写入数据库失败，停止回填，同步位置保留在已提交的邮件: {e}")
+                _abort()
+                raise
+            processed_count, inserted_count = writer.processed, writer.inserted
+    finally:
+        if own_pool:
+            parse_pool.close()
+
+    print(stats.report())
+    return processed_count, inserted_count
+
+
+class _CheckpointWriter:
+    """非批量模式的数据库写入端：每WRITE_BATCH_SIZE封一个事务，同步位置在同一个事务中提交
+
+    回填的批次按完成顺序到达，同步位置只推进到email_ids中连续提交的UID，失败的UID之后不推进。
+    """
+
+    def __init__(self, db_config, sync_state, email_ids, windowed, account, folder):
+        self.db_config = db_config
+        self.sync_state = sync_state
+        self.email_ids = email_ids
+        self.windowed = windowed
+        self.account = account
+        self.folder = folder
+        self.pending = []
+        self.pending_uids = []
+        self.committed = set()
+        self.position = 0
+        self.processed = 0
+        self.inserted = 0
+
+    def __enter__(self):
+        self.connection = connect_email_db(self.db_config)
+        self.cursor = self.connection.cursor()
+        ensure_email_tables(self.cursor)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cursor.close()
+        self.connection.close()
+
+    def add(self, batch_ids, records):
+        self.pending.extend(records)
+        self.pending_uids.extend(batch_ids)
+        if len(self.pending) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """写入缓冲的邮件并推进同步位置；没有缓冲的邮件时也会写入同步状态（记录新的UIDVALIDITY）"""
+        self.connection.begin()
+        try:
+            inserted = 0
+            if self.pending:
+                inserted = upsert_emails(self.cursor, self.pending, uidvalidity=self.sync_state['uidvalidity'],
+                                         account=self.account, folder=self.folder)
+            if not self.windowed:
+                self.committed.update(self.pending_uids)
+                while self.position < len(self.email_ids) and self.email_ids[self.position] in self.committed:
+                    self.committed.discard(self.email_ids[self.position])
+                    self.position += 1
+                if self.position:
+                    self.sync_state['last_uid'] = max(self.sync_state['last_uid'],
+                                                      self.email_ids[self.position - 1])
+            write_sync_state(self.cursor, self.sync_state)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        self.processed += len(self.pending)
+        self.inserted += inserted
+        self.pending = []
+        self.pending_uids = []
+
+
+class _Counter:
+    """统计经过生成器的元素个数"""
+
+    def __init__(self):
+        self.count = 0
+
+    def wrap(self, iterable):
+        for item in iterable:
+            self.count += 1
+            yield item
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='使用多个IMAP连接并发回填邮件')
+    parser.add_argument('email', help='邮箱地址')
+    parser.add_argument('password', help='邮箱授权码')
+    parser.add_argument('imap_server', help='IMAP服务器地址')
+    parser.add_argument('start_date', nargs='?', default=None, help='开始日期 (YYYY-MM-DD)')
+    parser.add_argument('end_date', nargs='?', default=None, help='结束日期 (YYYY-MM-DD)')
+    parser.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS,
+                        help=f'IMAP连接数 (最多 {MAX_IMAP_CONNECTIONS})')
+    parser.add_argument('--parse-workers', type=int, default=None, help='解析进程数，默认为CPU核数')
+    parser.add_argument('--fetch-mode', choices=['partial', 'rfc822'], default='rfc822',
+                        help='rfc822: 下载完整邮件并在进程池中解析（默认）；partial: 只下载头部和正文部分')
+    parser.add_argument('--bulk', action='store_true',
+                        help='批量模式：暂存到临时表后一次性合并，只改写内容有变化的邮件')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.configure_from_args(config.config.get('metrics'), args)
+
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+    try:
+        processed_count, inserted_count = run_backfill(
+            args.email, args.password, args.imap_server, db_config, args.start_date, args.end_date,
+            args.connections, args.parse_workers, args.fetch_mode, args.bulk,
+            open_cache(config.config.get('cache'))
+        )
+        print(f"总共处理 {processed_count} 封邮件，新增 {inserted_count} 封邮件")
+        metrics.report()
+        metrics.flush()
+    except Exception as e:
+        print(f"回填邮件时发生错误: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# 每个账号同时登录的IMAP连接数：同一进程中的正文连接池、收件箱监听、导入、回填和asyncio后端共用一个计数，
+# 总数不超过账号配置的max_connections（服务器按账号限制并发连接，超过时登录失败）
+import threading
+
+from imapclient import IMAPClient
+
+import script.config as config
+from script import metrics
+
+# 等待空闲名额的最长时间（秒），超过后放弃登录
+ACQUIRE_TIMEOUT = 120
+
+_cond = threading.Condition()
+# 账号 -> 已占用的连接数
+_used = {}
+# 账号 -> 名额不足时调用的回收函数（关闭空闲会话，返回关闭的数量）
+_reclaimers = {}
+
+
+def limit(account):
+    """账号的连接数上限：取账号配置的max_connections，不在配置中的账号取默认值"""
+    for item in config.get_accounts():
+        if item['address'] == account:
+            return item['max_connections']
+    return config.DEFAULT_MAX_CONNECTIONS
+
+
+def _reclaim(account):
+    # 在锁外调用：回收函数关闭会话时会调用release
+    with _cond:
+        reclaimers = list(_reclaimers.get(account, ()))
+    for reclaim in reclaimers:
+        try:
+            reclaim()
+        except Exception as e:
+            metrics.debug("回收账号 %s 的空闲连接失败: %s", account, e)
+
+
+def available(account):
+    """回收空闲会话后账号还能新建的连接数（如监听占用的连接不会被回收）"""
+    _reclaim(account)
+    with _cond:
+        return max(limit(account) - _used.get(account, 0), 0)
+
+
+def acquire(account, timeout=ACQUIRE_TIMEOUT):
+    """占用账号的一个连接名额，名额不足时先回收空闲会话再等待，超时抛出RuntimeError"""
+    cap = limit(account)
+    with _cond:
+        if _used.get(account, 0) < cap:
+            _used[account] = _used.get(account, 0) + 1
+            return
+    _reclaim(account)
+    with _cond:
+        if not _cond.wait_for(lambda: _used.get(account, 0) < cap, timeout):
+            raise RuntimeError(f"账号 {account} 的IMAP连接数已达上限 {cap}，请稍后重试")
+        _used[account] = _used.get(account, 0) + 1
+    metrics.count('imap_budget_waits_total')
+
+
+def release(account):
+    with _cond:
+        if _used.get(account, 0) > 0:
+            _used[account] -= 1
+        _cond.notify_all()
+
+
+def add_reclaimer(account, reclaim):
+    with _cond:
+        _reclaimers.setdefault(account, []).append(reclaim)
+
+
+def remove_reclaimer(account, reclaim):
+    with _cond:
+        if reclaim in _reclaimers.get(account, ()):
+            _reclaimers[account].remove(reclaim)
+
+
+class BudgetedIMAPClient(IMAPClient):
+    """登录前占用账号的连接名额，logout或shutdown时归还（只归还一次，失败的logout也会归还）"""
+
+    budget_account = None
+
+    def login(self, username, password):
+        acquire(username)
+        try:
+            result = super().login(username, password)
+        except Exception:
+            release(username)
+            raise
+        self.budget_account = username
+        return result
+
+    def _release_budget(self):
+        account, self.budget_account = self.budget_account, None
+        if account is not None:
+            release(account)
+
+    def logout(self):
+        try:
+            return super().logout()
+        finally:
+            self._release_budget()
+
+    def shutdown(self):
+        try:
+            return super().shutdown()
+        finally:
+            self._release_budget()
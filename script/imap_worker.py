@@ -0,0 +1,541 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 导入配置模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script.config as config
+from script.get_email_body_by_id import (connect_to_qq_mail, fetch_email_bodies, fetch_email_body_by_imap_id,
+                                         get_cached_email_body)
+from script.raw_cache import open_cache
+from script.qq_email_imap import ImportInterrupted, run_import, run_watch
+from script.sync_scheduler import run_scheduler
+from script import imap_budget, metrics
+
+# 连接池默认大小，QQ邮箱对同一账号的并发登录数有限制
+DEFAULT_POOL_SIZE = 2
+# 空闲连接发送NOOP保活的间隔（秒）
+KEEPALIVE_INTERVAL = 60
+
+
+class IMAPSessionPool:
+    """已登录IMAP会话的连接池
+
+    会话按需创建，数量不超过max_size；空闲会话定期发送NOOP保活，
+    失效的会话会被丢弃并在下次使用时重新登录。
+    """
+
+    def __init__(self, email_addr, password, imap_server, max_size=DEFAULT_POOL_SIZE, cache=None):
+        self.email_addr = email_addr
+        self.password = password
+        self.imap_server = imap_server
+        self.max_size = max_size
+        self.cache = cache
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.stats = {'logins': 0, 'reconnects': 0, 'requests': 0}
+        # 同一账号的导入、监听等需要连接而名额不足时，先关闭本池的空闲会话
+        imap_budget.add_reclaimer(email_addr, self.close_idle)
+
+    def _connect(self):
+        session = connect_to_qq_mail(self.email_addr, self.password, self.imap_server)
+        self.stats['logins'] += 1
+        return session
+
+    @staticmethod
+    def _is_alive(session):
+        try:
+            session.noop()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(session):
+        try:
+            session.logout()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """取出一个可用会话，池满时阻塞等待"""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    session, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - last_used < KEEPALIVE_INTERVAL or self._is_alive(session):
+                    return session
+                self.stats['reconnects'] += 1
+                self._close(session)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, session, broken=False):
+        """归还会话；broken为True时直接关闭"""
+        if broken:
+            self._close(session)
+        else:
+            self._idle.put((session, time.monotonic()))
+        self._slots.release()
+
+    def keepalive(self):
+        """对空闲超过保活间隔的会话发送NOOP，失效的会话直接丢弃
+
+        检查期间同样占用连接池名额，保证会话总数不会超过max_size。
+        """
+        for _ in range(self._idle.qsize()):
+            if not self._slots.acquire(blocking=False):
+                return
+            try:
+                session, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                self._slots.release()
+                return
+            if time.monotonic() - last_used < KEEPALIVE_INTERVAL:
+                self._idle.put((session, last_used))
+            elif self._is_alive(session):
+                self._idle.put((session, time.monotonic()))
+            else:
+                self._close(session)
+            self._slots.release()
+
+    def close_idle(self):
+        """关闭全部空闲会话（归还账号的连接名额），返回关闭的数量"""
+        closed = 0
+        while True:
+            try:
+                session, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return closed
+            self._close(session)
+            closed += 1
+
+    def close(self):
+        imap_budget.remove_reclaimer(self.email_addr, self.close_idle)
+        self.close_idle()
+
+    def _cache(self, folder):
+        """本账号folder文件夹的原始邮件缓存视图"""
+        return self.cache.for_mailbox(self.email_addr, folder) if self.cache else None
+
+    def fetch_body(self, imap_id, uidvalidity=None, message_id_hash=None, folder='INBOX', cache_only=False):
+        """获取邮件正文，优先读取原始邮件缓存；连接失效时自动重连重试一次
+
+        cache_only为True时只读缓存（对账已标记为孤儿的邮件，服务器上原UID已不存在）。
+        """
+        self.stats['requests'] += 1
+        if uidvalidity is not None or message_id_hash:
+            # 缓存命中时完全不占用IMAP连接
+            body = get_cached_email_body(self._cache(folder), imap_id, uidvalidity, message_id_hash)
+            if body is not None or cache_only:
+                return body
+        if cache_only:
+            return None
+        for attempt in range(2):
+            session = self.acquire()
+            body = fetch_email_body_by_imap_id(session, imap_id, self._cache(folder), folder)
+            if body is not None:
+                self.release(session)
+                return body
+            # fetch_email_body_by_imap_id会吞掉异常，用NOOP区分"邮件不存在"和"连接已断开"
+            if self._is_alive(session):
+                self.release(session)
+                return None
+            self.release(session, broken=True)
+            self.stats['reconnects'] += 1
+        return None
+
+    def fetch_bodies(self, items, folder='INBOX'):
+        """批量获取同一文件夹中多封邮件的正文，逐封产出 (item, 正文或None)
+
+        items中每项为 {"imap_id", "uidvalidity", "message_id_hash"}，带 "cache_only": true 的只读缓存。缓存命中的邮件不占用连接，
+        其余邮件在一个会话中只SELECT一次、按UID集合FETCH；连接失效时重连并重试未完成的部分一次。
+        """
+        self.stats['requests'] += 1
+        pending = {}
+        for item in items:
+            if item.get('uidvalidity') is not None or item.get('message_id_hash'):
+                body = get_cached_email_body(self._cache(folder), item.get('imap_id'), item.get('uidvalidity'),
+                                             item.get('message_id_hash'))
+                if body is not None:
+                    yield item, body
+                    continue
+            if item.get('cache_only'):
+                yield item, None
+                continue
+            pending.setdefault(str(item.get('imap_id')), []).append(item)
+        for _ in range(2):
+            if not pending:
+                return
+            session = self.acquire()
+            broken = False
+            try:
+                for imap_id, body in fetch_email_bodies(session, list(pending), self._cache(folder), folder):
+                    for item in pending.pop(imap_id, ()):
+                        yield item, body
+            except Exception as e:
+                broken = not self._is_alive(session)
+                if not broken:
+                    metrics.warn("批量获取邮件正文失败: %s", e)
+            finally:
+                self.release(session, broken=broken)
+            if not broken:
+                break
+            self.stats['reconnects'] += 1
+        for imap_items in pending.values():
+            for item in imap_items:
+                yield item, None
+
+
+class FetchJob:
+    """正在运行的邮件获取任务"""
+
+    def __init__(self, request_id, start_date, end_date):
+        self.request_id = request_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.started = time.time()
+        self.cancel = threading.Event()
+        self.processed = 0
+        self.inserted = 0
+        self.total = None
+
+    def status(self):
+        return {
+            'id': self.request_id,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'started': self.started,
+            'processed': self.processed,
+            'inserted': self.inserted,
+            'total': self.total,
+            'cancelling': self.cancel.is_set()
+        }
+
+
+class IMAPWorker:
+    """常驻的IMAP工作进程，通过stdin/stdout按行交换JSON请求和响应
+
+    请求格式: {"id": 1, "op": "body", "imap_id": "123", "uidvalidity": 1, "message_id_hash": "...",
+              "account": "a@qq.com", "folder": "INBOX", "cache_only": false}
+    响应格式: {"id": 1, "ok": true, "body": "..."} 或 {"id": 1, "ok": false, "error": "..."}
+    支持的操作: configure, body, bodies, fetch, cancel, watch, unwatch, status, ping, stats
+
+    bodies请求: {"id": 5, "op": "bodies", "account": "a@qq.com",
+                "items": [{"key": "42", "imap_id": "123", "uidvalidity": 1, "message_id_hash": "...", "folder": "INBOX"}]}
+    一次获取多封邮件的正文（每个文件夹一个连接、一次SELECT），每封邮件获取后发送
+    {"id": 5, "event": "body", "key": "42", "body": "..."}，结束时发送 {"id": 5, "ok": true, "found": 1, "missing": []}，
+    missing为未能获取的key。body和bodies中带 "cache_only": true 的邮件（对账标记的孤儿）只从原始邮件缓存读取。
+
+    fetch请求: {"id": 2, "op": "fetch", "start_date": "2025-01-01", "end_date": "2025-01-31"}
+    执行期间按批发送进度事件 {"id": 2, "event": "progress", "processed": 50, "inserted": 3, "total": 200}，
+    结束时发送 {"id": 2, "ok": true, "processed": 200, "inserted": 12, "cancelled": false}。
+    fetch请求带 "accounts": "all" 时按配置同步所有账号的所有文件夹（见 sync_scheduler.py），
+    结束响应中附带每个文件夹的结果 "folders": [...]。
+    cancel请求: {"id": 3, "op": "cancel", "target": 2}，在当前批次完成后停止，已入库的邮件保留。
+    watch请求: {"id": 4, "op": "watch"}，持续监听收件箱，新邮件入库后发送
+    {"id": 4, "event": "change", "type": "new", "uids": [...], "inserted": 1}；
+    收到unwatch或切换账号时结束，并发送 {"id": 4, "ok": true}。
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, output=None):
+        self.pool_size = pool_size
+        self.pool = None
+        # 其他账号的连接池，按需创建，只用于获取这些账号的邮件正文
+        self._account_pools = {}
+        self._account_pools_lock = threading.Lock()
+        self.cache = open_cache(config.config.get('cache'))
+        self.output = output or sys.stdout
+        self._fetch_job = None
+        self._fetch_lock = threading.Lock()
+        self._watch = None
+        self._output_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.configure(
+            config.config['email']['address'],
+            config.config['email']['password'],
+            config.config['email']['imap_server']
+        )
+
+    def configure(self, email_addr, password, imap_server):
+        """切换邮箱账号，旧的连接池会被关闭，正在进行的监听也会停止"""
+        self.stop_watch()
+        old_pool = self.pool
+        self.pool = None
+        if email_addr and password and imap_server:
+            self.pool = IMAPSessionPool(email_addr, password, imap_server, self.pool_size, self.cache)
+        if old_pool:
+            old_pool.close()
+        # 配置保存后账号列表可能已变化，其他账号的连接池重新按需创建
+        with self._account_pools_lock:
+            account_pools, self._account_pools = self._account_pools, {}
+        for pool in account_pools.values():
+            pool.close()
+
+    def send(self, message):
+        line = json.dumps(message, ensure_ascii=False)
+        with self._output_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def start_fetch(self, request):
+        """在后台线程中执行一次导入，同一时间只允许一个获取任务"""
+        request_id = request.get('id')
+        pool = self.pool
+        email_addr = request.get('email') or (pool.email_addr if pool else None)
+        password = request.get('password') or (pool.password if pool else None)
+        imap_server = request.get('imap_server') or (pool.imap_server if pool else None)
+        if not email_addr or not password or not imap_server:
+            raise ValueError('缺少必要的邮箱配置信息，请提供邮箱地址、授权码和IMAP服务器地址')
+        with self._fetch_lock:
+            if self._fetch_job is not None:
+                raise RuntimeError(f'已有邮件获取任务正在运行 (请求 {self._fetch_job.request_id})')
+            job = FetchJob(request_id, request.get('start_date'), request.get('end_date'))
+            self._fetch_job = job
+        threading.Thread(
+            target=self._run_fetch,
+            args=(job, email_addr, password, imap_server, request.get('fetch_mode') or 'partial',
+              request.get('accounts') == 'all'),
+            daemon=True
+        ).start()
+
+    def _run_fetch(self, job, email_addr, password, imap_server, fetch_mode, all_accounts=False):
+        def progress(processed, inserted, total):
+            job.processed, job.inserted, job.total = processed, inserted, total
+            self.send({'id': job.request_id, 'event': 'progress',
+                       'processed': processed, 'inserted': inserted, 'total': total})
+
+        try:
+            db_config = self._db_config()
+            accounts = config.get_accounts() if all_accounts else []
+            if accounts:
+                processed, inserted, folders = run_scheduler(
+                    accounts, db_config, job.start_date, job.end_date, fetch_mode,
+                    cache=self.cache, progress=progress, cancel=job.cancel
+                )
+                self.send({'id': job.request_id, 'ok': True, 'processed': processed, 'inserted': inserted,
+                           'cancelled': job.cancel.is_set(), 'folders': folders})
+                return
+            try:
+                processed, inserted = run_import(
+                    email_addr, password, imap_server, db_config, job.start_date, job.end_date,
+                    fetch_mode, cache=self.cache, progress=progress, cancel=job.cancel
+                )
+            except ImportInterrupted:
+                processed, inserted = job.processed, job.inserted
+            self.send({'id': job.request_id, 'ok': True, 'processed': processed, 'inserted': inserted,
+                       'cancelled': job.cancel.is_set()})
+        except Exception as e:
+            self.send({'id': job.request_id, 'ok': False, 'error': str(e)})
+        finally:
+            with self._fetch_lock:
+                self._fetch_job = None
+            # 指标按累计值输出，每次获取结束后更新一次指标文件
+            metrics.flush()
+
+    def _db_config(self):
+        # 配置页面保存后config.json可能已变化，每次使用前重新读取数据库配置
+        config.load_config()
+        return {
+            'host': config.config['db']['host'],
+            'user': config.config['db']['user'],
+            'password': config.config['db']['password'],
+            'database': 'job_emails',
+            'charset': config.config['db']['charset']
+        }
+
+    def start_watch(self, request):
+        """在后台线程中监听收件箱，同一时间只有一个监听"""
+        request_id = request.get('id')
+        pool = self.pool
+        if not pool:
+            raise ValueError('缺少必要的邮箱配置信息，请提供邮箱地址、授权码和IMAP服务器地址')
+        self.stop_watch()
+        stop = threading.Event()
+        self._watch = (request_id, stop)
+
+        def on_change(change):
+            self.send({'id': request_id, 'event': 'change', **change})
+
+        def run():
+            try:
+                run_watch(pool.email_addr, pool.password, pool.imap_server, self._db_config(),
+                          request.get('fetch_mode') or 'partial', self.cache, on_change, stop)
+                self.send({'id': request_id, 'ok': True})
+            except Exception as e:
+                self.send({'id': request_id, 'ok': False, 'error': str(e)})
+            finally:
+                if self._watch and self._watch[1] is stop:
+                    self._watch = None
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_watch(self):
+        """停止监听，返回是否有正在进行的监听"""
+        watch = self._watch
+        self._watch = None
+        if watch is None:
+            return False
+        watch[1].set()
+        return True
+
+    def pool_for(self, account=None):
+        """返回指定账号的连接池；未指定账号或为当前账号时返回默认连接池
+
+        账号不在配置中时抛出ValueError，不能退回默认连接池（同一UID在另一个邮箱中是另一封邮件）。
+        """
+        pool = self.pool
+        if not account or (pool and pool.email_addr == account):
+            return pool
+        with self._account_pools_lock:
+            if account not in self._account_pools:
+                config.load_config()
+                match = next((a for a in config.get_accounts() if a['address'] == account), None)
+                if match is None:
+                    raise ValueError(f"账号 {account} 不在配置中，无法获取该账号的邮件正文")
+                self._account_pools[account] = IMAPSessionPool(
+                    match['address'], match['password'], match['imap_server'],
+                    min(self.pool_size, match['max_connections']), self.cache
+                )
+            return self._account_pools[account]
+
+    def cancel_fetch(self, target=None):
+        """取消获取任务；target为空时取消当前任务，返回是否找到了任务"""
+        job = self._fetch_job
+        if job is None or (target is not None and job.request_id != target):
+            return False
+        job.cancel.set()
+        return True
+
+    def handle(self, request):
+        request_id = request.get('id')
+        op = request.get('op')
+        try:
+            if op == 'ping':
+                self.send({'id': request_id, 'ok': True})
+            elif op == 'configure':
+                self.configure(request.get('email'), request.get('password'), request.get('imap_server'))
+                self.send({'id': request_id, 'ok': True})
+            elif op == 'stats':
+                stats = dict(self.pool.stats) if self.pool else {}
+                if self.cache:
+                    stats['cache'] = self.cache.summary()
+                if metrics.is_enabled():
+                    stats['metrics'] = metrics.snapshot()
+                self.send({'id': request_id, 'ok': True, 'stats': stats})
+            elif op == 'status':
+                job = self._fetch_job
+                self.send({
+                    'id': request_id,
+                    'ok': True,
+                    'configured': self.pool is not None,
+                    'fetch': job.status() if job else None,
+                    'watching': self._watch is not None
+                })
+            elif op == 'fetch':
+                # 结果和进度事件由后台线程发送
+                self.start_fetch(request)
+            elif op == 'watch':
+                # 变更事件和结束响应由后台线程发送
+                self.start_watch(request)
+            elif op == 'unwatch':
+                self.send({'id': request_id, 'ok': True, 'stopped': self.stop_watch()})
+            elif op == 'cancel':
+                self.send({'id': request_id, 'ok': True, 'cancelled': self.cancel_fetch(request.get('target'))})
+            elif op == 'body':
+                pool = self.pool_for(request.get('account'))
+                if not pool:
+                    raise ValueError('缺少必要的邮箱配置信息，请提供邮箱地址、授权码和IMAP服务器地址')
+                body = pool.fetch_body(request.get('imap_id'), request.get('uidvalidity'),
+                                       request.get('message_id_hash'), request.get('folder') or 'INBOX',
+                                       bool(request.get('cache_only')))
+                if body is None and request.get('cache_only'):
+                    self.send({
+                        'id': request_id,
+                        'ok': False,
+                        'error': f"邮件已从服务器删除或移到其他文件夹，且原始邮件缓存中没有 IMAP ID {request.get('imap_id')}"
+                    })
+                elif body is None:
+                    self.send({
+                        'id': request_id,
+                        'ok': False,
+                        'error': f"无法获取邮件正文，IMAP ID {request.get('imap_id')} 可能不存在或已删除"
+                    })
+                else:
+                    self.send({'id': request_id, 'ok': True, 'body': body})
+            elif op == 'bodies':
+                pool = self.pool_for(request.get('account'))
+                if not pool:
+                    raise ValueError('缺少必要的邮箱配置信息，请提供邮箱地址、授权码和IMAP服务器地址')
+                by_folder = {}
+                for item in request.get('items') or []:
+                    by_folder.setdefault(item.get('folder') or 'INBOX', []).append(item)
+                found = 0
+                missing = []
+                for folder, items in by_folder.items():
+                    for item, body in pool.fetch_bodies(items, folder):
+                        if body is None:
+                            missing.append(item.get('key'))
+                        else:
+                            found += 1
+                            self.send({'id': request_id, 'event': 'body', 'key': item.get('key'), 'body': body})
+                self.send({'id': request_id, 'ok': True, 'found': found, 'missing': missing})
+            else:
+                raise ValueError(f'未知的操作: {op}')
+        except Exception as e:
+            self.send({'id': request_id, 'ok': False, 'error': str(e)})
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(KEEPALIVE_INTERVAL / 2)
+            pool = self.pool
+            if pool:
+                try:
+                    pool.keepalive()
+                except Exception:
+                    pass
+
+    def serve(self, stream):
+        threading.Thread(target=self._keepalive_loop, daemon=True).start()
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send({'id': None, 'ok': False, 'error': '无效的JSON请求'})
+                continue
+            # 获取正文的请求可能较慢，放到线程池中并发处理，其余操作直接处理
+            if request.get('op') in ('body', 'bodies'):
+                self._executor.submit(self.handle, request)
+            else:
+                self.handle(request)
+        self._executor.shutdown(wait=True)
+        if self.pool:
+            self.pool.close()
+        for pool in self._account_pools.values():
+            pool.close()
+
+
+def main():
+    """主函数"""
+    sys.stdin = open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False)
+    # 协议只使用原来的标准输出；fd 1 改为指向标准错误，导入代码中的print不会混入协议
+    output = open(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False)
+    pool_size = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_POOL_SIZE
+    IMAPWorker(pool_size, output).serve(sys.stdin)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+# 轻量的分阶段计时/计数和分级日志：关闭时计时器是空操作、日志不做格式化
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+# 日志级别
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARN': 30, 'ERROR': 40}
+# 当前日志级别，调试日志在热点路径上可以先判断DEBUG_ENABLED再拼接参数
+_level = LEVELS['INFO']
+DEBUG_ENABLED = False
+
+# 输出格式：ndjson 每次flush追加一行一个指标；prometheus 每次flush重写文本文件
+FORMATS = ('ndjson', 'prometheus')
+# Prometheus指标名前缀
+METRIC_PREFIX = 'job_emails_'
+# 直方图的桶上界：名称以_bytes结尾的按字节，其余按秒
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+
+_enabled = False
+_format = 'ndjson'
+_path = ''
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_atexit_registered = False
+
+
+def set_level(name):
+    """设置日志级别（DEBUG/INFO/WARN/ERROR，不区分大小写）"""
+    global _level, DEBUG_ENABLED
+    _level = LEVELS.get(str(name).upper(), LEVELS['INFO'])
+    DEBUG_ENABLED = _level <= LEVELS['DEBUG']
+
+
+def _log(level, message, args):
+    if args:
+        message = message % args
+    print(f"[{level}] {message}", file=sys.stderr if level in ('WARN', 'ERROR') else sys.stdout)
+
+
+def debug(message, *args):
+    """调试日志，参数按%格式化，只有级别为DEBUG时才格式化和输出"""
+    if DEBUG_ENABLED:
+        _log('DEBUG', message, args)
+
+
+def warn(message, *args):
+    if _level <= LEVELS['WARN']:
+        _log('WARN', message, args)
+
+
+def error(message, *args):
+    if _level <= LEVELS['ERROR']:
+        _log('ERROR', message, args)
+
+
+def configure(settings=None, enabled=None, path=None, fmt=None, level=None):
+    """按配置（config.json中的metrics段）和命令行参数设置指标输出和日志级别，参数优先于配置
+
+    指定了输出文件时自动开启指标；开启后进程退出时会再flush一次。
+    """
+    global _enabled, _path, _format, _atexit_registered
+    settings = settings or {}
+    _path = path if path is not None else settings.get('path') or ''
+    _format = fmt or settings.get('format') or 'ndjson'
+    if _format not in FORMATS:
+        raise ValueError(f"不支持的指标格式 {_format}，可选: {', '.join(FORMATS)}")
+    _enabled = bool(enabled if enabled is not None else settings.get('enabled') or _path)
+    set_level(level or settings.get('log_level') or 'INFO')
+    if _enabled and not _atexit_registered:
+        atexit.register(flush)
+        _atexit_registered = True
+
+
+def add_arguments(parser):
+    """给命令行脚本添加 --log-level、--metrics、--metrics-format 参数"""
+    parser.add_argument('--log-level', choices=list(LEVELS), type=str.upper,
+                        help='日志级别（默认取config.json中metrics.log_level，未配置时为INFO）')
+    parser.add_argument('--metrics', metavar='PATH', help='开启分阶段指标并写入该文件')
+    parser.add_argument('--metrics-format', choices=FORMATS, help='指标文件格式（默认ndjson）')
+
+
+def configure_from_args(settings, args):
+    """按add_arguments添加的命令行参数覆盖配置"""
+    configure(settings, path=args.metrics, fmt=args.metrics_format, level=args.log_level)
+
+
+def is_enabled():
+    return _enabled
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def count(name, value=1, **labels):
+    """计数器加value"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """直方图记录一个观测值"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            buckets = BYTES_BUCKETS if name.endswith('_bytes') else SECONDS_BUCKETS
+            histogram = _histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1),
+                                            'count': 0, 'sum': 0.0, 'min': value, 'max': value}
+        for i, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][i] += 1
+                break
+        else:
+            histogram['counts'][-1] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['min'] = min(histogram['min'], value)
+        histogram['max'] = max(histogram['max'], value)
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        if exc_type is not None:
+            count(self.name.rsplit('_seconds', 1)[0] + '_errors_total', **self.labels)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def timer(name, **labels):
+    """计时上下文管理器，耗时记入名为name的直方图（秒）；块内抛出异常时 <name>_errors_total 加一
+
+    指标关闭时返回共享的空操作对象。
+    """
+    if not _enabled:
+        return _NOOP_TIMER
+    return _Timer(name, labels)
+
+
+def snapshot():
+    """当前所有指标的副本：{'counters': [...], 'histograms': [...]}"""
+    with _lock:
+        counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(_counters.items())]
+        histograms = [{'name': name, 'labels': dict(labels), 'count': h['count'], 'sum': h['sum'],
+                       'min': h['min'], 'max': h['max'],
+                       'buckets': dict(zip([str(bound) for bound in h['buckets']] + ['+Inf'], h['counts']))}
+                      for (name, labels), h in sorted(_histograms.items())]
+    return {'counters': counters, 'histograms': histograms}
+
+
+def _prometheus_labels(labels, extra=None):
+    items = list(labels.items()) + (list(extra.items()) if extra else [])
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+
+def render_prometheus(data=None):
+    """按Prometheus文本格式输出指标"""
+    data = data or snapshot()
+    lines = []
+    typed = set()
+    for counter in data['counters']:
+        name = METRIC_PREFIX + counter['name']
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f"{name}{_prometheus_labels(counter['labels'])} {counter['value']}")
+    for histogram in data['histograms']:
+        name = METRIC_PREFIX + histogram['name']
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket_count in histogram['buckets'].items():
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_prometheus_labels(histogram['labels'], {'le': bound})} {cumulative}")
+        lines.append(f"{name}_sum{_prometheus_labels(histogram['labels'])} {histogram['sum']}")
+        lines.append(f"{name}_count{_prometheus_labels(histogram['labels'])} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def flush():
+    """把当前指标写入输出文件（未配置文件时不输出）
+
+    ndjson格式追加一批记录，每行一个计数器或直方图，同一次flush的记录ts相同；
+    prometheus格式整体重写文件（先写临时文件再替换，抓取方不会读到半个文件）。
+    """
+    if not _enabled or not _path:
+        return
+    data = snapshot()
+    try:
+        directory = os.path.dirname(os.path.abspath(_path))
+        os.makedirs(directory, exist_ok=True)
+        if _format == 'prometheus':
+            temp_path = f'{_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(render_prometheus(data))
+            os.replace(temp_path, _path)
+            return
+        ts = round(time.time(), 3)
+        with open(_path, 'a', encoding='utf-8') as f:
+            for counter in data['counters']:
+                f.write(json.dumps({'ts': ts, 'pid': os.getpid(), 'type': 'counter', **counter},
+                                   ensure_ascii=False) + '\n')
+            for histogram in data['histograms']:
+                f.write(json.dumps({'ts': ts, 'pid': os.getpid(), 'type': 'histogram', **histogram},
+                                   ensure_ascii=False) + '\n')
+    except OSError as e:
+        warn("写入指标文件 %s 失败: %s", _path, e)
+
+
+def report(limit=15):
+    """按总耗时从高到低打印各阶段的计时，用于查看一次同步的时间花在哪里"""
+    if not _enabled:
+        return
+    timings = [h for h in snapshot()['histograms'] if h['name'].endswith('_seconds')]
+    if not timings:
+        return
+    timings.sort(key=lambda h: h['sum'], reverse=True)
+    print("各阶段耗时:")
+    for h in timings[:limit]:
+        labels = ','.join(f'{name}={value}' for name, value in h['labels'].items())
+        name = f"{h['name']}{{{labels}}}" if labels else h['name']
+        print(f"  {name:<52} 总计 {h['sum']:>9.3f} 秒  次数 {h['count']:>7}  "
+              f"平均 {h['sum'] / h['count'] * 1000:>9.2f} ms  最大 {h['max'] * 1000:>9.2f} ms")
+
+
+def reset():
+    """清空已记录的指标"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
@@ -0,0 +1,347 @@
+import argparse
+import email
+import os
+import sys
+import time
+
+import pymysql
+
+# 导入配置模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script.config as config
+from script.qq_email_imap import (
+    ALL_EMAILS_COLUMNS,
+    EMAIL_LOCATIONS_TABLE_SQL,
+    connect_email_db,
+    connect_to_qq_mail,
+    decode_subject,
+    email_identity_hash,
+    ensure_columns,
+    format_send_date,
+    legacy_account,
+)
+
+# 每次回填的id范围大小，单条UPDATE只锁住这一段，避免长时间阻塞导入和页面查询
+DEFAULT_CHUNK_SIZE = 1000
+# 两次回填之间的停顿（秒），给线上请求让出资源
+DEFAULT_PAUSE = 0.05
+# 通过IMAP补全Message-ID时每次FETCH的邮件数量
+IMAP_FETCH_BATCH_SIZE = 200
+
+# 新增的查询索引（idx_body_hash用于清理没有邮件引用的压缩正文，见 body_store.py）
+NEW_INDEXES = {
+    'idx_send_ts': 'KEY idx_send_ts (send_ts)',
+    'idx_uid': 'KEY idx_uid (uid, uidvalidity)',
+    'idx_account_folder': 'KEY idx_account_folder (account, folder)',
+    'idx_body_hash': 'KEY idx_body_hash (body_hash)',
+}
+UNIQUE_INDEX = ('uniq_message_id_hash', 'UNIQUE KEY uniq_message_id_hash (message_id_hash)')
+# 旧的去重键（Node版本的表还多了delivered列）
+LEGACY_UNIQUE_INDEX = 'unique_email'
+
+# 无Message-ID时的指纹，与 qq_email_imap.email_identity_hash 的算法一致
+FINGERPRINT_SQL = ("UNHEX(MD5(CONCAT_WS(CHAR(31 USING utf8mb4), COALESCE(subject, ''), "
+                   "COALESCE(sender, ''), COALESCE(send_date, ''))))")
+
+# 只转换格式正确的发送时间，避免严格模式下无效日期导致UPDATE失败
+BACKFILL_SQL = f"""
+UPDATE all_emails SET
+    send_ts = IF(send_date REGEXP '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}} [0-9]{{2}}:[0-9]{{2}}:[0-9]{{2}}$',
+                 CAST(send_date AS DATETIME), NULL),
+    uid = IF(imap_id REGEXP '^[0-9]+$', CAST(imap_id AS UNSIGNED), NULL),
+    message_id_hash = {FINGERPRINT_SQL}
+WHERE id >= %s AND id < %s AND message_id_hash IS NULL
+"""
+
+# 旧版本只同步一个账号的收件箱，未记录位置的行归到该账号的INBOX
+LEGACY_LOCATION_SQL = """
+UPDATE all_emails SET account = %s, folder = 'INBOX'
+WHERE id >= %s AND id < %s AND account IS NULL AND orphaned_at IS NULL
+"""
+
+# 每行第一个位置写入email_locations（之后入库的位置由 qq_email_imap.record_locations 记录）
+LOCATIONS_SQL = """
+INSERT INTO email_locations (account, folder, uidvalidity, uid, message_id_hash)
+SELECT account, folder, uidvalidity, uid, message_id_hash FROM all_emails
+WHERE id >= %s AND id < %s AND account IS NOT NULL AND folder IS NOT NULL
+    AND uidvalidity IS NOT NULL AND uid IS NOT NULL AND message_id_hash IS NOT NULL
+ON DUPLICATE KEY UPDATE message_id_hash = VALUES(message_id_hash)
+"""
+
+
+def get_indexes(cursor, table):
+    """返回表上已有的索引名"""
+    cursor.execute(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def alter_online(cursor, statement):
+    """优先以在线DDL（不锁表）执行ALTER TABLE，服务器不支持时退回普通ALTER"""
+    try:
+        cursor.execute(f"{statement}, ALGORITHM=INPLACE, LOCK=NONE")
+    except pymysql.err.IntegrityError:
+        raise
+    except pymysql.err.MySQLError as e:
+        print(f"在线DDL不可用，改为普通ALTER: {e}")
+        cursor.execute(statement)
+
+
+def backfill(cursor, chunk_size, pause):
+    """按id范围分段回填 send_ts、uid 和 message_id_hash，返回回填的行数"""
+    cursor.execute("SELECT MIN(id), MAX(id) FROM all_emails WHERE message_id_hash IS NULL")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        print("没有需要回填的行")
+        return 0
+    total = 0
+    started = time.monotonic()
+    for start in range(min_id, max_id + 1, chunk_size):
+        cursor.execute(BACKFILL_SQL, (start, start + chunk_size))
+        total += cursor.rowcount
+        print(f"已回填 {total} 行 (id < {start + chunk_size}/{max_id + 1}, "
+              f"{total / max(time.monotonic() - started, 1e-6):.0f} 行/秒)")
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+def backfill_locations(cursor, account, chunk_size, pause):
+    """按id范围分段为旧行补上账号和文件夹，并把每行的位置写入email_locations，返回补上账号的行数
+
+    account为None时只写入已有位置的行。
+    """
+    cursor.execute(EMAIL_LOCATIONS_TABLE_SQL)
+    cursor.execute("SELECT MIN(id), MAX(id) FROM all_emails")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return 0
+    total = 0
+    for start in range(min_id, max_id + 1, chunk_size):
+        if account:
+            cursor.execute(LEGACY_LOCATION_SQL, (account, start, start + chunk_size))
+            total += cursor.rowcount
+        cursor.execute(LOCATIONS_SQL, (start, start + chunk_size))
+        if pause:
+            time.sleep(pause)
+    print(f"已为 {total} 行旧邮件补上账号 {account} 的收件箱位置")
+    return total
+
+
+def _legacy_matches(row, headers, internaldate):
+    """IMAP上当前UID对应的邮件是否就是数据库中的这封邮件"""
+    _, _, subject, sender, send_date = row
+    if decode_subject(headers.get('Subject', '')) != (subject or ''):
+        return False
+    if headers.get('From', '') != (sender or ''):
+        return False
+    raw_date = headers.get('Date', '')
+    return (send_date or '') in (format_send_date(raw_date), format_send_date(raw_date, internaldate))
+
+
+def upgrade_message_ids(cursor, email_addr, password, imap_server, chunk_size, pause):
+    """通过IMAP为历史邮件补全Message-ID和UIDVALIDITY
+
+    历史数据没有保存Message-ID，回填时只能用指纹作为去重键；之后重新导入同一封邮件时
+    会得到基于Message-ID的键。这里按UID取回邮件头，确认主题、发件人和时间一致后
+    把去重键换成Message-ID的哈希。UID已经对应到别的邮件（UIDVALIDITY变化过）的行保持不变。
+
+    Returns:
+        int: 更新的行数
+    """
+    client = connect_to_qq_mail(email_addr, password, imap_server)
+    updated = 0
+    try:
+        uidvalidity = client.select_folder('INBOX', readonly=True).get(b'UIDVALIDITY')
+        last_id = 0
+        while True:
+            cursor.execute(
+                "SELECT id, uid, subject, sender, send_date FROM all_emails "
+                "WHERE id > %s AND uidvalidity IS NULL AND uid IS NOT NULL ORDER BY id LIMIT %s",
+                (last_id, chunk_size)
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            by_uid = {row[1]: row for row in rows}
+            updates = []
+            uids = sorted(by_uid)
+            for i in range(0, len(uids), IMAP_FETCH_BATCH_SIZE):
+                batch = uids[i:i+IMAP_FETCH_BATCH_SIZE]
+                fetched = client.fetch(batch, ['BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE MESSAGE-ID)]',
+                                               'INTERNALDATE'])
+                for uid, data in fetched.items():
+                    row = by_uid.get(uid)
+                    header_bytes = next((v for k, v in data.items()
+                                         if isinstance(k, bytes) and k.upper().startswith(b'BODY[HEADER')), b'')
+                    headers = email.message_from_bytes(header_bytes or b'')
+                    message_id = headers.get('Message-ID', '')
+                    if row is None or not message_id.strip():
+                        continue
+                    if not _legacy_matches(row, headers, data.get(b'INTERNALDATE')):
+                        continue
+                    updates.append((email_identity_hash({'message_id': message_id}), uidvalidity, row[0]))
+            if updates:
+                try:
+                    cursor.executemany(
+                        "UPDATE all_emails SET message_id_hash = %s, uidvalidity = %s WHERE id = %s", updates
+                    )
+                    updated += len(updates)
+                except pymysql.err.IntegrityError as e:
+                    # 已建唯一键且同一Message-ID已存在时逐行更新，跳过冲突的行
+                    print(f"批量更新Message-ID冲突，改为逐行更新: {e}")
+                    for update in updates:
+                        try:
+                            cursor.execute(
+                                "UPDATE all_emails SET message_id_hash = %s, uidvalidity = %s WHERE id = %s", update
+                            )
+                            updated += 1
+                        except pymysql.err.IntegrityError:
+                            pass
+            print(f"已通过IMAP补全 {updated} 封邮件的Message-ID (id <= {last_id})")
+            if pause:
+                time.sleep(pause)
+    finally:
+        try:
+            client.logout()
+        except Exception:
+            pass
+    return updated
+
+
+def merge_duplicates(cursor, delivery_database, dry_run=False):
+    """合并去重键相同的行：保留id最小的一行，投递标记取并集，投递记录改为指向保留的行
+
+    Returns:
+        int: 删除的重复行数
+    """
+    cursor.execute(
+        "SELECT message_id_hash, MIN(id), MAX(delivered), GROUP_CONCAT(id) FROM all_emails "
+        "WHERE message_id_hash IS NOT NULL GROUP BY message_id_hash HAVING COUNT(*) > 1"
+    )
+    groups = cursor.fetchall()
+    removed = 0
+    for _, keep_id, delivered, ids in groups:
+        duplicate_ids = [int(i) for i in ids.split(',') if int(i) != keep_id]
+        removed += len(duplicate_ids)
+        if dry_run:
+            print(f"[dry-run] 保留 id={keep_id}，删除重复的 {duplicate_ids}")
+            continue
+        placeholders = ','.join(['%s'] * len(duplicate_ids))
+        cursor.connection.begin()
+        try:
+            cursor.execute("UPDATE all_emails SET delivered = %s WHERE id = %s", (delivered, keep_id))
+            try:
+                cursor.execute(
+                    f"UPDATE `{delivery_database}`.deliveries SET email_id = %s WHERE email_id IN ({placeholders})",
+                    [keep_id] + duplicate_ids
+                )
+            except pymysql.err.ProgrammingError:
+                # 投递记录表还不存在
+                pass
+            cursor.execute(f"DELETE FROM all_emails WHERE id IN ({placeholders})", duplicate_ids)
+            cursor.connection.commit()
+        except Exception:
+            cursor.connection.rollback()
+            raise
+    if groups:
+        print(f"{'[dry-run] ' if dry_run else ''}合并了 {len(groups)} 组重复邮件，删除 {removed} 行")
+    return removed
+
+
+def migrate(db_config, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_PAUSE, imap_account=None,
+            delivery_database='job_deliveries', dry_run=False, location_account=None):
+    """把all_emails迁移到以message_id_hash为去重键的结构，可重复执行
+
+    步骤：补列 → 分段回填 → （可选）通过IMAP补全Message-ID → 建查询索引
+    → 合并重复行 → 建唯一键并删除旧的前缀唯一键 → 旧行补上账号、文件夹（location_account的收件箱）并记录位置。
+    """
+    with connect_email_db(db_config) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW TABLES LIKE 'all_emails'")
+            if not cursor.fetchone():
+                print("all_emails 表不存在，无需迁移")
+                return
+            if dry_run:
+                cursor.execute("SELECT COUNT(*) FROM all_emails WHERE message_id_hash IS NULL")
+                print(f"[dry-run] 需要回填 {cursor.fetchone()[0]} 行")
+                merge_duplicates(cursor, delivery_database, dry_run=True)
+                return
+
+            print("1/6 检查新增列...")
+            ensure_columns(cursor, 'all_emails', ALL_EMAILS_COLUMNS)
+
+            print("2/6 分段回填 send_ts、uid、message_id_hash...")
+            backfill(cursor, chunk_size, pause)
+
+            if imap_account:
+                print("   通过IMAP补全历史邮件的Message-ID...")
+                upgrade_message_ids(cursor, *imap_account, chunk_size, pause)
+
+            print("3/6 创建查询索引...")
+            indexes = get_indexes(cursor, 'all_emails')
+            for name, definition in NEW_INDEXES.items():
+                if name not in indexes:
+                    print(f"   创建索引 {name}")
+                    alter_online(cursor, f"ALTER TABLE all_emails ADD {definition}")
+
+            print("4/6 合并重复邮件...")
+            # 回填期间新导入的旧格式行在这里补齐，避免唯一键冲突
+            backfill(cursor, chunk_size, 0)
+            merge_duplicates(cursor, delivery_database)
+
+            print("5/6 切换唯一键...")
+            name, definition = UNIQUE_INDEX
+            if name not in indexes:
+                try:
+                    alter_online(cursor, f"ALTER TABLE all_emails ADD {definition}")
+                except pymysql.err.IntegrityError as e:
+                    print(f"创建唯一键失败，迁移期间有新的重复邮件写入，请重新运行: {e}", file=sys.stderr)
+                    sys.exit(1)
+            if LEGACY_UNIQUE_INDEX in indexes:
+                print(f"   删除旧的唯一键 {LEGACY_UNIQUE_INDEX}")
+                alter_online(cursor, f"ALTER TABLE all_emails DROP INDEX {LEGACY_UNIQUE_INDEX}")
+
+            print("6/6 补全旧邮件的账号、文件夹并记录位置...")
+            backfill_locations(cursor, location_account, chunk_size, pause)
+            print("迁移完成")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='迁移 all_emails 表：新的去重键、发送时间索引和UID列')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='每次回填的id范围大小')
+    parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE, help='每段回填之间的停顿（秒）')
+    parser.add_argument('--imap', action='store_true',
+                        help='使用配置中的邮箱账号，通过IMAP为历史邮件补全Message-ID')
+    parser.add_argument('--dry-run', action='store_true', help='只统计需要回填和合并的行，不修改数据')
+    args = parser.parse_args()
+
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+    imap_account = None
+    if args.imap:
+        imap_account = (config.config['email']['address'], config.config['email']['password'],
+                        config.config['email']['imap_server'])
+        if not all(imap_account):
+            print("配置中缺少邮箱账号信息，无法使用 --imap", file=sys.stderr)
+            sys.exit(1)
+    try:
+        migrate(db_config, args.chunk_size, args.pause, imap_account, dry_run=args.dry_run,
+                location_account=legacy_account())
+    except Exception as e:
+        print(f"迁移失败: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
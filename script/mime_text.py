@@ -0,0 +1,282 @@
+# 邮件正文提取：qq_email_imap.py 和 get_email_body_by_id.py 共用
+import base64
+import binascii
+import codecs
+import email.utils
+import quopri
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from html import unescape
+
+# 未声明字符集时依次尝试的编码（gb2312是gbk的子集，无需单独尝试）
+FALLBACK_ENCODINGS = ('utf-8', 'gbk', 'latin1')
+# 增量解码时每次处理的字节数
+DECODE_CHUNK_SIZE = 16 * 1024
+# 单个字符最多占用的字节数，用于估算截断时需要解码的字节范围
+MAX_BYTES_PER_CHAR = 4
+# HTML源码长度与可见文本长度之比的估算上限
+HTML_EXPANSION = 8
+
+# 常见的错误字符集声明，统一映射到兼容的超集
+CHARSET_ALIASES = {
+    'gb2312': 'gbk',
+    'gb_2312-80': 'gbk',
+    'x-gbk': 'gbk',
+    'ks_c_5601-1987': 'cp949',
+    'unicode-1-1-utf-7': 'utf-7',
+}
+
+# 发件人域名 -> 该域名邮件上次声明的字符集（只记录声明过的字符集，不记录猜测的结果），
+# 最多记住 DOMAIN_CHARSET_CACHE_SIZE 个域名，超出时淘汰最久未用的域名，长期运行的进程内存不会一直增长
+DOMAIN_CHARSET_CACHE_SIZE = 4096
+_domain_charsets = OrderedDict()
+_domain_charsets_lock = threading.Lock()
+# 任何字节串都能解码成功的编码，不能作为域名的缓存结果
+_CATCH_ALL_ENCODINGS = ('iso8859-1',)
+
+
+def _remember_domain_charset(domain, encoding):
+    with _domain_charsets_lock:
+        _domain_charsets[domain] = encoding
+        _domain_charsets.move_to_end(domain)
+        if len(_domain_charsets) > DOMAIN_CHARSET_CACHE_SIZE:
+            _domain_charsets.popitem(last=False)
+
+
+def _domain_charset(domain):
+    with _domain_charsets_lock:
+        encoding = _domain_charsets.get(domain)
+        if encoding:
+            _domain_charsets.move_to_end(domain)
+        return encoding
+
+
+@lru_cache(maxsize=64)
+def _lookup_codec(charset):
+    """解析字符集名称，无法识别时返回None"""
+    charset = charset.strip().strip('"').lower()
+    charset = CHARSET_ALIASES.get(charset, charset)
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def sender_domain(sender):
+    """从发件人地址中提取域名"""
+    if not sender:
+        return None
+    address = email.utils.parseaddr(sender)[1]
+    if '@' not in address:
+        return None
+    return address.rsplit('@', 1)[1].lower()
+
+
+def _decode_prefix(payload, encoding, errors, limit, final=True):
+    """增量解码payload，解码出limit个字符后停止；limit为None时解码全部
+
+    final为False时末尾不完整的字符（内容被截断时）留在解码器中丢弃，不会按错误处理。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    if limit is None:
+        return decoder.decode(payload, final=final)
+    pieces = []
+    decoded_len = 0
+    view = memoryview(payload)
+    for start in range(0, len(view), DECODE_CHUNK_SIZE):
+        end = start + DECODE_CHUNK_SIZE
+        piece = decoder.decode(view[start:end], final=final and end >= len(view))
+        pieces.append(piece)
+        decoded_len += len(piece)
+        if decoded_len >= limit:
+            break
+    return ''.join(pieces)[:limit]
+
+
+def decode_payload(payload, charset=None, limit=None, domain=None):
+    """解码邮件内容
+
+    Args:
+        payload (bytes): 传输解码后的邮件内容
+        charset (str, optional): 邮件声明的字符集
+        limit (int, optional): 最多需要的字符数，超出部分不解码
+        domain (str, optional): 发件人域名，用于记住该域名声明过的字符集，供未声明字符集的邮件参考
+
+    Returns:
+        str: 解码后的文本
+    """
+    if not payload:
+        return ""
+    if limit is not None:
+        # 截断时先限制字节范围，最后一个字符不完整时由增量解码器保留，不会报错
+        payload = payload[:limit * MAX_BYTES_PER_CHAR]
+
+    if charset:
+        encoding = _lookup_codec(charset)
+        if encoding:
+            if domain and encoding not in _CATCH_ALL_ENCODINGS:
+                _remember_domain_charset(domain, encoding)
+            return _decode_prefix(payload, encoding, 'ignore', limit)
+
+    # 严格的UTF-8最先尝试（误判的可能性最小），其次是该域名声明过的字符集；
+    # 内容可能被截断在字符中间，末尾不完整的字节不算解码失败
+    candidates = FALLBACK_ENCODINGS
+    cached = _domain_charset(domain) if domain else None
+    if cached and cached != 'utf-8':
+        candidates = ('utf-8', cached) + tuple(e for e in FALLBACK_ENCODINGS if e not in ('utf-8', cached))
+    for encoding in candidates:
+        try:
+            return _decode_prefix(payload, encoding, 'strict', limit, final=False)
+        except UnicodeDecodeError:
+            continue
+    return _decode_prefix(payload, 'utf-8', 'ignore', limit)
+
+
+# 单遍扫描HTML的词法规则：注释、需要整体丢弃的元素（连同内容；部分获取的内容在元素中间截断时丢弃到末尾）、
+# 块级标签（替换为空格）、其他标签（直接去掉）
+_SKIP_TAGS = 'script|style|head|title|noscript|template'
+_BLOCK_TAGS = ('br|p|div|tr|td|th|li|ul|ol|table|section|article|header|footer|'
+               'h[1-6]|blockquote|hr')
+_HTML_TOKEN_RE = re.compile(
+    r'<!--.*?(?:-->|\Z)|<(%s)\b[^>]*>.*?(?:</\1\s*>|\Z)|<(/?(?:%s)\b)?[^>]*>' % (_SKIP_TAGS, _BLOCK_TAGS),
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def _replace_token(match):
+    return ' ' if match.group(2) else ''
+
+
+def _convert_html(html):
+    text = _HTML_TOKEN_RE.sub(_replace_token, html)
+    if '&' in text:
+        text = unescape(text)
+    # str.split() 按Unicode空白切分（包括&nbsp;解码出的\xa0），比正则替换快得多
+    return ' '.join(text.split())
+
+
+def html_to_text(html, limit=None):
+    """将HTML转换为压缩空白后的纯文本
+
+    Args:
+        html (str): HTML内容
+        limit (int, optional): 最多需要的字符数，只转换足够产生limit个字符的前缀
+
+    Returns:
+        str: 纯文本
+    """
+    if limit is None:
+        return _convert_html(html)
+    size = limit * 2
+    while True:
+        chunk = html[:size]
+        if size < len(html):
+            # 在最后一个完整标签处截断，避免把半个标签当作文本
+            cut = chunk.rfind('>')
+            if cut > 0:
+                chunk = chunk[:cut + 1]
+        text = _convert_html(chunk)
+        if len(text) >= limit or size >= len(html):
+            return text[:limit]
+        size *= 2
+
+
+def decode_partial_payload(payload, encoding):
+    """解码可能被截断的传输编码内容"""
+    if encoding == 'base64':
+        data = b''.join(payload.split())
+        data = data[:len(data) - len(data) % 4]
+        try:
+            return base64.b64decode(data)
+        except (binascii.Error, ValueError):
+            return b''
+    if encoding == 'quoted-printable':
+        # 去掉被截断的转义序列，避免解码出错误字节
+        tail = payload[-2:]
+        if b'=' in tail:
+            payload = payload[:len(payload) - 2 + tail.index(b'=')]
+        return quopri.decodestring(payload)
+    return payload
+
+
+def _raw_limit(subtype, limit, html_as_text):
+    """估算凑够limit个字符需要的字节数"""
+    if limit is None:
+        return None
+    if subtype == 'html' and html_as_text:
+        # HTML标签会在转换时去掉，需要解码更多内容才能凑够limit个可见字符
+        return limit * HTML_EXPANSION * MAX_BYTES_PER_CHAR
+    return limit * MAX_BYTES_PER_CHAR
+
+
+def _part_payload(part, max_bytes):
+    """取出MIME部分的内容；指定max_bytes时只做前缀的传输解码"""
+    if max_bytes is None:
+        return part.get_payload(decode=True)
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    if encoding not in ('base64', 'quoted-printable'):
+        payload = part.get_payload(decode=True)
+        return payload[:max_bytes] if payload else payload
+    encoded = part.get_payload(decode=False)
+    if isinstance(encoded, str):
+        encoded = encoded.encode('ascii', errors='ignore')
+    # base64每4个字符对应3个字节，quoted-printable最坏每3个字符对应1个字节，另外留出换行的余量
+    factor = 2 if encoding == 'base64' else 4
+    if len(encoded) <= max_bytes * factor:
+        return part.get_payload(decode=True)
+    return decode_partial_payload(encoded[:max_bytes * factor], encoding)
+
+
+def extract_text_part(payload, charset, subtype, limit=None, domain=None, html_as_text=True):
+    """解码单个text/plain或text/html部分"""
+    if subtype == 'html' and html_as_text:
+        raw_limit = None if limit is None else limit * HTML_EXPANSION
+        return html_to_text(decode_payload(payload, charset, raw_limit, domain), limit)
+    return decode_payload(payload, charset, limit, domain)
+
+
+def extract_body(msg, limit=None, html_as_text=True):
+    """获取邮件正文内容
+
+    跳过附件，优先使用第一个text/plain部分，否则使用最后一个text/html部分。
+
+    Args:
+        msg (email.message.Message): 邮件消息对象
+        limit (int, optional): 最多需要的字符数；需要判断是否被截断时可传入limit + 1
+        html_as_text (bool): 是否把HTML正文转换为纯文本
+
+    Returns:
+        str: 邮件正文内容
+    """
+    domain = sender_domain(msg.get('From', ''))
+    body = ""
+    if msg.is_multipart():
+        for part in msg.walk():
+            if "attachment" in str(part.get("Content-Disposition", "")):
+                continue
+            if part.get_content_maintype() != 'text':
+                continue
+            subtype = part.get_content_subtype()
+            if subtype not in ('plain', 'html'):
+                continue
+            try:
+                payload = _part_payload(part, _raw_limit(subtype, limit, html_as_text))
+                body = extract_text_part(payload, part.get_content_charset(),
+                                         subtype, limit, domain, html_as_text)
+            except Exception as e:
+                print(f"解码邮件内容时出错: {e}")
+                continue
+            if subtype == 'plain':
+                break
+    else:
+        try:
+            subtype = msg.get_content_subtype()
+            payload = _part_payload(msg, _raw_limit(subtype, limit, html_as_text))
+            body = extract_text_part(payload, msg.get_content_charset(),
+                                     subtype, limit, domain, html_as_text)
+        except Exception as e:
+            print(f"解码单部分邮件内容时出错: {e}")
+            body = ""
+    return body
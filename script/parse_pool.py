@@ -0,0 +1,146 @@
+# 多进程邮件解析池：原始邮件写入共享内存，子进程直接在共享内存上解析，只传回精简的解析结果
+import os
+import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 每个槽位的大小，超过的邮件单独分配一块共享内存
+DEFAULT_SLOT_SIZE = 512 * 1024
+# 每个子进程任务解析的邮件数：太小时进程间通信开销占比高，太大时并行度不够
+CHUNK_SIZE = 8
+# 每个解析进程对应的槽位数，槽位用完时提交方等待，在途的原始邮件总量因此有上限
+SLOTS_PER_WORKER = 2 * CHUNK_SIZE
+
+# 子进程中挂载的共享内存区
+_arena = None
+
+
+def _init_worker(arena_name):
+    global _arena
+    _arena = shared_memory.SharedMemory(name=arena_name)
+
+
+def _parse_refs(refs):
+    """在子进程中解析一组邮件，refs为 [(msg_id, 单独的共享内存名或None, 偏移, 长度)]"""
+    from script.qq_email_imap import parse_email_message
+
+    records = []
+    for msg_id, segment_name, offset, length in refs:
+        segment = shared_memory.SharedMemory(name=segment_name) if segment_name else None
+        view = (segment or _arena).buf[offset:offset + length]
+        try:
+            records.append(parse_email_message(msg_id, view))
+        finally:
+            view.release()
+            if segment:
+                segment.close()
+    return records
+
+
+class ParsePool:
+    """把原始RFC822邮件交给进程池解析
+
+    父进程只把邮件字节复制一次到共享内存槽位，任务参数只有槽位位置，不序列化邮件内容；
+    子进程在共享内存的memoryview上解析，返回与parse_email_message相同的记录（正文已截断）。
+    槽位数固定，全部占用时submit阻塞直到有任务完成，内存占用与邮箱大小无关。
+    可以被多个线程同时使用。
+    """
+
+    def __init__(self, workers=None, slot_size=DEFAULT_SLOT_SIZE, slots=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.slot_size = slot_size
+        self.slots = max(CHUNK_SIZE, slots or self.workers * SLOTS_PER_WORKER)
+        self._arena = shared_memory.SharedMemory(create=True, size=self.slot_size * self.slots)
+        self._free = list(range(self.slots))
+        self._available = threading.Condition()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(self._arena.name,))
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _acquire(self, count):
+        with self._available:
+            while len(self._free) < count:
+                self._available.wait()
+            taken, self._free = self._free[:count], self._free[count:]
+        return taken
+
+    def _release(self, slots, segments):
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+        with self._available:
+            self._free.extend(slots)
+            self._available.notify_all()
+
+    def _submit_chunk(self, chunk):
+        slots = self._acquire(len(chunk))
+        refs = []
+        segments = []
+        for slot, (msg_id, raw) in zip(slots, chunk):
+            size = len(raw)
+            if size > self.slot_size:
+                segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+                segment.buf[:size] = raw
+                segments.append(segment)
+                refs.append((msg_id, segment.name, 0, size))
+            else:
+                offset = slot * self.slot_size
+                self._arena.buf[offset:offset + size] = raw
+                refs.append((msg_id, None, offset, size))
+        try:
+            future = self._executor.submit(_parse_refs, refs)
+        except BaseException:
+            self._release(slots, segments)
+            raise
+        # 子进程解析完成后槽位才能复用
+        future.add_done_callback(lambda _: self._release(slots, segments))
+        return future
+
+    def submit(self, items):
+        """提交一批 (msg_id, 原始邮件)，返回Future，结果为按输入顺序排列的解析记录
+
+        任一邮件解析失败时Future以该异常结束（与逐封解析时整批失败的行为一致）。
+        """
+        items = list(items)
+        result = Future()
+        if not items:
+            result.set_result([])
+            return result
+        chunks = [self._submit_chunk(items[i:i + CHUNK_SIZE]) for i in range(0, len(items), CHUNK_SIZE)]
+        remaining = [len(chunks)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                result.set_result([record for chunk in chunks for record in chunk.result()])
+            except BaseException as e:
+                result.set_exception(e)
+
+        for chunk in chunks:
+            chunk.add_done_callback(on_done)
+        return result
+
+    def parse(self, items):
+        """同步解析一批 (msg_id, 原始邮件)，返回解析记录列表"""
+        return self.submit(items).result()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._arena.close()
+        self._arena.unlink()
@@ -4,31 +4,49 @@ from email.header import decode_header
 import datetime
 import sys
 import os
-from imapclient import IMAPClient
 import ssl
-import logging
-import io
+import argparse
+import hashlib
+import itertools
+import tempfile
+import signal
+import json
+import threading
+import time
 import email.utils
+from email.parser import BytesHeaderParser
 
 # 导入配置模块
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import script.config as config
+from script.mime_text import decode_partial_payload, extract_body, extract_text_part, sender_domain
+from script.raw_cache import open_cache
+from script.imap_budget import BudgetedIMAPClient
+from script.search_index import ensure_search_tables, index_emails
+from script.body_store import BODY_TABLE_COLUMNS, ensure_body_tables, get_store as get_body_store
+from script.email_classifier import classify_emails, ensure_classification_tables
+from script.analytics_rollup import add_email_days, ensure_rollup_tables
+from script.adaptive_batch import (AdaptiveBatcher, WriteBuffer, email_bytes, fetch_message_sizes,
+                                   is_connection_error)
+from script import metrics
 
-# 配置日志
-# logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', encoding='utf-8')
-# logger = logging.getLogger(__name__)
+# 日志级别和指标输出（config.json中的metrics段，命令行参数可覆盖）
+metrics.configure(config.config.get('metrics'))
 
-# 设置标准输出编码为UTF-8
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+# 设置标准输出编码为UTF-8（原地修改编码，不再另包一层TextIOWrapper）
+if hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(encoding='utf-8')
 
 def connect_to_qq_mail(email, password, imap_server):
-    """连接到邮箱并登录"""
+    """连接到邮箱并登录，占用该账号的一个连接名额（见 imap_budget.py），logout时归还"""
     try:
         # 创建一个安全的SSL连接
-        client = IMAPClient(imap_server, ssl=True, ssl_context=ssl.create_default_context())
+        with metrics.timer('imap_connect_seconds'):
+            client = BudgetedIMAPClient(imap_server, ssl=True, ssl_context=ssl.create_default_context())
         
         # 使用邮箱地址和授权码登录
-        client.login(email, password)
+        with metrics.timer('imap_login_seconds'):
+            client.login(email, password)
         
         print(f"成功连接并登录邮箱: {email}")
         return client
@@ -36,55 +54,103 @@ def connect_to_qq_mail(email, password, imap_server):
         print(f"连接邮箱失败: {e}")
         raise
 
-def get_email_body(msg):
-    """获取邮件正文内容"""
-    def decode_content(payload, charset=None):
-        if not payload:
-            return ""
-        if charset:
-            try:
-                return payload.decode(charset, errors='ignore')
-            except:
-                pass
-        for encoding in ['utf-8', 'gbk', 'gb2312', 'latin1']:
-            try:
-                return payload.decode(encoding)
-            except UnicodeDecodeError:
-                continue
-        return payload.decode('utf-8', errors='ignore')
+SYNC_STATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS email_sync_state (
+    account VARCHAR(255) NOT NULL,
+    folder VARCHAR(255) NOT NULL,
+    uidvalidity BIGINT UNSIGNED DEFAULT NULL,
+    uidnext BIGINT UNSIGNED DEFAULT NULL,
+    last_uid BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    highest_modseq BIGINT UNSIGNED DEFAULT NULL,
+    reconciled_uidvalidity BIGINT UNSIGNED DEFAULT NULL,
+    reconciled_modseq BIGINT UNSIGNED DEFAULT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (account, folder)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# 旧版本建的同步状态表缺少的列（对账位置，见 reconcile.py）
+SYNC_STATE_COLUMNS = {
+    'reconciled_uidvalidity': 'BIGINT UNSIGNED DEFAULT NULL',
+    'reconciled_modseq': 'BIGINT UNSIGNED DEFAULT NULL',
+}
+
+def load_sync_state(db_config, account, folder='INBOX'):
+    """读取邮箱文件夹的同步状态（UIDVALIDITY、已同步的最大UID等）
     
-    body = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            if "attachment" in str(part.get("Content-Disposition", "")):
-                continue
-            content_type = part.get_content_type()
-            if content_type in ["text/plain", "text/html"]:
-                try:
-                    decoded = decode_content(part.get_payload(decode=True), part.get_content_charset())
-                    if content_type == "text/html":
-                        import re
-                        decoded = re.sub(r'<[^>]+>', '', decoded).strip()
-                        decoded = re.sub(r'\s+', ' ', decoded)
-                    body = decoded
-                    if content_type == "text/plain":
-                        break
-                except Exception as e:
-                    print(f"解码邮件内容时出错: {e}")
-                    continue
-    else:
-        try:
-            body = decode_content(msg.get_payload(decode=True), msg.get_content_charset())
-        except Exception as e:
-            print(f"解码单部分邮件内容时出错: {e}")
-            body = ""
+    读取失败时返回一个空状态，此时本次同步会退化为全量同步。
+    """
+    state = {
+        'account': account,
+        'folder': folder,
+        'uidvalidity': None,
+        'uidnext': None,
+        'last_uid': 0,
+        'highest_modseq': None
+    }
+    try:
+        with pymysql.connect(
+            host=db_config['host'],
+            user=db_config['user'],
+            password=db_config['password'],
+            database=db_config['database'],
+            charset=db_config['charset'],
+            autocommit=True
+        ) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(SYNC_STATE_TABLE_SQL)
+                cursor.execute(
+                    "SELECT uidvalidity, uidnext, last_uid, highest_modseq FROM email_sync_state "
+                    "WHERE account = %s AND folder = %s",
+                    (account, folder)
+                )
+                row = cursor.fetchone()
+                if row:
+                    state['uidvalidity'], state['uidnext'], state['last_uid'], state['highest_modseq'] = row
+                    state['last_uid'] = state['last_uid'] or 0
+        metrics.debug("同步状态: UIDVALIDITY=%s, 最大UID=%s, HIGHESTMODSEQ=%s",
+                      state['uidvalidity'], state['last_uid'], state['highest_modseq'])
+    except Exception as e:
+        metrics.warn("读取同步状态失败，将执行全量同步: %s", e)
+    return state
+
+def write_sync_state(cursor, sync_state):
+    """在已有的数据库游标上写入同步状态（表需已存在，避免DDL隐式提交当前事务）
     
-    return body[:10000] + "..." if len(body) > 10000 else body
+    UIDVALIDITY不变时同步位置只前进不后退，监听进程和手动获取同时运行时不会互相覆盖。
+    """
+    # last_uid必须在uidvalidity之前赋值，比较的才是旧的uidvalidity
+    cursor.execute("""
+    INSERT INTO email_sync_state (account, folder, uidvalidity, uidnext, last_uid, highest_modseq)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+    last_uid=IF(uidvalidity <=> VALUES(uidvalidity), GREATEST(last_uid, VALUES(last_uid)), VALUES(last_uid)),
+    uidvalidity=VALUES(uidvalidity), uidnext=VALUES(uidnext), highest_modseq=VALUES(highest_modseq)
+    """, (sync_state['account'], sync_state['folder'], sync_state['uidvalidity'],
+          sync_state['uidnext'], sync_state['last_uid'], sync_state['highest_modseq']))
+    metrics.debug("同步状态已保存: 最大UID=%s", sync_state['last_uid'])
+
+def legacy_account():
+    """迁移前入库、未记录账号的旧行所属的账号：单账号配置（email）的地址，未配置时取accounts中的第一个"""
+    address = config.config['email'].get('address')
+    if not address:
+        accounts = config.get_accounts()
+        address = accounts[0]['address'] if accounts else None
+    return address
 
-def save_emails_to_database(emails, db_config):
-    """将邮件保存到数据库"""
+def get_known_uids(db_config, uids, uidvalidity=None, account=None, folder=None):
+    """查询数据库中已经保存过的UID，用于按日期范围同步时跳过已下载的邮件
+    
+    只匹配当前UIDVALIDITY下的UID；迁移前入库、UIDVALIDITY未知的行也视为已保存。
+    指定account时只匹配该账号该文件夹的UID（不同文件夹的UID会重复）：同一封邮件在每个文件夹中的位置
+    记录在email_locations中，对账标记为孤儿的邮件不算已保存（需要重新入库以迁移位置）；
+    未记录账号的旧行只在旧版本同步的账号（legacy_account）的收件箱中视为已保存。
+    """
+    known = set()
+    if not uids:
+        return known
+    legacy = account is not None and account == legacy_account() and folder == 'INBOX'
     try:
-        print(f"[DEBUG] 尝试连接数据库: {db_config['database']}")
         with pymysql.connect(
             host=db_config['host'],
             user=db_config['user'],
@@ -93,171 +159,1104 @@ def save_emails_to_database(emails, db_config):
             charset=db_config['charset'],
             autocommit=True
         ) as connection:
-            print("[DEBUG] 数据库连接成功")
             with connection.cursor() as cursor:
-                print("[DEBUG] 创建/检查邮件表...")
-                cursor.execute("""
-                CREATE TABLE IF NOT EXISTS all_emails (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    imap_id VARCHAR(255),
-                    subject TEXT,
-                    sender TEXT,
-                    recipient TEXT,
-                    send_date TEXT,
-                    body LONGTEXT,
-                    delivered BOOLEAN DEFAULT FALSE,
-                    UNIQUE KEY unique_email (imap_id, subject(50), sender(50), send_date(50))
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-                """)
-                print("[DEBUG] 邮件表创建/检查完成")
+                uids = list(uids)
+                chunk_size = 1000
+                for i in range(0, len(uids), chunk_size):
+                    chunk = uids[i:i+chunk_size]
+                    placeholders = ','.join(['%s'] * len(chunk))
+                    # 走 idx_uid 索引
+                    sql = (f"SELECT DISTINCT uid FROM all_emails WHERE uid IN ({placeholders}) "
+                           "AND (uidvalidity = %s OR uidvalidity IS NULL)")
+                    params = chunk + [uidvalidity]
+                    if account is not None:
+                        sql += " AND ((account = %s AND folder = %s)" + (" OR account IS NULL)" if legacy else ")")
+                        params += [account, folder]
+                        # 邮件的第一个位置之外的文件夹，走 email_locations 主键
+                        sql += (" UNION SELECT l.uid FROM email_locations l "
+                                "JOIN all_emails a ON a.message_id_hash = l.message_id_hash AND a.orphaned_at IS NULL "
+                                f"WHERE l.account = %s AND l.folder = %s AND l.uidvalidity = %s AND l.uid IN ({placeholders})")
+                        params += [account, folder, uidvalidity] + chunk
+                    cursor.execute(sql, params)
+                    known.update(int(row[0]) for row in cursor.fetchall())
+    except Exception as e:
+        metrics.warn("查询已保存的UID失败，将重新下载: %s", e)
+    return known
+
+def select_folder_for_sync(client, folder, sync_state):
+    """选择文件夹，并根据同步状态判断是否需要全量重新同步
+    
+    Returns:
+        tuple: (select响应, 是否需要全量同步, 文件夹自上次同步后是否没有变化)
+    """
+    if client.has_capability('CONDSTORE') and client.has_capability('ENABLE'):
+        try:
+            client.enable('CONDSTORE')
+        except Exception as e:
+            metrics.debug("启用CONDSTORE失败: %s", e)
+    
+    with metrics.timer('imap_select_seconds'):
+        select_info = client.select_folder(folder)
+    uidvalidity = select_info.get(b'UIDVALIDITY')
+    uidnext = select_info.get(b'UIDNEXT')
+    highest_modseq = select_info.get(b'HIGHESTMODSEQ')
+    
+    full_resync = sync_state['uidvalidity'] is None or sync_state['uidvalidity'] != uidvalidity
+    if full_resync and sync_state['uidvalidity'] is not None:
+        print(f"UIDVALIDITY 已变化 ({sync_state['uidvalidity']} -> {uidvalidity})，执行全量同步")
+    
+    # UIDNEXT和HIGHESTMODSEQ都没变还不够：按日期范围导入或有批次重试失败时，last_uid之后可能还有没入库的邮件
+    unchanged = (
+        not full_resync
+        and uidnext is not None
+        and sync_state['uidnext'] == uidnext
+        and (highest_modseq is None or sync_state['highest_modseq'] == highest_modseq)
+        and (sync_state['last_uid'] or 0) >= uidnext - 1
+    )
+    
+    if full_resync:
+        sync_state['last_uid'] = 0
+    sync_state['uidvalidity'] = uidvalidity
+    sync_state['uidnext'] = uidnext
+    sync_state['highest_modseq'] = highest_modseq
+    return select_info, full_resync, unchanged
+
+def get_email_body(msg):
+    """获取邮件正文内容"""
+    with metrics.timer('body_extract_seconds', source='message'):
+        return truncate_body(extract_body(msg, BODY_MAX_CHARS + 1))
+
+# 入库时保留的正文最大字符数
+BODY_MAX_CHARS = 10000
+
+def truncate_body(body):
+    """截断正文到入库长度"""
+    return body[:BODY_MAX_CHARS] + "..." if len(body) > BODY_MAX_CHARS else body
+
+def decode_subject(raw_subject):
+    """解码邮件主题"""
+    subject = ""
+    for part, encoding in decode_header(raw_subject or ''):
+        if isinstance(part, bytes):
+            subject += part.decode(encoding or 'utf-8', errors='ignore')
+        else:
+            subject += str(part)
+    return subject
+
+def format_send_date(raw_send_date, fallback=None):
+    """将邮件头中的日期格式化为MySQL DATETIME格式 (YYYY-MM-DD HH:MM:SS)
+    
+    解析失败时使用fallback（如INTERNALDATE），否则保留原始日期。
+    """
+    if raw_send_date:
+        try:
+            parsed_date = email.utils.parsedate_to_datetime(raw_send_date)
+            if parsed_date:
+                return parsed_date.strftime('%Y-%m-%d %H:%M:%S')
+        except Exception as e:
+            print(f"解析邮件日期时出错: {e}")
+    if fallback is not None:
+        return fallback.strftime('%Y-%m-%d %H:%M:%S')
+    return raw_send_date
+
+class EmailRecord:
+    """解析后的一封邮件
+    
+    字段存放在__slots__中，没有每条记录一个字典的开销；主题和发送时间先保留原始邮件头，
+    第一次读取时才解码/格式化（序列化到其他进程前会先解码）。
+    兼容字典方式的读写（record['subject']、record.get('body')、record['body'] = ...）。
+    """
+    __slots__ = ('imap_id', 'sender', 'recipient', 'message_id', 'body',
+                 '_subject', '_raw_subject', '_send_date', '_raw_date', '_internal_date')
+    FIELDS = ('imap_id', 'subject', 'sender', 'recipient', 'send_date', 'message_id', 'body')
+    
+    def __init__(self, imap_id, raw_subject, sender, recipient, raw_date, message_id, body='', internal_date=None):
+        self.imap_id = imap_id
+        self.sender = sender
+        self.recipient = recipient
+        self.message_id = message_id
+        self.body = body
+        self._subject = None
+        self._raw_subject = raw_subject
+        self._send_date = None
+        self._raw_date = raw_date
+        self._internal_date = internal_date
+    
+    @property
+    def subject(self):
+        if self._subject is None:
+            self._subject = decode_subject(self._raw_subject)
+            self._raw_subject = None
+        return self._subject
+    
+    @subject.setter
+    def subject(self, value):
+        self._subject = value
+        self._raw_subject = None
+    
+    @property
+    def send_date(self):
+        if self._send_date is None and (self._raw_date is not None or self._internal_date is not None):
+            self._send_date = format_send_date(self._raw_date, self._internal_date)
+            self._raw_date = self._internal_date = None
+        return self._send_date
+    
+    @send_date.setter
+    def send_date(self, value):
+        self._send_date = value
+        self._raw_date = self._internal_date = None
+    
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def __contains__(self, key):
+        return key in self.FIELDS
+    
+    def __iter__(self):
+        return iter(self.FIELDS)
+    
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+    
+    def keys(self):
+        return self.FIELDS
+    
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+    
+    def __eq__(self, other):
+        if isinstance(other, (EmailRecord, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, EmailRecord) else other)
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return f"EmailRecord(imap_id={self.imap_id!r}, subject={self.subject!r})"
+    
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+    
+    def __setstate__(self, state):
+        imap_id, subject, sender, recipient, send_date, message_id, body = state
+        self.__init__(imap_id, None, sender, recipient, None, message_id, body)
+        self._subject = subject
+        self._send_date = send_date
+
+def parse_email_message(msg_id, raw_message):
+    """把完整的RFC822邮件解析成入库所需的字段
+    
+    raw_message可以是bytes或memoryview（解析池直接传入共享内存的视图），
+    按ASCII+surrogateescape解码后解析，与email.message_from_bytes的结果相同。
+    """
+    with metrics.timer('mime_parse_seconds', source='message'):
+        msg = email.message_from_string(str(raw_message, 'ascii', 'surrogateescape'))
+    return EmailRecord(msg_id, msg.get('Subject', ''), msg.get('From', ''), msg.get('To', ''),
+                       msg.get('Date', ''), msg.get('Message-ID', ''), get_email_body(msg))
+
+# 两阶段获取：第一阶段只取头部字段和BODYSTRUCTURE，第二阶段只取正文所在的MIME部分
+HEADER_FIELDS_ITEM = 'BODY.PEEK[HEADER.FIELDS (SUBJECT FROM TO DATE MESSAGE-ID)]'
+# 正文部分的最大下载字节数：按UTF-8中文3字节、base64膨胀4/3、HTML标签开销估算
+TEXT_PART_MAX_BYTES = BODY_MAX_CHARS * 8
+
+def _find_fetch_item(fetch_result, prefix):
+    """在FETCH结果中查找以prefix开头的数据项（服务器回显的键名格式不完全一致）"""
+    for key, value in fetch_result.items():
+        if isinstance(key, bytes) and key.upper().startswith(prefix):
+            return value
+    return None
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii', errors='ignore')
+    return value or ''
+
+def find_text_part(bodystructure, section=''):
+    """根据BODYSTRUCTURE找到正文所在的MIME部分
+    
+    与get_email_body的选择规则一致：跳过附件，优先第一个text/plain，否则使用最后一个text/html。
+    
+    Returns:
+        dict | None: {'section', 'subtype', 'charset', 'encoding'}，找不到正文时返回None
+    """
+    plain, html = None, None
+    stack = [(bodystructure, section)]
+    while stack:
+        part, part_section = stack.pop(0)
+        if part.is_multipart:
+            children = [
+                (child, f"{part_section}.{index}" if part_section else str(index))
+                for index, child in enumerate(part[0], start=1)
+            ]
+            stack = children + stack
+            continue
+        
+        maintype = _to_str(part[0]).lower()
+        subtype = _to_str(part[1]).lower()
+        if maintype != 'text' or subtype not in ('plain', 'html'):
+            continue
+        # text类型的扩展字段：md5在第9项，disposition在第10项
+        disposition = part[9] if len(part) > 9 else None
+        if disposition and isinstance(disposition, tuple) and _to_str(disposition[0]).lower() == 'attachment':
+            continue
+        
+        params = part[2] or ()
+        charset = None
+        for i in range(0, len(params) - 1, 2):
+            if _to_str(params[i]).lower() == 'charset':
+                charset = _to_str(params[i + 1])
+        info = {
+            'section': part_section or '1',
+            'subtype': subtype,
+            'charset': charset,
+            'encoding': _to_str(part[5]).lower()
+        }
+        if subtype == 'plain':
+            plain = info
+            break
+        html = info
+    return plain or html
+
+def partial_body_item(section):
+    """第二阶段FETCH的数据项：只下载正文部分的前TEXT_PART_MAX_BYTES字节"""
+    return f'BODY.PEEK[{section}]<0.{TEXT_PART_MAX_BYTES}>'
+
+def partial_records(headers, batch_ids):
+    """根据第一阶段的FETCH结果生成邮件记录（正文为空）
+    
+    Returns:
+        tuple: (记录字典 {msg_id: 记录}, 按section分组的正文位置 {section: [(msg_id, text_part)]},
+                需要下载完整邮件的msg_id列表)
+    """
+    records = {}
+    sections = {}
+    fallback_ids = []
+    for msg_id in batch_ids:
+        data = headers.get(msg_id)
+        if not data:
+            print(f"未找到邮件ID {msg_id} 的数据")
+            continue
+        header_bytes = _find_fetch_item(data, b'BODY[HEADER') or b''
+        with metrics.timer('mime_parse_seconds', source='header'):
+            msg = email.message_from_bytes(header_bytes)
+        records[msg_id] = EmailRecord(msg_id, msg.get('Subject', ''), msg.get('From', ''), msg.get('To', ''),
+                                      msg.get('Date', ''), msg.get('Message-ID', ''),
+                                      internal_date=data.get(b'INTERNALDATE'))
+        try:
+            text_part = find_text_part(data[b'BODYSTRUCTURE'])
+        except Exception as e:
+            print(f"解析邮件ID {msg_id} 的BODYSTRUCTURE出错，改为下载完整邮件: {e}")
+            fallback_ids.append(msg_id)
+            continue
+        if text_part:
+            sections.setdefault(text_part['section'], []).append((msg_id, text_part))
+    return records, sections, fallback_ids
+
+def fill_partial_bodies(records, parts, bodies, section):
+    """把第二阶段下载的正文部分解码后填入记录"""
+    prefix = f'BODY[{section}]'.encode()
+    for msg_id, text_part in parts:
+        payload = _find_fetch_item(bodies.get(msg_id, {}), prefix)
+        if not payload:
+            continue
+        with metrics.timer('body_extract_seconds', source='part'):
+            raw = decode_partial_payload(payload, text_part['encoding'])
+            decoded = extract_text_part(raw, text_part['charset'], text_part['subtype'],
+                                        BODY_MAX_CHARS + 1, sender_domain(records[msg_id].sender))
+        records[msg_id].body = truncate_body(decoded)
+
+def fetched_bytes(data):
+    """一次FETCH响应中字节串数据项的总字节数"""
+    total = 0
+    for item in data.values():
+        for value in item.values():
+            if isinstance(value, bytes):
+                total += len(value)
+    return total
+
+def record_fetched(data, stage, backend='imapclient'):
+    """记录一次FETCH下载的邮件数和字节数（指标关闭时不遍历）"""
+    if not metrics.is_enabled():
+        return
+    metrics.count('imap_fetch_messages_total', len(data), stage=stage, backend=backend)
+    metrics.count('imap_fetch_bytes_total', fetched_bytes(data), stage=stage, backend=backend)
+
+def timed_fetch(client, msg_ids, items, stage, on_bytes=None):
+    """client.fetch，并记录耗时和下载量；stage区分 header/body/rfc822，on_bytes(字节数)用于调用方自己的统计"""
+    with metrics.timer('imap_fetch_seconds', stage=stage, backend='imapclient'):
+        data = client.fetch(msg_ids, items)
+    record_fetched(data, stage)
+    if on_bytes is not None:
+        on_bytes(fetched_bytes(data))
+    return data
+
+def fetch_emails_partial(client, batch_ids, on_bytes=None):
+    """两阶段获取一批邮件：先取头部和BODYSTRUCTURE，再只下载正文所在的MIME部分
+    
+    无法解析BODYSTRUCTURE的邮件会退回到下载完整的RFC822。on_bytes见timed_fetch。
+    """
+    headers = timed_fetch(client, batch_ids, [HEADER_FIELDS_ITEM, 'BODYSTRUCTURE', 'INTERNALDATE'], 'header',
+                          on_bytes)
+    records, sections, fallback_ids = partial_records(headers, batch_ids)
+    
+    # 同一个section的邮件合并成一次FETCH
+    for section, parts in sections.items():
+        bodies = timed_fetch(client, [msg_id for msg_id, _ in parts], [partial_body_item(section)], 'body', on_bytes)
+        fill_partial_bodies(records, parts, bodies, section)
+    
+    if fallback_ids:
+        msg_data = timed_fetch(client, fallback_ids, ['RFC822'], 'rfc822', on_bytes)
+        for msg_id in fallback_ids:
+            if msg_id in msg_data and b'RFC822' in msg_data[msg_id]:
+                records[msg_id] = parse_email_message(msg_id, msg_data[msg_id][b'RFC822'])
+    
+    return [records[msg_id] for msg_id in batch_ids if msg_id in records]
+
+# 与 src/server.js 中的建表语句保持一致；旧表由 migrate_all_emails.py 迁移到该结构
+ALL_EMAILS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS all_emails (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    imap_id VARCHAR(255),
+    uidvalidity INT UNSIGNED DEFAULT NULL,
+    uid INT UNSIGNED DEFAULT NULL,
+    message_id_hash BINARY(16) DEFAULT NULL,
+    subject TEXT,
+    sender TEXT,
+    recipient TEXT,
+    send_date TEXT,
+    send_ts DATETIME DEFAULT NULL,
+    body LONGTEXT,
+    delivered BOOLEAN DEFAULT FALSE,
+    content_hash BINARY(16) DEFAULT NULL,
+    account VARCHAR(255) DEFAULT NULL,
+    folder VARCHAR(255) DEFAULT NULL,
+    orphaned_at DATETIME DEFAULT NULL,
+    body_hash BINARY(16) DEFAULT NULL,
+    UNIQUE KEY uniq_message_id_hash (message_id_hash),
+    KEY idx_send_ts (send_ts),
+    KEY idx_uid (uid, uidvalidity),
+    KEY idx_account_folder (account, folder),
+    KEY idx_body_hash (body_hash)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# 旧版本建的表缺少的列，只补列不建索引（索引和历史数据由 migrate_all_emails.py 处理）
+ALL_EMAILS_COLUMNS = {
+    'content_hash': 'BINARY(16) DEFAULT NULL',
+    'message_id_hash': 'BINARY(16) DEFAULT NULL',
+    'send_ts': 'DATETIME DEFAULT NULL',
+    'uidvalidity': 'INT UNSIGNED DEFAULT NULL',
+    'uid': 'INT UNSIGNED DEFAULT NULL',
+    'account': 'VARCHAR(255) DEFAULT NULL',
+    'folder': 'VARCHAR(255) DEFAULT NULL',
+    'orphaned_at': 'DATETIME DEFAULT NULL',
+    'body_hash': 'BINARY(16) DEFAULT NULL',
+}
+
+EMAIL_COLUMNS = ('imap_id', 'uidvalidity', 'uid', 'message_id_hash', 'subject', 'sender',
+                 'recipient', 'send_date', 'send_ts', 'body', 'delivered', 'content_hash',
+                 'account', 'folder', 'body_hash')
+# 正文所在的列，压缩存储时替换为NULL、正文移到email_bodies（见 body_store.py），body_hash为最后一列
+BODY_COLUMN = EMAIL_COLUMNS.index('body')
+
+# 重新导入时保留投递状态（手动标记或自动分类的结果）；
+# 同一封邮件出现在多个文件夹/账号中时只保留一行，位置（账号、文件夹、UID）以最先入库的为准；
+# 未记录位置的旧行或同一位置再次入库时才更新UID；对账标记为孤儿的行（原位置的邮件已删除或移走）
+# 在新位置再次入库时迁移到新位置并清除标记。位置列和orphaned_at必须放在最后赋值，前面比较的才是旧值
+_SAME_LOCATION = ("(account IS NULL OR orphaned_at IS NOT NULL "
+                  "OR (account <=> VALUES(account) AND folder <=> VALUES(folder)))")
+EMAIL_UPSERT_ASSIGNMENTS = f"""
+imap_id=IF({_SAME_LOCATION}, VALUES(imap_id), imap_id),
+uidvalidity=IF({_SAME_LOCATION}, VALUES(uidvalidity), uidvalidity),
+uid=IF({_SAME_LOCATION}, VALUES(uid), uid),
+message_id_hash=VALUES(message_id_hash), subject=VALUES(subject), sender=VALUES(sender),
+recipient=VALUES(recipient), send_date=VALUES(send_date), send_ts=VALUES(send_ts),
+body=VALUES(body), body_hash=VALUES(body_hash), content_hash=VALUES(content_hash),
+folder=IF(account IS NULL OR orphaned_at IS NOT NULL, VALUES(folder), folder),
+account=IF(orphaned_at IS NOT NULL, VALUES(account), COALESCE(account, VALUES(account))),
+orphaned_at=NULL
+"""
+
+UPSERT_EMAIL_SQL = f"""
+INSERT INTO all_emails 
+({', '.join(EMAIL_COLUMNS)}) 
+VALUES ({', '.join(['%s'] * len(EMAIL_COLUMNS))})
+ON DUPLICATE KEY UPDATE
+{EMAIL_UPSERT_ASSIGNMENTS}
+"""
+
+# 邮件在各账号、文件夹中的位置：all_emails每封邮件只有一行、只记录第一个位置，
+# 其他文件夹中的UID记录在这里，按日期范围同步时据此跳过已保存的邮件（见 get_known_uids）
+EMAIL_LOCATIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS email_locations (
+    account VARCHAR(255) NOT NULL,
+    folder VARCHAR(255) NOT NULL,
+    uidvalidity INT UNSIGNED NOT NULL,
+    uid INT UNSIGNED NOT NULL,
+    message_id_hash BINARY(16) NOT NULL,
+    PRIMARY KEY (account, folder, uidvalidity, uid),
+    KEY idx_message_id_hash (message_id_hash)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# 同一UIDVALIDITY下UID不会复用，已有的位置只可能是同一封邮件
+UPSERT_LOCATION_SQL = """
+INSERT INTO email_locations (account, folder, uidvalidity, uid, message_id_hash)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE message_id_hash = VALUES(message_id_hash)
+"""
+
+def ensure_columns(cursor, table, columns):
+    """旧版本创建的表缺少新增列时补上
+    
+    Args:
+        columns (dict): 列名 -> 列定义
+    """
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    existing = {row[0].lower() for row in cursor.fetchall()}
+    for column, definition in columns.items():
+        if column not in existing:
+            metrics.debug("为表 %s 添加列 %s", table, column)
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# 入库时自动识别投递、面试等招聘邮件（见 email_classifier.py）
+CLASSIFY_ON_INGEST = config.config.get('classify', {}).get('enabled', True)
+# 正文去重压缩存储：正文按哈希只存一份并压缩，all_emails中只保留body_hash（见 body_store.py）
+COMPRESS_BODIES = config.config.get('storage', {}).get('compress_bodies', False)
+# 压缩存储时每次写入email_bodies的行数
+BODY_STORE_CHUNK_SIZE = 500
+# upsert_emails每条executemany的参数字节数上限，几封带大正文的邮件就足以让一批参数很大
+UPSERT_BATCH_BYTES = 4 * 1024 * 1024
+
+def ensure_email_tables(cursor):
+    """创建/检查邮件表、位置表、同步状态表、搜索索引表、预聚合表和分类相关的表"""
+    cursor.execute(ALL_EMAILS_TABLE_SQL)
+    ensure_columns(cursor, 'all_emails', ALL_EMAILS_COLUMNS)
+    cursor.execute(EMAIL_LOCATIONS_TABLE_SQL)
+    ensure_body_tables(cursor)
+    ensure_columns(cursor, 'email_bodies', BODY_TABLE_COLUMNS)
+    cursor.execute(SYNC_STATE_TABLE_SQL)
+    ensure_columns(cursor, 'email_sync_state', SYNC_STATE_COLUMNS)
+    ensure_search_tables(cursor)
+    ensure_rollup_tables(cursor)
+    if CLASSIFY_ON_INGEST:
+        try:
+            ensure_classification_tables(cursor)
+        except pymysql.MySQLError as e:
+            metrics.warn("创建分类相关的表失败，入库时将跳过自动分类: %s", e)
+
+def classify_new_emails(cursor, message_id_hashes):
+    """对刚写入的邮件自动分类；分类失败只影响本批的分类结果，不影响邮件入库"""
+    if not CLASSIFY_ON_INGEST:
+        return
+    try:
+        with metrics.timer('classify_seconds'):
+            counts = classify_emails(cursor, message_id_hashes=message_id_hashes)
+    except pymysql.MySQLError as e:
+        metrics.warn("自动分类失败: %s", e)
+        return
+    if counts['deliveries'] or counts['interviews']:
+        print(f"自动识别: 新增投递记录 {counts['deliveries']} 条，面试记录 {counts['interviews']} 条")
+
+def email_content_hash(e):
+    """邮件内容指纹，用于判断重复导入的邮件是否有变化"""
+    content = '\x1f'.join((e['subject'] or '', e['sender'] or '', e['recipient'] or '',
+                           e['send_date'] or '', e['body'] or ''))
+    return hashlib.md5(content.encode('utf-8', errors='surrogatepass')).digest()
+
+def email_identity_hash(e):
+    """邮件的唯一标识（all_emails的去重键）
+    
+    有Message-ID时取其MD5，否则退化为主题、发件人、发送时间的指纹。
+    指纹的算法与 migrate_all_emails.py 回填历史数据时的SQL表达式一致。
+    """
+    message_id = (e.get('message_id') or '').strip()
+    if message_id:
+        key = message_id
+    else:
+        key = '\x1f'.join((e['subject'] or '', e['sender'] or '', e['send_date'] or ''))
+    return hashlib.md5(key.encode('utf-8', errors='surrogatepass')).digest()
+
+def parse_send_ts(send_date):
+    """把格式化后的发送时间转换为datetime，无法解析时返回None"""
+    try:
+        return datetime.datetime.strptime(send_date, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+def email_row(e, uidvalidity=None, account=None, folder=None):
+    """把解析后的邮件转换为all_emails的一行，列顺序见EMAIL_COLUMNS"""
+    uid = int(e['imap_id'])
+    return (str(uid), uidvalidity, uid, email_identity_hash(e), e['subject'] or '', e['sender'] or '',
+            e['recipient'] or '', e['send_date'] or '', parse_send_ts(e['send_date']),
+            e['body'], False, email_content_hash(e), account, folder, None)
+
+def store_bodies(cursor, rows):
+    """开启压缩存储时把行中的正文写入email_bodies，逐行产出正文列为NULL、带body_hash的行；未开启时原样产出
+    
+    rows可以是生成器，每次只缓存BODY_STORE_CHUNK_SIZE行。
+    """
+    if not COMPRESS_BODIES:
+        yield from rows
+        return
+    store = get_body_store()
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, BODY_STORE_CHUNK_SIZE))
+        if not chunk:
+            return
+        with metrics.timer('body_store_seconds'):
+            hashes = store.put_many(cursor, [row[BODY_COLUMN] for row in chunk])
+        for row, body_hash in zip(chunk, hashes):
+            yield row[:BODY_COLUMN] + (None,) + row[BODY_COLUMN + 1:-1] + (body_hash,)
+
+def new_email_days(cursor, rows):
+    """写入之前调用：一批all_emails行中尚未入库的邮件按发送日期计数，用于增量维护预聚合邮件数"""
+    hashes = list({row[3] for row in rows})
+    cursor.execute(f"SELECT message_id_hash FROM all_emails WHERE message_id_hash IN ({','.join(['%s'] * len(hashes))})",
+                   hashes)
+    existing = {row[0] for row in cursor.fetchall()}
+    days = {}
+    for row in rows:
+        if row[3] in existing or row[8] is None:
+            continue
+        existing.add(row[3])
+        days[row[8].date()] = days.get(row[8].date(), 0) + 1
+    return days
+
+def record_locations(cursor, rows):
+    """记录一批all_emails行（列顺序见EMAIL_COLUMNS）所在的账号、文件夹和UID，位置不完整的行跳过"""
+    locations = [(account, folder, uidvalidity, uid, message_id_hash)
+                 for (_, uidvalidity, uid, message_id_hash, *_, account, folder, _) in rows
+                 if account is not None and folder is not None and uidvalidity is not None and uid is not None]
+    if locations:
+        cursor.executemany(UPSERT_LOCATION_SQL, locations)
+
+def connect_email_db(db_config):
+    """连接邮件数据库"""
+    return pymysql.connect(
+        host=db_config['host'],
+        user=db_config['user'],
+        password=db_config['password'],
+        database=db_config['database'],
+        charset=db_config['charset'],
+        autocommit=True
+    )
+
+def upsert_emails(cursor, emails, batch_size=100, uidvalidity=None, account=None, folder=None,
+                  batch_bytes=UPSERT_BATCH_BYTES):
+    """在已有的数据库游标上写入或更新邮件，并增量更新搜索索引、预聚合表和自动分类，返回受影响的行数
+    
+    emails可以是生成器；每次最多构造batch_size行、约batch_bytes字节的参数，写入后即释放，之后只保留去重键。
+    """
+    inserted_count = 0
+    message_id_hashes = []
+    day_counts = {}
+    batch = []
+    pending_bytes = 0
+    
+    def count_new(rows):
+        for day, n in new_email_days(cursor, rows).items():
+            day_counts[day] = day_counts.get(day, 0) + n
+    
+    with metrics.timer('db_upsert_seconds'):
+        for e in emails:
+            batch.append(email_row(e, uidvalidity, account, folder))
+            pending_bytes += email_bytes(e)
+            if len(batch) >= batch_size or pending_bytes >= batch_bytes:
+                count_new(batch)
+                cursor.executemany(UPSERT_EMAIL_SQL, list(store_bodies(cursor, batch)))
+                inserted_count += cursor.rowcount
+                record_locations(cursor, batch)
+                message_id_hashes.extend(row[3] for row in batch)
+                batch = []
+                pending_bytes = 0
+        if batch:
+            count_new(batch)
+            cursor.executemany(UPSERT_EMAIL_SQL, list(store_bodies(cursor, batch)))
+            inserted_count += cursor.rowcount
+            record_locations(cursor, batch)
+            message_id_hashes.extend(row[3] for row in batch)
+    metrics.count('db_rows_written_total', len(message_id_hashes))
+    # 只有新邮件和内容有变化的邮件会重建索引；每封邮件只分类一次
+    with metrics.timer('search_index_seconds'):
+        index_emails(cursor, message_id_hashes=message_id_hashes)
+    add_email_days(cursor, day_counts)
+    classify_new_emails(cursor, message_id_hashes)
+    return inserted_count
+
+def save_emails_to_database(emails, db_config, sync_state=None, uidvalidity=None, account=None, folder=None):
+    """将邮件保存到数据库
+    
+    如果提供了sync_state，会在邮件全部写入成功后一并保存同步状态。
+    uidvalidity未指定时取sync_state中的值；account和folder未指定时同样取自sync_state。
+    """
+    if uidvalidity is None and sync_state:
+        uidvalidity = sync_state['uidvalidity']
+    if account is None and sync_state:
+        account, folder = sync_state['account'], sync_state['folder']
+    try:
+        metrics.debug("尝试连接数据库: %s", db_config['database'])
+        with connect_email_db(db_config) as connection:
+            metrics.debug("数据库连接成功")
+            with connection.cursor() as cursor:
+                ensure_email_tables(cursor)
+                metrics.debug("邮件表创建/检查完成")
                 
                 if not emails:
-                    print("[DEBUG] 没有邮件需要保存到数据库")
+                    metrics.debug("没有邮件需要保存到数据库")
+                    if sync_state:
+                        write_sync_state(cursor, sync_state)
                     return 0
                 
-                # 先检查数据库中已有的邮件数量
-                cursor.execute("SELECT COUNT(*) as count FROM all_emails")
-                result = cursor.fetchone()
-                existing_count = result[0] if result else 0
-                print(f"[DEBUG] 数据库中已有邮件数量: {existing_count}")
-                
-                insert_query = """
-                INSERT INTO all_emails 
-                (imap_id, subject, sender, recipient, send_date, body, delivered) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                subject=VALUES(subject), sender=VALUES(sender), recipient=VALUES(recipient), 
-                send_date=VALUES(send_date), body=VALUES(body), delivered=VALUES(delivered)
-                """
-                
-                email_data = [
-                    (str(e['imap_id']), e['subject'] or '', e['sender'] or '',
-                     e['recipient'] or '', e['send_date'] or '', e['body'], False)
-                    for e in emails
-                ]
-                
-                print(f"[DEBUG] 准备将 {len(email_data)} 封邮件插入数据库")
-                if email_data:
-                    print(f"[DEBUG] 第一条邮件数据预览: ID={email_data[0][0]}, Subject={email_data[0][1][:50]}...")
-                
-                batch_size = 100
-                processed_count = len(email_data)  # 记录处理的邮件数量
-                inserted_count = 0  # 记录实际插入的邮件数量
+                metrics.debug("准备将 %s 封邮件插入数据库", len(emails))
+                processed_count = len(emails)  # 记录处理的邮件数量
+                inserted_count = upsert_emails(cursor, emails, uidvalidity=uidvalidity,
+                                               account=account, folder=folder)  # 记录实际插入的邮件数量
                 
-                for i in range(0, len(email_data), batch_size):
-                    batch = email_data[i:i+batch_size]
-                    print(f"[DEBUG] 正在插入第 {i//batch_size + 1} 批邮件，共 {len(batch)} 封")
-                    # 执行插入或更新操作
-                    cursor.executemany(insert_query, batch)
-                    # 获取受影响的行数
-                    affected_rows = cursor.rowcount
-                    inserted_count += affected_rows
-                    print(f"[DEBUG] 第 {i//batch_size + 1} 批邮件处理完成，影响 {affected_rows} 行")
-                
-                print(f"[DEBUG] 邮件保存完成，总共处理 {processed_count} 封邮件，实际插入 {inserted_count} 封新邮件")
+                metrics.debug("邮件保存完成，总共处理 %s 封邮件，实际插入 %s 封新邮件", processed_count, inserted_count)
+                if sync_state:
+                    write_sync_state(cursor, sync_state)
                 return inserted_count
     except Exception as e:
-        print(f"[DEBUG] 数据库连接或操作失败: {e}")
+        metrics.error("数据库连接或操作失败: %s", e)
         import traceback
         traceback.print_exc()
         return 0
 
-def fetch_emails(client, start_date=None, end_date=None, email_address=None):
-    """获取邮件"""
+STAGING_TABLE_SQL = """
+CREATE TEMPORARY TABLE staging_emails (
+    imap_id VARCHAR(255),
+    uidvalidity INT UNSIGNED,
+    uid INT UNSIGNED,
+    message_id_hash BINARY(16),
+    subject TEXT,
+    sender TEXT,
+    recipient TEXT,
+    send_date TEXT,
+    send_ts DATETIME,
+    body LONGTEXT,
+    delivered BOOLEAN,
+    content_hash BINARY(16),
+    account VARCHAR(255),
+    folder VARCHAR(255),
+    body_hash BINARY(16),
+    KEY idx_message_id_hash (message_id_hash)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# 只合并内容指纹有变化的邮件：去重键相同且指纹相同的行直接跳过，不会重写正文（孤儿行除外，需要迁移位置）
+MERGE_STAGING_SQL = f"""
+INSERT INTO all_emails
+({', '.join(EMAIL_COLUMNS)})
+SELECT {', '.join('s.' + column for column in EMAIL_COLUMNS)}
+FROM staging_emails s
+LEFT JOIN all_emails a ON a.message_id_hash = s.message_id_hash AND a.content_hash = s.content_hash
+    AND a.orphaned_at IS NULL
+WHERE a.id IS NULL
+ON DUPLICATE KEY UPDATE
+{EMAIL_UPSERT_ASSIGNMENTS}
+"""
+
+# 暂存表每次INSERT的行数，pymysql会把executemany改写为多行VALUES
+STAGING_INSERT_ROWS = 1000
+
+def _escape_load_data_field(value):
+    """按LOAD DATA默认格式转义字段"""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r').replace('\0', '\\0'))
+
+def _stage_with_load_data(cursor, rows):
+    """通过LOAD DATA LOCAL INFILE写入暂存表，返回写入的行数"""
+    count = 0
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv', delete=False) as f:
+        path = f.name
+        for (imap_id, uidvalidity, uid, message_id_hash, subject, sender, recipient,
+             send_date, send_ts, body, delivered, content_hash, account, folder, body_hash) in rows:
+            fields = [_escape_load_data_field(v) for v in (imap_id, uidvalidity, uid)]
+            fields.append(message_id_hash.hex())
+            fields.extend(_escape_load_data_field(v) for v in (subject, sender, recipient, send_date, send_ts, body))
+            fields.append('1' if delivered else '0')
+            fields.append(content_hash.hex())
+            fields.extend(_escape_load_data_field(v) for v in (account, folder))
+            fields.append(body_hash.hex() if body_hash else '\\N')
+            f.write('\t'.join(fields) + '\n')
+            count += 1
     try:
-        client.select_folder('INBOX')
-        print("已选择收件箱文件夹")
-        
-        # 构建搜索条件
-        search_criteria = ['ALL']
-        if start_date and end_date:
+        cursor.execute(
+            "LOAD DATA LOCAL INFILE %s INTO TABLE staging_emails CHARACTER SET utf8mb4 "
+            "(imap_id, uidvalidity, uid, @message_id_hash, subject, sender, recipient, send_date, "
+            "send_ts, body, delivered, @hash, account, folder, @body_hash) "
+            "SET message_id_hash = UNHEX(@message_id_hash), content_hash = UNHEX(@hash), body_hash = UNHEX(@body_hash)",
+            (path.replace('\\', '/'),)
+        )
+    finally:
+        os.remove(path)
+    return count
+
+def _stage_with_insert(cursor, rows):
+    """通过多行INSERT写入暂存表，返回写入的行数"""
+    sql = f"INSERT INTO staging_emails VALUES ({', '.join(['%s'] * len(EMAIL_COLUMNS))})"
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= STAGING_INSERT_ROWS:
+            cursor.executemany(sql, chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        cursor.executemany(sql, chunk)
+        count += len(chunk)
+    return count
+
+def bulk_save_emails(emails, db_config, sync_state=None, use_load_data=True):
+    """批量导入邮件：先写入临时暂存表，再用一条语句合并到all_emails
+    
+    整个过程在一个事务中完成，只有内容指纹变化的行会被写入。emails可以是生成器，
+    暂存阶段逐行消费，生成器结束后才会执行合并并写入sync_state。
+    use_load_data为True且服务器开启了local_infile时使用LOAD DATA LOCAL INFILE，
+    否则使用多行INSERT。
+    
+    Returns:
+        int: 新增的邮件数
+    """
+    with pymysql.connect(
+        host=db_config['host'],
+        user=db_config['user'],
+        password=db_config['password'],
+        database=db_config['database'],
+        charset=db_config['charset'],
+        local_infile=use_load_data,
+        autocommit=True
+    ) as connection:
+        with connection.cursor() as cursor:
+            ensure_email_tables(cursor)
+            cursor.execute(STAGING_TABLE_SQL)
+            if use_load_data:
+                cursor.execute("SELECT @@GLOBAL.local_infile")
+                if not cursor.fetchone()[0]:
+                    metrics.debug("服务器未开启local_infile，改用多行INSERT写入暂存表")
+                    use_load_data = False
+            
+            connection.begin()
             try:
-                start_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-                end_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d") + datetime.timedelta(days=1)
-                search_criteria = ['SINCE', start_dt, 'BEFORE', end_dt]
-                print(f"使用日期范围搜索: {start_date} 到 {end_date}")
-            except ValueError as e:
-                print(f"日期格式无效: {e}")
-                # 如果日期格式无效，则使用默认搜索条件
-                search_criteria = ['ALL']
-        else:
-            # 如果没有指定日期范围，则使用默认搜索条件
-            search_criteria = ['ALL']
-        
+                uidvalidity = sync_state['uidvalidity'] if sync_state else None
+                account = sync_state['account'] if sync_state else None
+                folder = sync_state['folder'] if sync_state else None
+                rows = store_bodies(cursor, (email_row(e, uidvalidity, account, folder) for e in emails))
+                # 暂存阶段会消费邮件生成器，耗时包含获取和解析
+                with metrics.timer('db_stage_seconds'):
+                    if use_load_data:
+                        staged = _stage_with_load_data(cursor, rows)
+                    else:
+                        staged = _stage_with_insert(cursor, rows)
+                metrics.debug("已暂存 %s 封邮件", staged)
+                
+                cursor.execute(
+                    "SELECT COUNT(*) FROM staging_emails s "
+                    "JOIN all_emails a ON a.message_id_hash = s.message_id_hash AND a.content_hash = s.content_hash "
+                    "AND a.orphaned_at IS NULL"
+                )
+                unchanged = cursor.fetchone()[0]
+                # 合并之前统计新邮件的发送日期，用于增量维护预聚合邮件数
+                cursor.execute(
+                    "SELECT DATE(s.send_ts), COUNT(DISTINCT s.message_id_hash) FROM staging_emails s "
+                    "LEFT JOIN all_emails a ON a.message_id_hash = s.message_id_hash "
+                    "WHERE a.id IS NULL AND s.send_ts IS NOT NULL GROUP BY 1"
+                )
+                day_counts = dict(cursor.fetchall())
+                with metrics.timer('db_merge_seconds'):
+                    cursor.execute(MERGE_STAGING_SQL)
+                # 新增的行计1，更新的行计2
+                changed = staged - unchanged
+                updated = max(cursor.rowcount - changed, 0)
+                inserted = changed - updated
+                metrics.debug("合并完成: 新增 %s 封, 更新 %s 封, 未变化 %s 封", inserted, updated, unchanged)
+                metrics.count('db_rows_written_total', changed)
+                cursor.execute(
+                    "INSERT INTO email_locations (account, folder, uidvalidity, uid, message_id_hash) "
+                    "SELECT account, folder, uidvalidity, uid, message_id_hash FROM staging_emails "
+                    "WHERE account IS NOT NULL AND folder IS NOT NULL AND uidvalidity IS NOT NULL AND uid IS NOT NULL "
+                    "ON DUPLICATE KEY UPDATE message_id_hash = VALUES(message_id_hash)"
+                )
+                
+                cursor.execute("SELECT message_id_hash FROM staging_emails")
+                staged_hashes = [row[0] for row in cursor.fetchall()]
+                with metrics.timer('search_index_seconds'):
+                    indexed = index_emails(cursor, message_id_hashes=staged_hashes)
+                metrics.debug("搜索索引已更新 %s 封邮件", indexed)
+                add_email_days(cursor, day_counts)
+                classify_new_emails(cursor, staged_hashes)
+                
+                if sync_state:
+                    write_sync_state(cursor, sync_state)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.execute("DROP TEMPORARY TABLE IF EXISTS staging_emails")
+            return inserted
+
+def fetch_raw_messages(client, batch_ids, cache=None, uidvalidity=None):
+    """下载一批完整的RFC822邮件，先查本地缓存，只下载未缓存的邮件并写入缓存
+    
+    Returns:
+        list: [(msg_id, 原始邮件)]，按batch_ids的顺序，服务器上不存在的邮件不在结果中
+    """
+    cached = cache.get_many(uidvalidity, batch_ids) if cache else {}
+    missing = [msg_id for msg_id in batch_ids if msg_id not in cached]
+    metrics.count('raw_cache_hits_total', len(cached))
+    if missing:
+        msg_data = timed_fetch(client, missing, ['RFC822'], 'rfc822')
+        for msg_id in missing:
+            if msg_id not in msg_data or b'RFC822' not in msg_data[msg_id]:
+                print(f"未找到邮件ID {msg_id} 的数据")
+                continue
+            raw = msg_data[msg_id][b'RFC822']
+            cached[msg_id] = raw
+            if cache:
+                try:
+                    headers = BytesHeaderParser().parsebytes(raw)
+                    message_id = (headers.get('Message-ID') or '').strip()
+                    cache.put(raw, uidvalidity, msg_id,
+                              email_identity_hash({'message_id': message_id}) if message_id else None)
+                except Exception as e:
+                    metrics.warn("写入原始邮件缓存失败: %s", e)
+    return [(msg_id, cached[msg_id]) for msg_id in batch_ids if msg_id in cached]
+
+def reparse_cached_emails(db_config, cache, chunk_size=500):
+    """用缓存中的原始邮件重新提取正文，只更新内容有变化的行，不访问邮箱服务器
+    
+    Returns:
+        tuple: (重新解析并更新的邮件数, 未缓存的邮件数)
+    """
+    reparsed = 0
+    missing = 0
+    legacy = legacy_account()
+    with connect_email_db(db_config) as connection:
+        with connection.cursor() as cursor:
+            last_id = 0
+            while True:
+                cursor.execute(
+                    "SELECT id, uidvalidity, uid, message_id_hash, content_hash, account, folder FROM all_emails "
+                    "WHERE id > %s AND uid IS NOT NULL ORDER BY id LIMIT %s",
+                    (last_id, chunk_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                updates = []
+                for row_id, uidvalidity, uid, message_id_hash, content_hash, account, folder in rows:
+                    # 旧版本导入的行没有账号和文件夹，属于默认账号的收件箱
+                    mailbox = (account or legacy, folder or 'INBOX')
+                    raw = cache.get(uidvalidity, uid, message_id_hash, mailbox)
+                    if raw is None:
+                        missing += 1
+                        continue
+                    record = parse_email_message(uid, raw)
+                    new_hash = email_content_hash(record)
+                    if new_hash != content_hash:
+                        updates.append((record['body'], new_hash, row_id))
+                if updates and COMPRESS_BODIES:
+                    hashes = get_body_store().put_many(cursor, [update[0] for update in updates])
+                    cursor.executemany("UPDATE all_emails SET body = NULL, body_hash = %s, content_hash = %s WHERE id = %s",
+                                       [(body_hash,) + update[1:] for body_hash, update in zip(hashes, updates)])
+                elif updates:
+                    cursor.executemany("UPDATE all_emails SET body = %s, body_hash = NULL, content_hash = %s WHERE id = %s",
+                                       updates)
+                if updates:
+                    index_emails(cursor, ids=[update[2] for update in updates])
+                    reparsed += len(updates)
+                print(f"已检查到 id={last_id}，更新 {reparsed} 封邮件")
+    return reparsed, missing
+
+def build_search_criteria(start_date=None, end_date=None):
+    """根据日期范围构建IMAP搜索条件"""
+    if start_date and end_date:
+        try:
+            start_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+            end_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d") + datetime.timedelta(days=1)
+            print(f"使用日期范围搜索: {start_date} 到 {end_date}")
+            return ['SINCE', start_dt, 'BEFORE', end_dt]
+        except ValueError as e:
+            print(f"日期格式无效: {e}")
+    # 如果没有指定日期范围或日期格式无效，则使用默认搜索条件
+    return ['ALL']
+
+class ImportInterrupted(Exception):
+    """导入过程收到终止信号"""
+
+def plan_email_uids(client, start_date=None, end_date=None, sync_state=None, db_config=None):
+    """选择文件夹（sync_state中的folder，没有sync_state时为收件箱）并确定本次需要获取的UID
+    
+    提供sync_state时按UID增量同步：未指定日期范围时只获取UID大于上次同步位置的邮件，
+    指定日期范围时跳过数据库中已保存的UID；UIDVALIDITY变化时退化为全量同步。
+    sync_state中的UIDVALIDITY等信息会被原地更新。
+    
+    Returns:
+        tuple: (按升序排列的UID列表, 是否按日期范围搜索)
+    """
+    full_resync = True
+    unchanged = False
+    folder = sync_state['folder'] if sync_state is not None else 'INBOX'
+    if sync_state is not None:
+        _, full_resync, unchanged = select_folder_for_sync(client, folder, sync_state)
+    else:
+        client.select_folder(folder)
+    print(f"已选择文件夹 {folder}")
+    
+    # 构建搜索条件
+    search_criteria = build_search_criteria(start_date, end_date)
+    
+    windowed = search_criteria != ['ALL']
+    if sync_state is not None and not windowed and not full_resync:
+        if unchanged:
+            print("邮箱自上次同步后没有变化，无需获取新邮件")
+            return [], windowed
+        # 只搜索上次同步之后的新邮件（"N:*" 至少会返回最后一封邮件，需要再过滤一次）
+        search_criteria = ['UID', f"{sync_state['last_uid'] + 1}:*"]
+        print(f"增量同步: 获取UID大于 {sync_state['last_uid']} 的邮件")
+    
+    with metrics.timer('imap_search_seconds'):
         email_ids = client.search(search_criteria)
-        print(f"找到 {len(email_ids)} 封邮件")
-        
-        # 限制处理数量
-        max_emails = 1000
-        if len(email_ids) > max_emails:
-            print(f"将处理前 {max_emails} 封邮件")
-            email_ids = email_ids[:max_emails]
+    if sync_state is not None and not windowed:
+        email_ids = [uid for uid in email_ids if uid > sync_state['last_uid']]
+    elif sync_state is not None and not full_resync and db_config:
+        known_uids = get_known_uids(db_config, email_ids, sync_state['uidvalidity'],
+                                    sync_state['account'], sync_state['folder'])
+        if known_uids:
+            print(f"跳过 {len(known_uids)} 封已保存的邮件")
+            email_ids = [uid for uid in email_ids if uid not in known_uids]
+    email_ids = sorted(email_ids)
+    metrics.count('imap_search_results_total', len(email_ids))
+    print(f"找到 {len(email_ids)} 封邮件")
+    return email_ids, windowed
+
+def parse_raw_messages(items, parse_pool=None):
+    """解析一批 (msg_id, 原始邮件)，提供parse_pool（parse_pool.ParsePool）时在子进程中解析"""
+    if parse_pool is not None:
+        return parse_pool.parse(items)
+    return [parse_email_message(msg_id, raw) for msg_id, raw in items]
+
+def fetch_email_batch(client, batch_ids, fetch_mode='partial', cache=None, uidvalidity=None, parse_pool=None):
+    """获取并解析一批邮件，返回解析后的邮件列表（服务器上不存在的邮件不在结果中）"""
+    if fetch_mode != 'partial':
+        return parse_raw_messages(fetch_raw_messages(client, batch_ids, cache, uidvalidity), parse_pool)
+    cached = cache.get_many(uidvalidity, batch_ids) if cache else {}
+    remaining = [msg_id for msg_id in batch_ids if msg_id not in cached]
+    # 缓存命中的邮件在进程池中解析，同时在本线程获取其余邮件
+    parsing = parse_pool.submit(list(cached.items())) if parse_pool is not None and cached else None
+    if parsing is None:
+        parsed = {msg_id: parse_email_message(msg_id, raw) for msg_id, raw in cached.items()}
+    else:
+        parsed = {}
+    if remaining:
+        parsed.update((e['imap_id'], e) for e in fetch_emails_partial(client, remaining))
+    if parsing is not None:
+        parsed.update((e['imap_id'], e) for e in parsing.result())
+    return [parsed[msg_id] for msg_id in batch_ids if msg_id in parsed]
+
+def iter_email_batches(client, email_ids, fetch_mode='partial', batch_size=None, cache=None, uidvalidity=None,
+                       backend=None, parse_pool=None):
+    """逐批获取并解析邮件的生成器
+    
+    每次产出 (batch_ids, 解析后的邮件列表, 错误)，出错的批次邮件列表为空。
+    批次按邮件大小（RFC822.SIZE）划分，并按每批耗时和错误自适应调整（见 adaptive_batch.py），
+    内存占用只与批次字节数有关；batch_size限制每批的最大邮件数。
+    失败的批次退避后重试，反复失败时逐步拆小，只有重试用尽的邮件作为出错的批次产出，
+    因此产出的批次不一定按UID顺序。提供cache时已缓存的邮件直接从本地解析。
+    提供backend（如async_imap.AsyncFetchBackend）时由它在独立连接上流水线获取，产出格式相同。
+    提供parse_pool时完整邮件（rfc822模式和缓存命中的邮件）交给进程池解析。
+    """
+    if backend is not None:
+        for batch_ids, batch_emails, error in backend.iter_batches(email_ids, fetch_mode, batch_size, cache,
+                                                                   uidvalidity):
+            if error is not None:
+                metrics.count('fetch_batch_errors_total', fetch_mode=fetch_mode)
+            metrics.count('emails_fetched_total', len(batch_emails), fetch_mode=fetch_mode)
+            yield batch_ids, batch_emails, error
+        return
+    batcher = AdaptiveBatcher(email_ids, fetch_message_sizes(client, email_ids), fetch_mode, max_messages=batch_size)
+    while True:
+        batch_ids = batcher.next_batch()
+        if batch_ids is None:
+            return
+        batch_no = batcher.batch_no
+        print(f"正在处理第 {batch_no} 批邮件（{len(batch_ids)} 封），邮件ID范围 {min(batch_ids)}-{max(batch_ids)}，"
+              f"剩余 {batcher.remaining()} 封")
+        batch_started = time.perf_counter()
+        try:
+            batch_emails = fetch_email_batch(client, batch_ids, fetch_mode, cache, uidvalidity, parse_pool)
+        except ImportInterrupted:
+            raise
+        except Exception as e:
+            metrics.count('fetch_batch_errors_total', fetch_mode=fetch_mode)
+            delay = batcher.failed(batch_ids, e)
+            if delay is not None:
+                print(f"处理第 {batch_no} 批邮件时出错，{delay:.1f} 秒后重试: {e}")
+                time.sleep(delay)
+                continue
+            print(f"处理第 {batch_no} 批邮件时出错: {e}")
+            yield batch_ids, [], e
+            if is_connection_error(e):
+                # 连接已断开，剩余的邮件留到下次运行
+                rest = batcher.abandon()
+                if rest:
+                    yield rest, [], e
+                return
+            continue
+        elapsed = time.perf_counter() - batch_started
+        batcher.succeeded(batch_ids, elapsed)
+        metrics.observe('fetch_batch_seconds', elapsed, fetch_mode=fetch_mode)
+        metrics.count('emails_fetched_total', len(batch_emails), fetch_mode=fetch_mode)
+        metrics.debug("第 %s 批邮件处理完成", batch_no)
+        yield batch_ids, batch_emails, None
+
+def fetch_emails(client, start_date=None, end_date=None, email_address=None, sync_state=None, db_config=None,
+                 fetch_mode='partial', cache=None, backend=None, parse_pool=None):
+    """获取邮件并全部返回
+    
+    适合少量邮件；大量邮件请使用import_emails边获取边入库。
+    sync_state会被原地更新，调用方应在邮件入库成功后保存它。
+    fetch_mode为'partial'时按两阶段方式只下载头部和正文部分，为'rfc822'时下载完整邮件。
+    backend和parse_pool见iter_email_batches，client仍用于SEARCH和同步状态。
+    """
+    try:
+        email_ids, windowed = plan_email_uids(client, start_date, end_date, sync_state, db_config)
         
         emails = []
-        batch_size = 50
+        first_failed_uid = None
         print(f"开始处理邮件，总共 {len(email_ids)} 封")
-        for i in range(0, len(email_ids), batch_size):
-            batch_ids = email_ids[i:i+batch_size]
-            print(f"正在处理第 {i//batch_size + 1} 批邮件，邮件ID范围 {min(batch_ids)}-{max(batch_ids)}")
-            
-            try:
-                msg_data = client.fetch(batch_ids, ['RFC822'])
-                print(f"第 {i//batch_size + 1} 批邮件数据获取完成")
-                for msg_id in batch_ids:
-                    if msg_id not in msg_data or b'RFC822' not in msg_data[msg_id]:
-                        print(f"未找到邮件ID {msg_id} 的数据")
-                        continue
-                    
-                    msg = email.message_from_bytes(msg_data[msg_id][b'RFC822'])
-                    
-                    # 解码主题
-                    subject = ""
-                    subject_header = decode_header(msg.get('Subject', ''))
-                    for part, encoding in subject_header:
-                        if isinstance(part, bytes):
-                            subject += part.decode(encoding or 'utf-8', errors='ignore')
-                        else:
-                            subject += str(part)
-                    
-                    # 获取基本信息
-                    sender = msg.get('From', '')
-                    recipient = msg.get('To', '')
-                    raw_send_date = msg.get('Date', '')
-                    
-                    # 格式化日期为统一格式
-                    send_date = raw_send_date
-                    if raw_send_date:
-                        try:
-                            # 解析邮件头中的日期
-                            parsed_date = email.utils.parsedate_to_datetime(raw_send_date)
-                            if parsed_date:
-                                # 转换为MySQL DATETIME格式 (YYYY-MM-DD HH:MM:SS)
-                                send_date = parsed_date.strftime('%Y-%m-%d %H:%M:%S')
-                        except Exception as e:
-                            print(f"解析邮件日期时出错: {e}")
-                            # 如果解析失败，保留原始日期
-                            send_date = raw_send_date
-                    
-                    # 获取邮件正文
-                    body = get_email_body(msg)
-                    
-                    emails.append({
-                        'imap_id': msg_id,
-                        'subject': subject,
-                        'sender': sender,
-                        'recipient': recipient,
-                        'send_date': send_date,
-                        'body': body
-                    })
-                    
-                    # 每处理10封邮件输出一次进度
-                    if len(emails) % 10 == 0:
-                        print(f"已处理 {len(emails)} 封邮件")
-                
-                print(f"第 {i//batch_size + 1} 批邮件处理完成")
-            except Exception as e:
-                print(f"处理第 {i//batch_size + 1} 批邮件时出错: {e}")
-                continue
+        uidvalidity = sync_state['uidvalidity'] if sync_state else None
+        for batch_ids, batch_emails, error in iter_email_batches(client, email_ids, fetch_mode, cache=cache,
+                                                                 uidvalidity=uidvalidity, backend=backend,
+                                                                 parse_pool=parse_pool):
+            # 重试后仍失败的批次可能晚于后面的批次产出，取所有失败批次中最小的UID
+            if error is not None and (first_failed_uid is None or min(batch_ids) < first_failed_uid):
+                first_failed_uid = min(batch_ids)
+            emails.extend(batch_emails)
+        
+        # 只把同步位置推进到第一个失败批次之前，保证失败的邮件下次还会被获取
+        if sync_state is not None and not windowed and email_ids:
+            synced_uids = [uid for uid in email_ids if first_failed_uid is None or uid < first_failed_uid]
+            if synced_uids:
+                sync_state['last_uid'] = max(sync_state['last_uid'], max(synced_uids))
         
         print(f"邮件获取完成，总共处理 {len(emails)} 封邮件")
         return emails
@@ -265,61 +1264,349 @@ def fetch_emails(client, start_date=None, end_date=None, email_address=None):
         print(f"获取邮件时出错: {e}")
         return []
 
+def import_emails(client, db_config, sync_state, start_date=None, end_date=None, fetch_mode='partial', cache=None,
+                  progress=None, cancel=None, backend=None, parse_pool=None, max_messages=None):
+    """流式导入邮件：逐批 获取 → 解析 → 入库 → 保存断点
+    
+    每批邮件写入后立即保存同步状态作为断点，中断后再次运行会从断点继续：
+    未指定日期范围时从最后提交的UID继续，指定日期范围时跳过已入库的UID。
+    progress(已处理数, 新增数, 总数) 在每批之后调用；cancel（threading.Event）被设置时
+    在下一批开始前停止，已提交的批次保留。
+    max_messages限制本次最多获取的邮件数（UID最小的部分），其余的留给下次调用，
+    progress报告的总数此时为本次计划获取的邮件数。
+    
+    Returns:
+        tuple: (处理的邮件数, 新增的邮件数)
+    """
+    email_ids, windowed = plan_email_uids(client, start_date, end_date, sync_state, db_config)
+    if max_messages and len(email_ids) > max_messages:
+        email_ids = email_ids[:max_messages]
+        # 还有邮件留给下次，不能让下次按UIDNEXT判断为没有变化
+        sync_state['uidnext'] = None
+    
+    with connect_email_db(db_config) as connection:
+        with connection.cursor() as cursor:
+            ensure_email_tables(cursor)
+            # 先记录新的UIDVALIDITY，保证下次运行能正确判断是否需要全量同步
+            write_sync_state(cursor, sync_state)
+            if not email_ids:
+                return 0, 0
+            
+            print(f"开始处理邮件，总共 {len(email_ids)} 封")
+            return import_uid_batches(connection, cursor, client, email_ids, windowed, sync_state,
+                                      fetch_mode, cache, progress, cancel, backend, parse_pool)
+
+def import_uid_batches(connection, cursor, client, email_ids, windowed, sync_state, fetch_mode='partial',
+                       cache=None, progress=None, cancel=None, backend=None, parse_pool=None):
+    """逐批获取指定的UID，按缓冲的大小和时间合并入库（见 adaptive_batch.WriteBuffer），与同步状态在同一个事务中提交
+    
+    入库期间不从获取端取下一批，获取端随之暂停。重试的批次可能晚于后面的批次产出，
+    未指定日期范围时同步位置只推进到连续获取成功并已提交的UID，不会越过失败的邮件。
+    
+    Returns:
+        tuple: (处理的邮件数, 新增的邮件数)
+    """
+    processed_count = 0
+    inserted_count = 0
+    if progress:
+        progress(0, 0, len(email_ids))
+    buffer = WriteBuffer()
+    buffered_uids = []
+    # 已提交但同步位置还不能越过的UID（前面有未完成的UID）
+    committed = set()
+    position = 0
+    flushing = False
+    
+    def flush():
+        nonlocal processed_count, inserted_count, position, flushing
+        flushing = True
+        emails = buffer.take()
+        connection.begin()
+        if emails:
+            inserted_count += upsert_emails(cursor, emails, uidvalidity=sync_state['uidvalidity'],
+                                            account=sync_state['account'], folder=sync_state['folder'])
+        if not windowed:
+            committed.update(buffered_uids)
+            while position < len(email_ids) and email_ids[position] in committed:
+                committed.discard(email_ids[position])
+                position += 1
+            if position:
+                sync_state['last_uid'] = max(sync_state['last_uid'], email_ids[position - 1])
+        write_sync_state(cursor, sync_state)
+        with metrics.timer('db_commit_seconds'):
+            connection.commit()
+        buffered_uids.clear()
+        processed_count += len(emails)
+        flushing = False
+        print(f"已处理 {processed_count} 封邮件")
+        if progress:
+            progress(processed_count, inserted_count, len(email_ids))
+    
+    try:
+        for batch_ids, batch_emails, error in iter_email_batches(
+                client, email_ids, fetch_mode, cache=cache, uidvalidity=sync_state['uidvalidity'],
+                backend=backend, parse_pool=parse_pool):
+            if cancel is not None and cancel.is_set():
+                raise ImportInterrupted()
+            if error is not None:
+                # 失败的UID不会提交，同步位置停在它们之前
+                continue
+            buffer.add(batch_emails)
+            buffered_uids.extend(batch_ids)
+            if buffer.full():
+                flush()
+        if buffered_uids:
+            flush()
+    except ImportInterrupted:
+        # 已获取的邮件先提交；中断发生在提交过程中时该事务放弃
+        if buffered_uids and not flushing:
+            flush()
+        print(f"导入被中断，已提交 {processed_count} 封邮件，下次运行将从断点继续")
+    
+    return processed_count, inserted_count
+
+# IDLE会话的最长保持时间（秒），RFC 2177要求客户端在29分钟内重新发起IDLE
+IDLE_RENEW_INTERVAL = 25 * 60
+# 每次等待服务器推送的超时时间（秒），期间可以响应停止请求
+IDLE_CHECK_TIMEOUT = 30
+# 服务器不支持IDLE时NOOP轮询的间隔（秒）
+NOOP_POLL_INTERVAL = 30
+# 监听连接断开后重新连接前的等待时间（秒）
+WATCH_RETRY_DELAY = 10
+
+def _untagged(responses, keyword):
+    """从IDLE/NOOP的未标记响应中取出指定类型的条目，如 (3, b'EXISTS')"""
+    return [r for r in responses if isinstance(r, tuple) and len(r) >= 2 and r[1] == keyword]
+
+def _wait_for_changes(client, use_idle, stop):
+    """等待邮箱变化，返回收到的未标记响应；stop被设置时尽快返回"""
+    if not use_idle:
+        stop.wait(NOOP_POLL_INTERVAL)
+        if stop.is_set():
+            return []
+        return client.noop()[1]
+    
+    responses = []
+    client.idle()
+    try:
+        started = time.monotonic()
+        while not stop.is_set() and time.monotonic() - started < IDLE_RENEW_INTERVAL:
+            responses = client.idle_check(timeout=IDLE_CHECK_TIMEOUT)
+            if responses:
+                break
+    finally:
+        responses = list(responses) + list(client.idle_done()[1])
+    return responses
+
+def watch_inbox(client, db_config, sync_state, fetch_mode='partial', cache=None, on_change=None, stop=None):
+    """保持IDLE会话监听收件箱，收到新邮件时只获取新增的UID并入库
+    
+    服务器不支持IDLE时退化为定时NOOP轮询。每次入库后调用 on_change(事件)，事件格式：
+    {'type': 'new', 'uids': [...], 'processed': n, 'inserted': m} 或 {'type': 'expunge', 'count': n}。
+    没有同步位置（只按日期范围获取过）或UIDVALIDITY变化时，从当前最新的邮件开始监听，
+    监听起点只保存在内存中、不推进同步位置，之后不带日期范围的获取仍会导入历史邮件。
+    stop（threading.Event）被设置时返回。
+    """
+    stop = stop or threading.Event()
+    select_info, full_resync, _ = select_folder_for_sync(client, 'INBOX', sync_state)
+    # 没有同步位置时按窗口导入新邮件（同步位置不变），否则从同步位置补上漏掉的邮件
+    windowed = full_resync or not sync_state['last_uid']
+    watch_uid = sync_state['last_uid']
+    if windowed and select_info.get(b'UIDNEXT'):
+        watch_uid = select_info[b'UIDNEXT'] - 1
+        print(f"从UID {watch_uid} 之后开始监听，历史邮件在下次不带日期范围获取时导入")
+    use_idle = client.has_capability('IDLE')
+    print(f"开始监听收件箱 ({'IDLE' if use_idle else f'每{NOOP_POLL_INTERVAL}秒NOOP轮询'})")
+    
+    with connect_email_db(db_config) as connection:
+        with connection.cursor() as cursor:
+            ensure_email_tables(cursor)
+            write_sync_state(cursor, sync_state)
+            # 先补上监听开始前到达的邮件
+            responses = [(0, b'EXISTS')]
+            while not stop.is_set():
+                if _untagged(responses, b'EXISTS'):
+                    uids = [uid for uid in client.search(['UID', f"{watch_uid + 1}:*"]) if uid > watch_uid]
+                    if uids:
+                        # 长时间空闲后MySQL可能已断开连接
+                        connection.ping(reconnect=True)
+                        processed, inserted = import_uid_batches(
+                            connection, cursor, client, sorted(uids), windowed, sync_state, fetch_mode, cache
+                        )
+                        watch_uid = max(uids) if windowed else sync_state['last_uid']
+                        if on_change:
+                            on_change({'type': 'new', 'uids': sorted(uids), 'processed': processed,
+                                       'inserted': inserted})
+                expunged = _untagged(responses, b'EXPUNGE')
+                if expunged and on_change:
+                    on_change({'type': 'expunge', 'count': len(expunged)})
+                responses = _wait_for_changes(client, use_idle, stop)
+
+def run_watch(email, password, imap_server, db_config, fetch_mode='partial', cache=None, on_change=None, stop=None):
+    """持续监听收件箱，连接断开后自动重连，直到stop被设置"""
+    stop = stop or threading.Event()
+    if cache is not None:
+        cache = cache.for_mailbox(email, 'INBOX')
+    while not stop.is_set():
+        client = None
+        try:
+            sync_state = load_sync_state(db_config, email, 'INBOX')
+            client = connect_to_qq_mail(email, password, imap_server)
+            watch_inbox(client, db_config, sync_state, fetch_mode, cache, on_change, stop)
+        except Exception as e:
+            print(f"监听收件箱出错，{WATCH_RETRY_DELAY}秒后重新连接: {e}")
+            stop.wait(WATCH_RETRY_DELAY)
+        finally:
+            if client is not None:
+                try:
+                    client.logout()
+                except Exception:
+                    pass
+
+def run_import(email, password, imap_server, db_config, start_date=None, end_date=None, fetch_mode='partial',
+               connections=1, bulk=False, cache=None, progress=None, cancel=None, fetch_backend='imapclient',
+               folder='INBOX', parse_pool=None, max_messages=None):
+    """完成一次完整的导入：读取断点、连接邮箱、获取并入库邮件
+    
+    命令行和常驻服务（imap_worker.py）共用。progress和cancel只在单连接的流式导入中生效。
+    fetch_backend为'asyncio'时邮件内容由async_imap在第二个连接上流水线获取，
+    SEARCH和同步状态仍使用IMAPClient连接。每个 (账号, 文件夹) 有独立的断点。
+    parse_pool（parse_pool.ParsePool）可以由多次导入共用，未提供时回填模式和asyncio后端各自创建。
+    max_messages只在单连接的流式导入中生效，见import_emails。
+    
+    Returns:
+        tuple: (处理的邮件数, 新增的邮件数)
+    """
+    if connections > 1 or bulk:
+        from script.imap_backfill import run_backfill
+        return run_backfill(
+            email, password, imap_server, db_config, start_date, end_date,
+            connections, fetch_mode=fetch_mode, bulk=bulk, cache=cache, folder=folder, parse_pool=parse_pool
+        )
+    
+    # 读取上次的同步状态（即导入断点）
+    sync_state = load_sync_state(db_config, email, folder)
+    if cache is not None:
+        cache = cache.for_mailbox(email, folder)
+    client = connect_to_qq_mail(email, password, imap_server)
+    backend = None
+    if fetch_backend == 'asyncio':
+        from script.async_imap import AsyncFetchBackend
+        backend = AsyncFetchBackend(email, password, imap_server, folder=folder, parse_pool=parse_pool)
+    try:
+        return import_emails(client, db_config, sync_state, start_date, end_date, fetch_mode, cache,
+                             progress, cancel, backend, parse_pool, max_messages)
+    finally:
+        try:
+            client.logout()
+            metrics.debug("邮箱连接已关闭")
+        except Exception as e:
+            metrics.debug("关闭邮箱连接时出错: %s", e)
+
+def _raise_interrupted(signum, frame):
+    raise ImportInterrupted()
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(
+        description='从IMAP邮箱获取邮件并保存到数据库',
+        usage='python qq_email_imap.py <email> <password> <imap_server> [start_date] [end_date] [选项]'
+    )
+    parser.add_argument('email', help='邮箱地址')
+    parser.add_argument('password', help='邮箱授权码')
+    parser.add_argument('imap_server', help='IMAP服务器地址')
+    parser.add_argument('start_date', nargs='?', default=None, help='开始日期 (YYYY-MM-DD)')
+    parser.add_argument('end_date', nargs='?', default=None, help='结束日期 (YYYY-MM-DD)')
+    parser.add_argument('--fetch-mode', choices=['partial', 'rfc822'], default='partial',
+                        help='partial: 只下载头部和正文部分（默认）；rfc822: 下载完整邮件')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='大于1时使用多连接并发回填模式 (见 imap_backfill.py)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='使用回填模式并批量合并入库，适合大量导入')
+    parser.add_argument('--folder', default='INBOX', help='要同步的文件夹（默认INBOX）')
+    parser.add_argument('--backend', choices=['imapclient', 'asyncio'], default='imapclient',
+                        help='asyncio: 在单个连接上流水线发送多条UID FETCH，解析在进程池中进行')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='大于0时完整邮件交给该数量的解析进程，原始邮件经共享内存传递（见 parse_pool.py）')
+    parser.add_argument('--watch', action='store_true',
+                        help='持续监听收件箱（IDLE，不支持时NOOP轮询），新邮件到达后立即入库并输出变更事件')
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
 def main():
     """主函数"""
     try:
-        if len(sys.argv) < 4:
-            print("用法: python qq_email_imap.py <email> <password> <imap_server> [start_date] [end_date]", file=sys.stderr)
-            sys.exit(1)
-        
-        email = sys.argv[1]
-        password = sys.argv[2]
-        imap_server = sys.argv[3]
-        start_date = sys.argv[4] if len(sys.argv) > 4 else None
-        end_date = sys.argv[5] if len(sys.argv) > 5 else None
+        args = parse_args()
+        metrics.configure_from_args(config.config.get('metrics'), args)
+        email = args.email
+        password = args.password
+        imap_server = args.imap_server
+        start_date = args.start_date
+        end_date = args.end_date
         
-        print(f"[DEBUG] 开始执行邮件获取脚本")
-        print(f"[DEBUG] 邮箱: {email}")
+        metrics.debug("开始执行邮件获取脚本，邮箱: %s", email)
         if start_date and end_date:
-            print(f"[DEBUG] 日期范围: {start_date} 到 {end_date}")
+            metrics.debug("日期范围: %s 到 %s", start_date, end_date)
         
-        # 连接邮箱
-        client = connect_to_qq_mail(email, password, imap_server)
+        db_config = {
+            'host': config.config['db']['host'],
+            'user': config.config['db']['user'],
+            'password': config.config['db']['password'],
+            'database': 'job_emails',
+            'charset': config.config['db']['charset']
+        }
         
-        # 获取邮件
-        emails = fetch_emails(client, start_date, end_date, email)
-        processed_count = len(emails)  # 记录处理的邮件数量
+        # 原始邮件本地缓存，已下载过的邮件不再访问服务器
+        cache = open_cache(config.config.get('cache'))
         
-        print(f"[DEBUG] 获取到的邮件总数: {processed_count}")
+        if args.watch:
+            # 收到终止信号时在当前批次完成后停止监听；每个变更事件输出一行JSON
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            def print_change(change):
+                print(json.dumps({'event': 'change', **change}, ensure_ascii=False), flush=True)
+            try:
+                run_watch(email, password, imap_server, db_config, args.fetch_mode, cache, print_change, stop)
+            except KeyboardInterrupt:
+                pass
+            print("已停止监听")
+            return
         
-        # 保存到数据库
-        inserted_count = 0
-        if emails:
-            db_config = {
-                'host': config.config['db']['host'],
-                'user': config.config['db']['user'],
-                'password': config.config['db']['password'],
-                'database': 'job_emails',
-                'charset': config.config['db']['charset']
-            }
-            print(f"[DEBUG] 数据库配置: {db_config}")
-            inserted_count = save_emails_to_database(emails, db_config)
-            print(f"[DEBUG] 总共处理 {processed_count} 封邮件，新增 {inserted_count} 封邮件")
+        # 收到终止信号时中断导入，已提交的批次和断点会保留
+        signal.signal(signal.SIGTERM, _raise_interrupted)
+        
+        parse_pool = None
+        if args.parse_workers > 0:
+            from script.parse_pool import ParsePool
+            parse_pool = ParsePool(args.parse_workers)
+        
+        # 连接邮箱，逐批获取并保存邮件
+        try:
+            processed_count, inserted_count = run_import(
+                email, password, imap_server, db_config, start_date, end_date, args.fetch_mode,
+                args.connections, args.bulk, cache, fetch_backend=args.backend, folder=args.folder,
+                parse_pool=parse_pool
+            )
+        except ImportInterrupted:
+            print("导入被中断，下次运行将从断点继续")
+            processed_count, inserted_count = 0, 0
+        finally:
+            if parse_pool is not None:
+                parse_pool.close()
+        
+        if processed_count:
             print(f"总共处理 {processed_count} 封邮件，新增 {inserted_count} 封邮件")
         else:
-            print("[DEBUG] 没有获取到任何邮件")
-            print("[DEBUG] 总共处理 0 封邮件，新增 0 封邮件")
             print("没有获取到任何邮件")
             print("总共处理 0 封邮件，新增 0 封邮件")
         
-        # 关闭连接
-        try:
-            client.logout()
-            print("[DEBUG] 邮箱连接已关闭")
-        except Exception as e:
-            print(f"[DEBUG] 关闭邮箱连接时出错: {e}")
+        if cache:
+            summary = cache.summary()
+            metrics.debug("原始邮件缓存: 命中 %s 次, 未命中 %s 次", summary['hits'], summary['misses'])
+        metrics.report()
+        metrics.flush()
     except Exception as e:
-        print(f"[DEBUG] 主函数执行时发生错误: {e}", file=sys.stderr)
+        metrics.error("主函数执行时发生错误: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,304 @@
+# 原始邮件（RFC822）的本地缓存：qq_email_imap.py、imap_backfill.py 和 get_email_body_by_id.py 共用
+import argparse
+import hashlib
+import mmap
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+# 默认缓存目录（项目根目录下）
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'raw_messages')
+# 默认缓存上限（压缩后的字节数）
+DEFAULT_MAX_MB = 512
+# 压缩级别：原始邮件以文本和base64为主，6级在速度和压缩率之间比较均衡
+COMPRESS_LEVEL = 6
+# 最近访问时间的更新粒度（秒），避免每次命中都写索引
+TOUCH_INTERVAL = 60
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    raw_size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_blobs_last_access ON blobs (last_access);
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_keys_digest ON keys (digest);
+"""
+
+
+def uid_key(mailbox, uidvalidity, uid):
+    """mailbox为 (账号, 文件夹)：不同文件夹、不同账号的UIDVALIDITY可能相同"""
+    account, folder = mailbox
+    return f'uid:{account}:{folder}:{uidvalidity}:{uid}'
+
+
+def message_id_key(message_id_hash):
+    if isinstance(message_id_hash, (bytes, bytearray)):
+        message_id_hash = message_id_hash.hex()
+    return f'mid:{message_id_hash.lower()}'
+
+
+class RawMessageCache:
+    """按内容寻址的原始邮件缓存
+
+    邮件以sha256为文件名压缩存放，相同内容只存一份；通过 (账号, 文件夹, UIDVALIDITY, UID) 或
+    Message-ID哈希查找，按UID查找和写入需指定mailbox或使用 for_mailbox 返回的视图。
+    索引保存在SQLite中，多个进程可以同时读写。
+    总大小超过上限时按最近访问时间淘汰：总大小在打开时统计一次，之后随写入和淘汰累加，
+    超过上限时才重新统计（包括其他进程的写入）并淘汰。
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'puts': 0, 'evictions': 0}
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        with self._db() as db:
+            db.executescript(INDEX_SCHEMA)
+        self._total_lock = threading.Lock()
+        self._total = self._db().execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def _db(self):
+        """每个线程使用独立的SQLite连接"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            self.stats[name] += n
+
+    def _path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest[2:])
+
+    def _read(self, digest):
+        """通过mmap读取并解压，文件已被淘汰时返回None"""
+        try:
+            with open(self._path(digest), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return zlib.decompress(mapped)
+        except (OSError, zlib.error):
+            return None
+
+    def for_mailbox(self, account, folder):
+        """返回限定在一个 (账号, 文件夹) 中的缓存视图"""
+        return MailboxCache(self, account, folder)
+
+    def get(self, uidvalidity=None, uid=None, message_id_hash=None, mailbox=None):
+        """查找原始邮件，依次尝试 (mailbox, UIDVALIDITY, UID) 和 Message-ID哈希
+
+        Returns:
+            bytes | None: 原始邮件，未缓存时返回None
+        """
+        keys = []
+        if mailbox is not None and uidvalidity is not None and uid is not None:
+            keys.append(uid_key(mailbox, uidvalidity, uid))
+        if message_id_hash:
+            keys.append(message_id_key(message_id_hash))
+        db = self._db()
+        for key in keys:
+            row = db.execute(
+                'SELECT b.digest, b.last_access FROM keys k JOIN blobs b ON b.digest = k.digest WHERE k.key = ?',
+                (key,)
+            ).fetchone()
+            if not row:
+                continue
+            raw = self._read(row[0])
+            if raw is None:
+                continue
+            now = time.time()
+            if now - row[1] >= TOUCH_INTERVAL:
+                with db:
+                    db.execute('UPDATE blobs SET last_access = ? WHERE digest = ?', (now, row[0]))
+            self._count('hits')
+            return raw
+        self._count('misses')
+        return None
+
+    def get_many(self, uidvalidity, uids, mailbox=None):
+        """批量按UID查找，返回 {uid: 原始邮件}，未缓存的UID不在结果中"""
+        found = {}
+        if mailbox is None or uidvalidity is None:
+            self._count('misses', len(uids))
+            return found
+        for uid in uids:
+            raw = self.get(uidvalidity, uid, mailbox=mailbox)
+            if raw is not None:
+                found[uid] = raw
+        return found
+
+    def put(self, raw, uidvalidity=None, uid=None, message_id_hash=None, mailbox=None):
+        """保存原始邮件并建立索引（未指定mailbox时不建UID索引），返回内容摘要"""
+        digest = hashlib.sha256(raw).hexdigest()
+        keys = []
+        if mailbox is not None and uidvalidity is not None and uid is not None:
+            keys.append(uid_key(mailbox, uidvalidity, uid))
+        if message_id_hash:
+            keys.append(message_id_key(message_id_hash))
+
+        db = self._db()
+        path = self._path(digest)
+        size = None
+        row = db.execute('SELECT size FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        added = row is None
+        if row and os.path.exists(path):
+            size = row[0]
+        else:
+            data = zlib.compress(raw, COMPRESS_LEVEL)
+            size = len(data)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，读取方不会看到写了一半的文件
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with db:
+            db.execute(
+                'INSERT INTO blobs (digest, size, raw_size, last_access) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(digest) DO UPDATE SET last_access = excluded.last_access',
+                (digest, size, len(raw), time.time())
+            )
+            db.executemany('INSERT OR REPLACE INTO keys (key, digest) VALUES (?, ?)',
+                           [(key, digest) for key in keys])
+        self._count('puts')
+        if added:
+            with self._total_lock:
+                self._total += size
+                over = self._total > self.max_bytes
+            if over:
+                self.evict()
+        return digest
+
+    def evict(self):
+        """总大小超过上限时，按最近访问时间淘汰最旧的邮件，返回淘汰的数量"""
+        db = self._db()
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        with self._total_lock:
+            self._total = total
+        if total <= self.max_bytes:
+            return 0
+        # 一次多淘汰一些（降到上限的90%），避免每次写入都触发淘汰
+        target = self.max_bytes * 0.9
+        evicted = []
+        evicted_bytes = 0
+        for digest, size in db.execute('SELECT digest, size FROM blobs ORDER BY last_access'):
+            if total <= target:
+                break
+            evicted.append(digest)
+            evicted_bytes += size
+            total -= size
+        with db:
+            db.executemany('DELETE FROM keys WHERE digest = ?', [(d,) for d in evicted])
+            db.executemany('DELETE FROM blobs WHERE digest = ?', [(d,) for d in evicted])
+        with self._total_lock:
+            self._total -= evicted_bytes
+        for digest in evicted:
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+        self._count('evictions', len(evicted))
+        return len(evicted)
+
+    def summary(self):
+        """缓存占用情况和本进程的命中统计"""
+        count, size, raw_size = self._db().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(raw_size), 0) FROM blobs'
+        ).fetchone()
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'messages': count,
+            'bytes': size,
+            'raw_bytes': raw_size,
+            'max_bytes': self.max_bytes,
+            'hit_rate': stats['hits'] / lookups if lookups else 0.0,
+        })
+        return stats
+
+
+class MailboxCache:
+    """一个 (账号, 文件夹) 的缓存视图：get/get_many/put按UID查找时限定在该文件夹内，其余属性与原缓存相同"""
+
+    def __init__(self, cache, account, folder):
+        self.cache = cache
+        self.mailbox = (account, folder)
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def get(self, uidvalidity=None, uid=None, message_id_hash=None):
+        return self.cache.get(uidvalidity, uid, message_id_hash, self.mailbox)
+
+    def get_many(self, uidvalidity, uids):
+        return self.cache.get_many(uidvalidity, uids, self.mailbox)
+
+    def put(self, raw, uidvalidity=None, uid=None, message_id_hash=None):
+        return self.cache.put(raw, uidvalidity, uid, message_id_hash, self.mailbox)
+
+
+def open_cache(cache_config):
+    """根据配置中的cache部分创建缓存，未启用（默认）或创建失败时返回None"""
+    cache_config = cache_config or {}
+    if not cache_config.get('enabled', False):
+        return None
+    try:
+        return RawMessageCache(
+            cache_config.get('dir') or DEFAULT_CACHE_DIR,
+            int(cache_config.get('max_mb') or DEFAULT_MAX_MB) * 1024 * 1024
+        )
+    except Exception as e:
+        print(f"原始邮件缓存不可用: {e}", file=sys.stderr)
+        return None
+
+
+def main():
+    """主函数"""
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import script.config as config
+
+    parser = argparse.ArgumentParser(description='原始邮件缓存管理')
+    parser.add_argument('command', choices=['stats', 'reparse'],
+                        help='stats: 查看缓存占用；reparse: 用缓存中的原始邮件重新提取正文并更新数据库')
+    args = parser.parse_args()
+
+    cache = open_cache(config.config.get('cache'))
+    if cache is None:
+        print("原始邮件缓存未启用", file=sys.stderr)
+        sys.exit(1)
+    if args.command == 'stats':
+        summary = cache.summary()
+        print(f"缓存 {summary['messages']} 封邮件, 压缩后 {summary['bytes'] / 1024 / 1024:.1f} MB "
+              f"(原始 {summary['raw_bytes'] / 1024 / 1024:.1f} MB), 上限 {summary['max_bytes'] / 1024 / 1024:.0f} MB")
+        return
+
+    from script.qq_email_imap import reparse_cached_emails
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+    reparsed, missing = reparse_cached_emails(db_config, cache)
+    print(f"重新解析 {reparsed} 封邮件，{missing} 封未缓存")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+# 邮箱与all_emails对账：找出服务器上已删除或移走的邮件，在数据库中标记（或删除）对应的行
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script.config as config
+from script.qq_email_imap import connect_email_db, connect_to_qq_mail, ensure_email_tables
+from script.search_index import remove_from_index
+from script.analytics_rollup import add_email_days
+from script import metrics
+
+# 对账用的临时表：UID区间，以上界为主键，按"上界不小于uid的第一个区间"一次索引查找判断覆盖
+RANGES_TABLE_SQL = """
+CREATE TEMPORARY TABLE reconcile_uid_ranges (
+    lo INT UNSIGNED NOT NULL,
+    hi INT UNSIGNED NOT NULL PRIMARY KEY
+) ENGINE=InnoDB
+"""
+# 每次INSERT的区间数
+RANGE_INSERT_ROWS = 1000
+# uid是否落在临时表的某个区间内
+_UID_COVERED = ("COALESCE((SELECT r.lo FROM reconcile_uid_ranges r WHERE r.hi >= a.uid "
+                "ORDER BY r.hi LIMIT 1) <= a.uid, FALSE)")
+# 删除模式下每次删除的行数
+DELETE_CHUNK_SIZE = 1000
+
+_ESEARCH_ALL_RE = re.compile(rb'\bALL\s+([0-9:,]+)')
+_SEQUENCE_SET_RE = re.compile(rb'([0-9:,]+)\s*$')
+
+
+def uids_to_ranges(uids):
+    """把UID集合压缩为按升序排列的闭区间列表 [(lo, hi)]"""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return [tuple(r) for r in ranges]
+
+
+def parse_sequence_set(text):
+    """解析IMAP序列集（如 b'1:3,5,9:7'），返回合并后的闭区间列表"""
+    if isinstance(text, bytes):
+        text = text.decode('ascii')
+    ranges = []
+    for part in text.split(','):
+        if not part:
+            continue
+        lo, _, hi = part.partition(':')
+        lo, hi = int(lo), int(hi or lo)
+        ranges.append((min(lo, hi), max(lo, hi)))
+    ranges.sort()
+    merged = []
+    for lo, hi in ranges:
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return [tuple(r) for r in merged]
+
+
+def server_uid_ranges(client):
+    """当前文件夹中全部邮件的UID区间
+
+    服务器支持ESEARCH时用 UID SEARCH RETURN (ALL) ALL，响应本身就是压缩后的序列集，
+    10万封邮件通常只有几十字节到几KB；否则退化为普通SEARCH（每个UID约7字节）。
+
+    Returns:
+        tuple: (区间列表, 使用的方式 'esearch' 或 'search')
+    """
+    if client.has_capability('ESEARCH'):
+        data = client._raw_command_untagged(b'SEARCH', [b'RETURN', b'(ALL)', b'ALL'],
+                                            response_name='ESEARCH', unpack=True)
+        if data is not None:
+            match = _ESEARCH_ALL_RE.search(data)
+            # 没有ALL项表示文件夹为空
+            return (parse_sequence_set(match.group(1)) if match else []), 'esearch'
+        metrics.warn("服务器没有返回ESEARCH结果，改用普通SEARCH")
+    return uids_to_ranges(client.search(['ALL'])), 'search'
+
+
+def vanished_uid_ranges(client, modseq):
+    """QRESYNC：自modseq之后被删除的邮件的UID区间（VANISHED (EARLIER)）
+
+    只对modseq之后有变化的邮件返回 UID，已删除的邮件以压缩的序列集返回。
+    """
+    untagged = client._imap.untagged_responses
+    untagged.pop('VANISHED', None)
+    client.fetch('1:*', ['UID'], modifiers=[f'CHANGEDSINCE {modseq}', 'VANISHED'])
+    ranges = []
+    for data in untagged.pop('VANISHED', []):
+        match = _SEQUENCE_SET_RE.search(data or b'')
+        if match:
+            ranges.extend(parse_sequence_set(match.group(1)))
+    return parse_sequence_set(','.join(f'{lo}:{hi}' for lo, hi in ranges))
+
+
+def _load_ranges(cursor, ranges):
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS reconcile_uid_ranges")
+    cursor.execute(RANGES_TABLE_SQL)
+    for i in range(0, len(ranges), RANGE_INSERT_ROWS):
+        cursor.executemany("INSERT INTO reconcile_uid_ranges (lo, hi) VALUES (%s, %s)",
+                           ranges[i:i+RANGE_INSERT_ROWS])
+
+
+def mark_orphans(cursor, account, folder, uidvalidity, uid_limit, ranges, present=True, stale_uidvalidity=False):
+    """用一条UPDATE把服务器上已不存在的邮件标记为孤儿（orphaned_at），返回标记的行数
+
+    present为True时ranges是服务器上现有的UID，不在其中的行是孤儿；
+    为False时ranges是已删除的UID（VANISHED），落在其中的行是孤儿。
+    只比较UID小于uid_limit（SELECT时的UIDNEXT）的行，对账期间新入库的邮件不受影响。
+    stale_uidvalidity为True时同一文件夹中UIDVALIDITY不是当前值的行也标记为孤儿
+    （UIDVALIDITY变化后已完成全量同步，还在的邮件都已更新为新的UIDVALIDITY）。
+    """
+    _load_ranges(cursor, ranges)
+    condition = f"NOT {_UID_COVERED}" if present else _UID_COVERED
+    stale = " OR a.uidvalidity <> %s" if stale_uidvalidity else ""
+    params = [account, folder, uid_limit, uidvalidity] + ([uidvalidity] if stale_uidvalidity else [])
+    cursor.execute(
+        "UPDATE all_emails a SET a.orphaned_at = NOW() "
+        "WHERE a.account = %s AND a.folder = %s AND a.orphaned_at IS NULL AND a.uid IS NOT NULL "
+        f"AND a.uid < %s AND ((a.uidvalidity = %s AND {condition}){stale})",
+        params
+    )
+    marked = cursor.rowcount
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS reconcile_uid_ranges")
+    return marked
+
+
+def purge_orphans(cursor, account, folder):
+    """删除该文件夹中已标记为孤儿的行及其搜索索引，并更新所在日期的预聚合邮件数，返回删除的行数"""
+    cursor.execute(
+        "SELECT id, DATE(send_ts) FROM all_emails WHERE account = %s AND folder = %s AND orphaned_at IS NOT NULL",
+        (account, folder)
+    )
+    rows = cursor.fetchall()
+    ids = [row[0] for row in rows]
+    for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+        chunk = ids[i:i+DELETE_CHUNK_SIZE]
+        remove_from_index(cursor, chunk)
+        cursor.execute(f"DELETE FROM all_emails WHERE id IN ({','.join(['%s'] * len(chunk))})", chunk)
+    day_counts = {}
+    for _, day in rows:
+        day_counts[day] = day_counts.get(day, 0) - 1
+    add_email_days(cursor, day_counts)
+    return len(ids)
+
+
+def _load_reconcile_state(cursor, account, folder):
+    cursor.execute(
+        "SELECT uidvalidity, reconciled_uidvalidity, reconciled_modseq FROM email_sync_state "
+        "WHERE account = %s AND folder = %s",
+        (account, folder)
+    )
+    return cursor.fetchone() or (None, None, None)
+
+
+def _save_reconcile_state(cursor, account, folder, uidvalidity, modseq):
+    cursor.execute(
+        "INSERT INTO email_sync_state (account, folder, reconciled_uidvalidity, reconciled_modseq) "
+        "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+        "reconciled_uidvalidity = VALUES(reconciled_uidvalidity), reconciled_modseq = VALUES(reconciled_modseq)",
+        (account, folder, uidvalidity, modseq)
+    )
+
+
+def enable_qresync(client):
+    """在选择文件夹之前启用QRESYNC（ENABLE只能在未选择文件夹时执行），返回是否启用成功"""
+    if not (client.has_capability('QRESYNC') and client.has_capability('ENABLE')):
+        return False
+    try:
+        return b'QRESYNC' in [c.upper() for c in client.enable('QRESYNC')]
+    except Exception as e:
+        metrics.debug("启用QRESYNC失败: %s", e)
+        return False
+
+
+def reconcile_folder(client, connection, account, folder='INBOX', delete=False, full=False, qresync=False):
+    """对账一个文件夹
+
+    qresync（enable_qresync的结果）为True且上次对账后UIDVALIDITY未变时只取上次对账之后删除的UID（VANISHED）；
+    HIGHESTMODSEQ未变化时直接跳过。否则取全部UID的区间与数据库比较（ESEARCH或SEARCH）。
+    标记在一个事务内完成，delete为True时再删除已标记的行。
+
+    Returns:
+        dict: {'folder', 'mode', 'ranges', 'orphaned', 'deleted'}
+    """
+    select_info = client.select_folder(folder, readonly=True)
+    uidvalidity = select_info.get(b'UIDVALIDITY')
+    uidnext = select_info.get(b'UIDNEXT')
+    highest_modseq = select_info.get(b'HIGHESTMODSEQ')
+
+    result = {'folder': folder, 'mode': None, 'ranges': 0, 'orphaned': 0, 'deleted': 0}
+    with connection.cursor() as cursor:
+        synced_uidvalidity, reconciled_uidvalidity, reconciled_modseq = _load_reconcile_state(cursor, account, folder)
+        incremental = (not full and qresync and highest_modseq is not None and reconciled_modseq is not None
+                       and reconciled_uidvalidity == uidvalidity)
+        with metrics.timer('reconcile_seconds', mode='vanished' if incremental else 'full'):
+            if incremental and reconciled_modseq == highest_modseq:
+                result['mode'] = 'unchanged'
+                ranges = None
+            elif incremental:
+                result['mode'] = 'vanished'
+                ranges = vanished_uid_ranges(client, reconciled_modseq)
+            else:
+                ranges, result['mode'] = server_uid_ranges(client)
+            if uidnext is None:
+                uidnext = (ranges[-1][1] + 1) if ranges and result['mode'] != 'vanished' else 2 ** 32 - 1
+
+            connection.begin()
+            try:
+                if ranges is not None:
+                    result['ranges'] = len(ranges)
+                    result['orphaned'] = mark_orphans(
+                        cursor, account, folder, uidvalidity, uidnext, ranges,
+                        present=result['mode'] != 'vanished',
+                        stale_uidvalidity=result['mode'] != 'vanished' and synced_uidvalidity == uidvalidity
+                    )
+                _save_reconcile_state(cursor, account, folder, uidvalidity, highest_modseq)
+                if delete:
+                    result['deleted'] = purge_orphans(cursor, account, folder)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+    metrics.count('reconcile_orphans_total', result['orphaned'], mode=result['mode'])
+    return result
+
+
+def reconcile_account(account, db_config, folders=None, delete=False, full=False):
+    """对账一个账号的所有（或指定的）文件夹，单个文件夹失败不影响其他文件夹
+
+    Returns:
+        list: 每个文件夹的结果，失败的文件夹带 'error'
+    """
+    results = []
+    client = connect_to_qq_mail(account['address'], account['password'], account['imap_server'])
+    try:
+        qresync = enable_qresync(client)
+        with connect_email_db(db_config) as connection:
+            with connection.cursor() as cursor:
+                ensure_email_tables(cursor)
+            for folder in folders or account['folders']:
+                started = time.monotonic()
+                try:
+                    result = reconcile_folder(client, connection, account['address'], folder, delete, full, qresync)
+                except Exception as e:
+                    metrics.error("对账 %s/%s 失败: %s", account['address'], folder, e)
+                    result = {'folder': folder, 'error': str(e)}
+                result['seconds'] = round(time.monotonic() - started, 3)
+                results.append(result)
+    finally:
+        try:
+            client.logout()
+        except Exception:
+            pass
+    return results
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='对账邮箱与数据库，标记服务器上已删除或移走的邮件')
+    parser.add_argument('--account', help='只对账该邮箱地址（默认对账配置中的所有账号）')
+    parser.add_argument('--folder', action='append', help='只对账该文件夹，可重复指定（默认为账号配置的文件夹）')
+    parser.add_argument('--full', action='store_true', help='不使用QRESYNC增量结果，比较全部UID')
+    parser.add_argument('--delete', action='store_true',
+                        help='删除孤儿行及其搜索索引（默认只标记orphaned_at；自动生成的投递/面试记录保留）')
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main():
+    """主函数"""
+    args = parse_args()
+    metrics.configure_from_args(config.config.get('metrics'), args)
+    accounts = [a for a in config.get_accounts() if not args.account or a['address'] == args.account]
+    if not accounts:
+        print("没有配置任何邮箱账号", file=sys.stderr)
+        sys.exit(1)
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+
+    failed = False
+    for account in accounts:
+        for result in reconcile_account(account, db_config, args.folder, args.delete, args.full):
+            name = f"{account['address']}/{result['folder']}"
+            if 'error' in result:
+                failed = True
+                continue
+            print(f"[{name}] 方式 {result['mode']}，UID区间 {result['ranges']} 个，"
+                  f"标记孤儿 {result['orphaned']} 封，删除 {result['deleted']} 封，耗时 {result['seconds']:.3f} 秒")
+    metrics.report()
+    metrics.flush()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
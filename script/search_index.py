@@ -0,0 +1,266 @@
+# 邮件主题和正文的倒排索引：中日韩文字按二元组切分，英文和数字按单词切分
+import argparse
+import math
+import os
+import re
+import sys
+from collections import Counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from script.body_store import BODY_JOIN, BODY_SELECT, read_body
+
+# 中日韩文字的连续片段，或英文字母数字组成的单词（与 src/server.js 中的 SEARCH_TOKEN_PATTERN 保持一致）
+TOKEN_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[a-z0-9]+')
+# 单词的最大长度，更长的部分截断（如长串的十六进制ID）
+MAX_TERM_LENGTH = 32
+# 主题中的词权重更高
+SUBJECT_WEIGHT = 5
+# weight列为SMALLINT UNSIGNED
+MAX_WEIGHT = 65535
+# 每次重建/回填处理的邮件数
+INDEX_CHUNK_SIZE = 500
+# search默认返回的结果数
+DEFAULT_SEARCH_LIMIT = 200
+
+SEARCH_TERMS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS email_search_terms (
+    term VARCHAR(32) NOT NULL,
+    email_id INT NOT NULL,
+    weight SMALLINT UNSIGNED NOT NULL,
+    PRIMARY KEY (term, email_id),
+    KEY idx_email_id (email_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+"""
+
+# 记录每封邮件建索引时的内容指纹，指纹与all_emails不一致的邮件需要重建索引
+SEARCH_DOCS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS email_search_docs (
+    email_id INT PRIMARY KEY,
+    content_hash BINARY(16) DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+
+def tokenize(text):
+    """把文本切分成索引词
+
+    中日韩文字片段切成相邻二元组（只有一个字时保留单字），英文转小写后按单词切分，
+    单个字母或数字不建索引。
+    """
+    terms = []
+    for match in TOKEN_RE.finditer((text or '').lower()):
+        token = match.group(0)
+        if token.isascii():
+            if len(token) >= 2:
+                terms.append(token[:MAX_TERM_LENGTH])
+        elif len(token) == 1:
+            terms.append(token)
+        else:
+            terms.extend(token[i:i+2] for i in range(len(token) - 1))
+    return terms
+
+
+def document_terms(subject, body):
+    """计算一封邮件的 {索引词: 权重}"""
+    weights = Counter(tokenize(body))
+    for term, count in Counter(tokenize(subject)).items():
+        weights[term] += count * SUBJECT_WEIGHT
+    return {term: min(weight, MAX_WEIGHT) for term, weight in weights.items()}
+
+
+def ensure_search_tables(cursor):
+    """创建/检查索引表（DDL会隐式提交，需在事务之外调用）"""
+    cursor.execute(SEARCH_TERMS_TABLE_SQL)
+    cursor.execute(SEARCH_DOCS_TABLE_SQL)
+
+
+def _reindex_rows(cursor, rows):
+    """重建指定邮件的索引，rows为 [(id, subject, body, content_hash)]"""
+    if not rows:
+        return 0
+    ids = [row[0] for row in rows]
+    placeholders = ','.join(['%s'] * len(ids))
+    cursor.execute(f"DELETE FROM email_search_terms WHERE email_id IN ({placeholders})", ids)
+    postings = []
+    for email_id, subject, body, _ in rows:
+        postings.extend((term, email_id, weight) for term, weight in document_terms(subject, body).items())
+    for i in range(0, len(postings), 5000):
+        cursor.executemany(
+            "INSERT INTO email_search_terms (term, email_id, weight) VALUES (%s, %s, %s)",
+            postings[i:i+5000]
+        )
+    cursor.executemany(
+        "INSERT INTO email_search_docs (email_id, content_hash) VALUES (%s, %s) "
+        "ON DUPLICATE KEY UPDATE content_hash = VALUES(content_hash)",
+        [(row[0], row[3]) for row in rows]
+    )
+    return len(rows)
+
+
+def _stale_rows(cursor, where, params):
+    cursor.execute(
+        f"SELECT a.id, a.subject, a.content_hash, {BODY_SELECT} FROM all_emails a "
+        "LEFT JOIN email_search_docs d ON d.email_id = a.id "
+        f"{BODY_JOIN} "
+        f"WHERE {where} AND (d.email_id IS NULL OR NOT (d.content_hash <=> a.content_hash))",
+        params
+    )
+    return [(email_id, subject, read_body(cursor, *body), content_hash)
+            for email_id, subject, content_hash, *body in cursor.fetchall()]
+
+
+def index_emails(cursor, message_id_hashes=None, ids=None):
+    """增量更新索引：只处理指定邮件中尚未建索引或内容指纹已变化的邮件
+
+    在写入all_emails的同一个事务中调用，邮件和索引一起提交。
+
+    Args:
+        message_id_hashes: 按去重键指定邮件（upsert之后使用）
+        ids: 按all_emails.id指定邮件
+
+    Returns:
+        int: 重建索引的邮件数
+    """
+    indexed = 0
+    for column, values in (('a.message_id_hash', message_id_hashes), ('a.id', ids)):
+        values = list(dict.fromkeys(values or ()))
+        for i in range(0, len(values), INDEX_CHUNK_SIZE):
+            chunk = values[i:i+INDEX_CHUNK_SIZE]
+            rows = _stale_rows(cursor, f"{column} IN ({','.join(['%s'] * len(chunk))})", chunk)
+            indexed += _reindex_rows(cursor, rows)
+    return indexed
+
+
+def remove_from_index(cursor, ids):
+    """删除邮件的索引"""
+    ids = list(ids)
+    if not ids:
+        return
+    placeholders = ','.join(['%s'] * len(ids))
+    cursor.execute(f"DELETE FROM email_search_terms WHERE email_id IN ({placeholders})", ids)
+    cursor.execute(f"DELETE FROM email_search_docs WHERE email_id IN ({placeholders})", ids)
+
+
+def update_index(connection, rebuild=False, chunk_size=INDEX_CHUNK_SIZE):
+    """为全部邮件补建索引，并清理已删除邮件的索引；rebuild为True时先清空索引
+
+    每处理chunk_size封邮件提交一次，可以在服务运行时执行。
+
+    Returns:
+        tuple: (建索引的邮件数, 清理的邮件数)
+    """
+    indexed = 0
+    with connection.cursor() as cursor:
+        ensure_search_tables(cursor)
+        if rebuild:
+            cursor.execute("TRUNCATE TABLE email_search_terms")
+            cursor.execute("TRUNCATE TABLE email_search_docs")
+        last_id = 0
+        while True:
+            cursor.execute("SELECT id FROM all_emails WHERE id > %s ORDER BY id LIMIT %s", (last_id, chunk_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            last_id = ids[-1]
+            connection.begin()
+            indexed += index_emails(cursor, ids=ids)
+            connection.commit()
+            print(f"已检查到 id={last_id}，建索引 {indexed} 封邮件")
+
+        cursor.execute(
+            "SELECT d.email_id FROM email_search_docs d LEFT JOIN all_emails a ON a.id = d.email_id "
+            "WHERE a.id IS NULL"
+        )
+        orphans = [row[0] for row in cursor.fetchall()]
+        for i in range(0, len(orphans), chunk_size):
+            connection.begin()
+            remove_from_index(cursor, orphans[i:i+chunk_size])
+            connection.commit()
+    return indexed, len(orphans)
+
+
+def search(cursor, query, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+    """在索引中搜索，返回按相关度排序的邮件ID
+
+    查询词全部出现的邮件才算匹配；相关度为各词权重乘以逆文档频率之和。
+    候选集只取自最少见的词的倒排列表，耗时与该列表长度相关，而不是邮件总数。
+
+    Returns:
+        list | None: [(email_id, score)]；查询中没有可索引的词（如单个汉字）时返回None，
+                     调用方应退回到逐行匹配
+    """
+    # 单个中日韩文字在文档中以二元组存储，无法直接查到
+    terms = list(dict.fromkeys(term for term in tokenize(query) if len(term) > 1))
+    if not terms:
+        return None
+
+    placeholders = ','.join(['%s'] * len(terms))
+    cursor.execute(
+        f"SELECT term, COUNT(*) FROM email_search_terms WHERE term IN ({placeholders}) GROUP BY term",
+        terms
+    )
+    df = dict(cursor.fetchall())
+    if len(df) < len(terms):
+        return []
+    cursor.execute("SELECT COALESCE(MAX(email_id), 0) FROM email_search_docs")
+    total = max(cursor.fetchone()[0], 1)
+    rarest = min(terms, key=lambda term: df[term])
+
+    cases = ' '.join('WHEN %s THEN %s' for _ in terms)
+    params = []
+    for term in terms:
+        params.extend((term, math.log(1 + total / df[term])))
+    params.extend(terms)
+    params.extend((rarest, len(terms), limit, offset))
+    cursor.execute(
+        f"SELECT t.email_id, SUM(t.weight * CASE t.term {cases} END) AS score "
+        f"FROM email_search_terms t "
+        f"WHERE t.term IN ({placeholders}) "
+        f"AND t.email_id IN (SELECT email_id FROM email_search_terms WHERE term = %s) "
+        f"GROUP BY t.email_id HAVING COUNT(*) = %s "
+        f"ORDER BY score DESC, t.email_id DESC LIMIT %s OFFSET %s",
+        params
+    )
+    return [(row[0], float(row[1])) for row in cursor.fetchall()]
+
+
+def main():
+    """主函数"""
+    import script.config as config
+    from script.qq_email_imap import connect_email_db
+
+    parser = argparse.ArgumentParser(description='邮件搜索索引')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('update', help='为尚未建索引或内容已变化的邮件建索引，并清理已删除邮件的索引')
+    sub.add_parser('rebuild', help='清空并重建全部索引')
+    query_parser = sub.add_parser('search', help='搜索并输出按相关度排序的邮件')
+    query_parser.add_argument('query')
+    query_parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+    with connect_email_db(db_config) as connection:
+        if args.command in ('update', 'rebuild'):
+            indexed, removed = update_index(connection, rebuild=args.command == 'rebuild')
+            print(f"建索引 {indexed} 封邮件，清理 {removed} 封已删除邮件的索引")
+            return
+        with connection.cursor() as cursor:
+            results = search(cursor, args.query, args.limit)
+            if results is None:
+                print("查询中没有可索引的词（单个汉字或字母无法使用索引）")
+                return
+            for email_id, score in results:
+                cursor.execute("SELECT send_date, subject FROM all_emails WHERE id = %s", (email_id,))
+                row = cursor.fetchone()
+                if row:
+                    print(f"{email_id}\t{score:.2f}\t{row[0]}\t{row[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# 多账号、多文件夹的同步调度：各账号并发同步，每个账号的连接数受限，断点按 (账号, 文件夹) 独立保存
+import argparse
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script.config as config
+from script.qq_email_imap import ImportInterrupted, run_import
+from script.raw_cache import open_cache
+from script import imap_budget, metrics
+
+# 每个同步线程占用的IMAP连接数：asyncio后端在SEARCH用的IMAPClient连接之外另开一个流水线连接
+TASK_CONNECTIONS = {'imapclient': 1, 'asyncio': 2}
+# 每个文件夹每轮最多获取的邮件数，之后排到队尾，同一账号的文件夹轮流同步
+FOLDER_TURN_MESSAGES = 2000
+
+
+class SyncTask:
+    """一个 (账号, 文件夹) 的同步任务及其结果"""
+
+    def __init__(self, account, folder):
+        self.account = account
+        self.folder = folder
+        self.processed = 0
+        self.inserted = 0
+        self.total = None
+        self.error = None
+        self.seconds = 0.0
+        self.turns = 0
+
+    @property
+    def name(self):
+        return f"{self.account['address']}/{self.folder}"
+
+    def result(self):
+        return {
+            'account': self.account['address'],
+            'folder': self.folder,
+            'processed': self.processed,
+            'inserted': self.inserted,
+            'error': str(self.error) if self.error else None,
+            'seconds': round(self.seconds, 1)
+        }
+
+
+def plan_tasks(accounts):
+    """按账号分组生成任务队列，同一账号内按配置顺序开始同步文件夹
+
+    Returns:
+        list: [(账号配置, 该账号的任务队列)]
+    """
+    plan = []
+    for account in accounts:
+        tasks = queue.Queue()
+        for folder in dict.fromkeys(account['folders']):
+            tasks.put(SyncTask(account, folder))
+        plan.append((account, tasks))
+    return plan
+
+
+def run_scheduler(accounts, db_config, start_date=None, end_date=None, fetch_mode='partial', cache=None,
+                  progress=None, cancel=None, fetch_backend='imapclient', parse_pool=None,
+                  turn_messages=FOLDER_TURN_MESSAGES):
+    """并发同步所有账号的所有文件夹
+
+    每个账号有自己的任务队列和同步线程，线程数为 min(可用连接数 // 每个线程的连接数, 文件夹数)，
+    可用连接数为max_connections减去同一进程中监听等已占用的连接（见 imap_budget.py），
+    asyncio后端每个线程占用两个IMAP连接，max_connections不足两个的账号改用imapclient后端；账号之间互不等待，总耗时取决于最慢的账号而不是所有账号之和。
+    同一账号内的文件夹轮流同步：每轮最多获取turn_messages封，还有剩余的文件夹排回队尾，
+    大文件夹不会让同账号的其他文件夹一直等待。
+    单个文件夹失败不影响其他文件夹，失败的文件夹断点不前进，下次同步时重试。
+    progress(已处理数, 新增数, 总数) 汇总所有任务的进度；cancel被设置时各任务在当前批次完成后停止。
+    提供parse_pool时所有任务共用这一个解析进程池。
+
+    Returns:
+        tuple: (处理的邮件数, 新增的邮件数, 每个任务的结果列表)
+    """
+    plan = plan_tasks(accounts)
+    all_tasks = [task for _, tasks in plan for task in list(tasks.queue)]
+    lock = threading.Lock()
+
+    def report():
+        if progress:
+            with lock:
+                totals = [task.total for task in all_tasks]
+                progress(sum(task.processed for task in all_tasks), sum(task.inserted for task in all_tasks),
+                         None if None in totals else sum(totals))
+
+    def run_turn(task, backend):
+        """同步任务的一轮，返回该文件夹是否还有邮件需要下一轮获取"""
+        account = task.account
+        processed, inserted = task.processed, task.inserted
+        planned = None
+
+        def task_progress(turn_processed, turn_inserted, turn_total):
+            nonlocal planned
+            planned = turn_total
+            task.processed, task.inserted = processed + turn_processed, inserted + turn_inserted
+            task.total = processed + turn_total
+            report()
+
+        started = time.monotonic()
+        task.turns += 1
+        print(f"[{task.name}] 开始第 {task.turns} 轮同步" if task.turns > 1 else f"[{task.name}] 开始同步")
+        more = False
+        try:
+            turn_processed, turn_inserted = run_import(
+                account['address'], account['password'], account['imap_server'], db_config,
+                start_date, end_date, fetch_mode, cache=cache, progress=task_progress, cancel=cancel,
+                fetch_backend=backend, folder=task.folder, parse_pool=parse_pool, max_messages=turn_messages
+            )
+            task.processed, task.inserted = processed + turn_processed, inserted + turn_inserted
+            # 本轮取满且全部成功时才继续；有失败的邮件时断点停在它们之前，留到下次同步重试
+            more = bool(turn_messages) and planned == turn_messages and turn_processed == planned
+        except ImportInterrupted:
+            pass
+        except Exception as e:
+            task.error = e
+            print(f"[{task.name}] 同步失败: {e}")
+        task.seconds += time.monotonic() - started
+        if more:
+            report()
+            return True
+        metrics.observe('sync_task_seconds', task.seconds, account=account['address'], folder=task.folder)
+        if task.total is None:
+            task.total = task.processed
+        print(f"[{task.name}] 处理 {task.processed} 封，新增 {task.inserted} 封，耗时 {task.seconds:.1f} 秒")
+        report()
+        return False
+
+    def account_worker(tasks, backend):
+        while cancel is None or not cancel.is_set():
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                return
+            if run_turn(task, backend):
+                tasks.put(task)
+
+    threads = []
+    for account, tasks in plan:
+        backend = fetch_backend
+        # 同一进程中的收件箱监听、正文连接池等已占用的连接也计入账号的上限（见 imap_budget.py）
+        connections = min(account['max_connections'], imap_budget.available(account['address']))
+        if connections < TASK_CONNECTIONS[backend]:
+            print(f"账号 {account['address']} 可用 {connections} 个连接，不足以使用 {backend} 后端，改用imapclient")
+            backend = 'imapclient'
+        workers = max(min(connections // TASK_CONNECTIONS[backend], tasks.qsize()), 1)
+        print(f"账号 {account['address']}: {tasks.qsize()} 个文件夹，{workers} 个同步线程，"
+              f"{workers * TASK_CONNECTIONS[backend]} 个连接")
+        for _ in range(workers):
+            thread = threading.Thread(target=account_worker, args=(tasks, backend), daemon=True)
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    processed = sum(task.processed for task in all_tasks)
+    inserted = sum(task.inserted for task in all_tasks)
+    return processed, inserted, [task.result() for task in all_tasks]
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='按配置同步所有账号的所有文件夹')
+    parser.add_argument('start_date', nargs='?', default=None, help='开始日期 (YYYY-MM-DD)')
+    parser.add_argument('end_date', nargs='?', default=None, help='结束日期 (YYYY-MM-DD)')
+    parser.add_argument('--fetch-mode', choices=['partial', 'rfc822'], default='partial',
+                        help='partial: 只下载头部和正文部分（默认）；rfc822: 下载完整邮件')
+    parser.add_argument('--backend', choices=['imapclient', 'asyncio'], default='imapclient',
+                        help='asyncio: 在单个连接上流水线发送多条UID FETCH')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='大于0时所有任务共用该数量的解析进程解析完整邮件（见 parse_pool.py）')
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main():
+    """主函数"""
+    args = parse_args()
+    metrics.configure_from_args(config.config.get('metrics'), args)
+    accounts = config.get_accounts()
+    if not accounts:
+        print("没有配置任何邮箱账号", file=sys.stderr)
+        sys.exit(1)
+    db_config = {
+        'host': config.config['db']['host'],
+        'user': config.config['db']['user'],
+        'password': config.config['db']['password'],
+        'database': 'job_emails',
+        'charset': config.config['db']['charset']
+    }
+
+    # 收到终止信号时各任务在当前批次完成后停止，已提交的批次和断点会保留
+    cancel = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: cancel.set())
+    started = time.monotonic()
+    parse_pool = None
+    if args.parse_workers > 0:
+        from script.parse_pool import ParsePool
+        parse_pool = ParsePool(args.parse_workers)
+    try:
+        processed, inserted, results = run_scheduler(
+            accounts, db_config, args.start_date, args.end_date, args.fetch_mode,
+            open_cache(config.config.get('cache')), cancel=cancel, fetch_backend=args.backend,
+            parse_pool=parse_pool
+        )
+    except KeyboardInterrupt:
+        cancel.set()
+        print("同步被中断，下次运行将从断点继续")
+        return
+    finally:
+        if parse_pool is not None:
+            parse_pool.close()
+
+    failed = [result for result in results if result['error']]
+    print(f"同步完成: {len(results)} 个文件夹，{len(failed)} 个失败，耗时 {time.monotonic() - started:.1f} 秒")
+    print(f"总共处理 {processed} 封邮件，新增 {inserted} 封邮件")
+    metrics.report()
+    metrics.flush()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
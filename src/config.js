@@ -32,6 +32,29 @@ export const config = {
         address: '',
         password: '',
         imap_server: 'imap.qq.com'
+    },
+    // 原始邮件本地缓存（见 script/raw_cache.py），默认关闭；dir为空时使用项目目录下的 cache/raw_messages
+    cache: {
+        enabled: false,
+        dir: '',
+        max_mb: 512
+    },
+    // 多账号/多文件夹同步（见 script/sync_scheduler.py），为空时只同步email中的账号的收件箱
+    accounts: [],
+    // 入库时按规则自动识别招聘邮件，生成待确认的投递和面试记录（见 script/email_classifier.py）
+    classify: {
+        enabled: true
+    },
+    // 正文去重压缩存储（见 script/body_store.py），只影响Python端的写入；读取时两种存储方式都支持
+    storage: {
+        compress_bodies: false
+    },
+    // 日志级别和分阶段指标（见 script/metrics.py）；path非空时把指标写入该文件，format为ndjson或prometheus
+    metrics: {
+        enabled: false,
+        format: 'ndjson',
+        path: '',
+        log_level: 'INFO'
     }
 };
 
@@ -51,6 +74,11 @@ export async function loadConfig() {
             // 更新配置
             config.db = { ...config.db, ...loadedConfig.db };
             config.email = { ...config.email, ...loadedConfig.email };
+            config.cache = { ...config.cache, ...loadedConfig.cache };
+            config.accounts = Array.isArray(loadedConfig.accounts) ? loadedConfig.accounts : [];
+            config.classify = { ...config.classify, ...loadedConfig.classify };
+            config.storage = { ...config.storage, ...loadedConfig.storage };
+            config.metrics = { ...config.metrics, ...loadedConfig.metrics };
             
             logMessage('配置文件加载成功');
         } else {
@@ -76,11 +104,31 @@ export async function saveConfig(newConfig) {
         if (newConfig.email) {
             config.email = { ...config.email, ...newConfig.email };
         }
+        if (newConfig.cache) {
+            config.cache = { ...config.cache, ...newConfig.cache };
+        }
+        if (Array.isArray(newConfig.accounts)) {
+            config.accounts = newConfig.accounts;
+        }
+        if (newConfig.classify) {
+            config.classify = { ...config.classify, ...newConfig.classify };
+        }
+        if (newConfig.metrics) {
+            config.metrics = { ...config.metrics, ...newConfig.metrics };
+        }
+        if (newConfig.storage) {
+            config.storage = { ...config.storage, ...newConfig.storage };
+        }
         
         // 保存到文件
         const configToSave = {
             db: config.db,
-            email: config.email
+            email: config.email,
+            cache: config.cache,
+            accounts: config.accounts,
+            classify: config.classify,
+            metrics: config.metrics,
+            storage: config.storage
         };
         
         fs.writeFileSync(configPath, JSON.stringify(configToSave, null, 2), 'utf-8');
@@ -4,6 +4,8 @@ import path from 'path';
 import { fileURLToPath } from 'url';
 import { spawn } from 'child_process';
 import fs from 'fs';
+import readline from 'readline';
+import zlib from 'zlib';
 import { config, loadConfig, saveConfig } from './config.js';
 
 // 日志记录函数
@@ -38,6 +40,175 @@ app.use((req, res, next) => {
     next();
 });
 
+// 常驻的IMAP工作进程，复用已登录的IMAP连接获取邮件正文
+const IMAP_WORKER_TIMEOUT = 60000;
+// 获取邮件任务的超时时间，超时后通知工作进程取消任务
+const FETCH_EMAILS_TIMEOUT = 300000;
+// 批量获取邮件正文时一次请求的最大邮件数
+const MAX_BATCH_BODY_IDS = 200;
+// 邮件列表返回的列：不含正文，列表查询不读取正文所在的页
+const EMAIL_LIST_COLUMNS = 'id, imap_id, uidvalidity, uid, subject, sender, recipient, send_date, send_ts, delivered, ' +
+    'delivered AS is_delivered, account, folder, orphaned_at';
+// 邮件列表的排序：migrate_all_emails.py 回填完成前旧邮件的 send_ts 为NULL，按 send_date（YYYY-MM-DD HH:MM:SS 字符串）排序
+const EMAIL_LIST_ORDER = ' ORDER BY COALESCE(send_ts, send_date) DESC';
+// 压缩存储的正文编码（与 script/body_store.py 一致）：0 为UTF-8原文，1 为zlib（dict_id非0时带预设字典）
+const BODY_CODEC_RAW = 0;
+// 收件箱监听结束（连接失败、切换账号）后重新开始监听的等待时间
+const EMAIL_WATCH_RETRY_DELAY = 30000;
+let imapWorker = null;
+let imapWorkerRequestId = 0;
+const imapWorkerPending = new Map();
+
+function getImapWorker() {
+    if (imapWorker) {
+        return imapWorker;
+    }
+
+    const scriptPath = path.join(__dirname, '..', 'script', 'imap_worker.py');
+    logMessage(`正在启动IMAP工作进程: ${scriptPath}`);
+    const worker = spawn('python', [scriptPath], {
+        cwd: __dirname,
+        env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
+    });
+
+    readline.createInterface({ input: worker.stdout }).on('line', (line) => {
+        let response;
+        try {
+            response = JSON.parse(line);
+        } catch (err) {
+            logMessage(`IMAP工作进程输出无法解析: ${line.substring(0, 100)}`, 'WARN');
+            return;
+        }
+        const pending = imapWorkerPending.get(response.id);
+        if (!pending) {
+            return;
+        }
+        // 进度事件不结束请求
+        if (response.event) {
+            if (pending.onEvent) {
+                pending.onEvent(response);
+            }
+            return;
+        }
+        imapWorkerPending.delete(response.id);
+        clearTimeout(pending.timer);
+        pending.resolve(response);
+    });
+
+    // 工作进程的日志按行转发，带 [WARN]/[ERROR] 前缀的行（见 script/metrics.py）使用对应级别
+    readline.createInterface({ input: worker.stderr }).on('line', (line) => {
+        if (!line.trim()) {
+            return;
+        }
+        const match = /^\[(WARN|ERROR)\] /.exec(line);
+        logMessage(`IMAP工作进程日志: ${match ? line.substring(match[0].length) : line}`, match ? match[1] : 'DEBUG');
+    });
+
+    const onExit = (reason) => {
+        if (imapWorker !== worker) {
+            return;
+        }
+        imapWorker = null;
+        logMessage(`IMAP工作进程已退出: ${reason}`, 'WARN');
+        for (const [id, pending] of imapWorkerPending) {
+            clearTimeout(pending.timer);
+            pending.reject(new Error(`IMAP工作进程已退出: ${reason}`));
+            imapWorkerPending.delete(id);
+        }
+    };
+    worker.on('exit', (code, signal) => onExit(signal || `退出码 ${code}`));
+    worker.on('error', (error) => onExit(error.message));
+    worker.stdin.on('error', (error) => onExit(error.message));
+
+    imapWorker = worker;
+    // 凭据通过标准输入传递，不出现在命令行参数中
+    sendImapWorkerRequest({
+        op: 'configure',
+        email: config.email.address,
+        password: config.email.password,
+        imap_server: config.email.imap_server
+    }).catch(err => logMessage(`配置IMAP工作进程失败: ${err.message}`, 'ERROR'));
+    return worker;
+}
+
+// options.timeout: 超时时间（0表示不超时）；options.onEvent: 收到进度事件时的回调；options.onStart: 拿到请求ID后的回调
+function sendImapWorkerRequest(request, options = {}) {
+    return new Promise((resolve, reject) => {
+        const worker = getImapWorker();
+        const id = ++imapWorkerRequestId;
+        const timeout = options.timeout === undefined ? IMAP_WORKER_TIMEOUT : options.timeout;
+        const timer = timeout === 0 ? null : setTimeout(() => {
+            imapWorkerPending.delete(id);
+            const error = new Error('IMAP工作进程响应超时');
+            error.timeout = true;
+            reject(error);
+        }, timeout);
+        imapWorkerPending.set(id, { resolve, reject, timer, onEvent: options.onEvent });
+        if (options.onStart) {
+            options.onStart(id);
+        }
+        worker.stdin.write(JSON.stringify({ ...request, id }) + '\n');
+    });
+}
+
+function cancelImapWorkerFetch(target) {
+    return sendImapWorkerRequest({ op: 'cancel', target })
+        .catch(err => logMessage(`取消邮件获取任务失败: ${err.message}`, 'ERROR'));
+}
+
+// 配置变更后通知IMAP工作进程切换账号
+function reconfigureImapWorker() {
+    if (!imapWorker) {
+        return;
+    }
+    sendImapWorkerRequest({
+        op: 'configure',
+        email: config.email.address,
+        password: config.email.password,
+        imap_server: config.email.imap_server
+    }).catch(err => logMessage(`重新配置IMAP工作进程失败: ${err.message}`, 'ERROR'));
+}
+
+// 收件箱监听：工作进程通过IDLE收到新邮件并入库后，以Server-Sent Events通知打开的邮件页面
+const emailEventClients = new Set();
+let emailWatcherActive = false;
+
+function broadcastEmailEvent(event) {
+    const data = `data: ${JSON.stringify(event)}\n\n`;
+    for (const client of emailEventClients) {
+        client.write(data);
+    }
+}
+
+function startEmailWatcher() {
+    if (emailWatcherActive || !config.email.address || !config.email.password || !config.db.host) {
+        return;
+    }
+    emailWatcherActive = true;
+    logMessage('开始监听收件箱');
+    sendImapWorkerRequest({ op: 'watch' }, {
+        timeout: 0,
+        onEvent: (event) => {
+            if (event.event !== 'change') {
+                return;
+            }
+            if (event.type === 'new') {
+                logMessage(`收件箱有新邮件，已入库 ${event.processed} 封，新增 ${event.inserted} 封`);
+            }
+            broadcastEmailEvent({ type: event.type, inserted: event.inserted, count: event.count });
+        }
+    }).then(response => {
+        if (!response.ok) {
+            logMessage(`监听收件箱失败: ${response.error}`, 'ERROR');
+        }
+    }).catch(err => {
+        logMessage(`监听收件箱失败: ${err.message}`, 'ERROR');
+    }).finally(() => {
+        emailWatcherActive = false;
+        setTimeout(startEmailWatcher, EMAIL_WATCH_RETRY_DELAY);
+    });
+}
+
 // 数据库连接池
 let interviewDb, emailDb, deliveryDb;
 
@@ -75,6 +246,214 @@ const getDbConfigs = () => ({
     }
 });
 
+// 旧版本建的 all_emails 表缺少的列（与 script/qq_email_imap.py 中的 ALL_EMAILS_COLUMNS 一致）
+const ALL_EMAILS_COLUMNS = {
+    content_hash: 'BINARY(16) DEFAULT NULL',
+    message_id_hash: 'BINARY(16) DEFAULT NULL',
+    send_ts: 'DATETIME DEFAULT NULL',
+    uidvalidity: 'INT UNSIGNED DEFAULT NULL',
+    uid: 'INT UNSIGNED DEFAULT NULL',
+    account: 'VARCHAR(255) DEFAULT NULL',
+    folder: 'VARCHAR(255) DEFAULT NULL',
+    orphaned_at: 'DATETIME DEFAULT NULL',
+    body_hash: 'BINARY(16) DEFAULT NULL'
+};
+
+// 为旧表补列；索引和历史数据的回填由 script/migrate_all_emails.py 完成
+async function ensureAllEmailsSchema() {
+    const [columns] = await emailDb.query(
+        "SELECT COLUMN_NAME AS name FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'all_emails'"
+    );
+    const existing = new Set(columns.map(column => column.name.toLowerCase()));
+    for (const [column, definition] of Object.entries(ALL_EMAILS_COLUMNS)) {
+        if (!existing.has(column)) {
+            logMessage(`为 all_emails 表添加列 ${column}`);
+            await emailDb.query(`ALTER TABLE all_emails ADD COLUMN ${column} ${definition}`);
+        }
+    }
+    const [indexes] = await emailDb.query(
+        "SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'all_emails' AND INDEX_NAME = 'idx_send_ts' LIMIT 1"
+    );
+    if (indexes.length === 0) {
+        logMessage('all_emails 表尚未迁移，邮件列表无法使用索引，请运行 python script/migrate_all_emails.py', 'WARN');
+    }
+    const [searchTables] = await emailDb.query(
+        "SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'email_search_docs' LIMIT 1"
+    );
+    searchIndexReady = searchTables.length > 0;
+    if (!searchIndexReady) {
+        logMessage('邮件搜索索引尚未建立，搜索将逐行匹配，请运行 python script/search_index.py update', 'WARN');
+    }
+}
+
+// 搜索索引（由 script/search_index.py 在入库时维护），与其中的 TOKEN_RE 保持一致
+const SEARCH_TOKEN_PATTERN = /[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[a-z0-9]+/g;
+const SEARCH_MAX_TERM_LENGTH = 32;
+const SEARCH_RESULT_LIMIT = 500;
+let searchIndexReady = false;
+
+// 把查询切分成索引词：中日韩文字取相邻二元组，英文单词转小写；单个字无法使用索引
+function tokenizeSearchQuery(text) {
+    const terms = new Set();
+    for (const token of (text || '').toLowerCase().match(SEARCH_TOKEN_PATTERN) || []) {
+        if (/^[a-z0-9]+$/.test(token)) {
+            if (token.length >= 2) {
+                terms.add(token.slice(0, SEARCH_MAX_TERM_LENGTH));
+            }
+        } else {
+            for (let i = 0; i < token.length - 1; i++) {
+                terms.add(token.slice(i, i + 2));
+            }
+        }
+    }
+    return [...terms];
+}
+
+// 在搜索索引中查询，返回按相关度排序的邮件ID；无法使用索引时返回null
+async function searchEmailIds(keyword) {
+    const terms = tokenizeSearchQuery(keyword);
+    if (!searchIndexReady || terms.length === 0) {
+        return null;
+    }
+    const placeholders = terms.map(() => '?').join(',');
+    const [dfRows] = await emailDb.query(
+        `SELECT term, COUNT(*) AS df FROM email_search_terms WHERE term IN (${placeholders}) GROUP BY term`,
+        terms
+    );
+    if (dfRows.length < terms.length) {
+        return [];
+    }
+    const df = new Map(dfRows.map(row => [row.term, Number(row.df)]));
+    const [[{ total }]] = await emailDb.query('SELECT COALESCE(MAX(email_id), 0) AS total FROM email_search_docs');
+    const rarest = terms.reduce((a, b) => (df.get(b) < df.get(a) ? b : a));
+    // 相关度 = 各词权重 × 逆文档频率；候选集只取最少见的词的倒排列表
+    const cases = terms.map(() => 'WHEN ? THEN ?').join(' ');
+    const idf = [];
+    for (const term of terms) {
+        idf.push(term, Math.log(1 + Math.max(Number(total), 1) / df.get(term)));
+    }
+    const [rows] = await emailDb.query(
+        `SELECT t.email_id FROM email_search_terms t
+         WHERE t.term IN (${placeholders})
+         AND t.email_id IN (SELECT email_id FROM email_search_terms WHERE term = ?)
+         GROUP BY t.email_id HAVING COUNT(*) = ?
+         ORDER BY SUM(t.weight * CASE t.term ${cases} END) DESC, t.email_id DESC LIMIT ?`,
+        [...terms, rarest, terms.length, ...idf, SEARCH_RESULT_LIMIT]
+    );
+    return rows.map(row => row.email_id);
+}
+
+// 数据分析页面的预聚合表，由Python入库流程增量维护（与 script/analytics_rollup.py 一致）；
+// 页面上手动增删改投递记录后在这里重新统计受影响的企业，删除邮件后减少所在日期的邮件数
+const ROLLUP_TABLES_SQL = [`
+      CREATE TABLE IF NOT EXISTS rollup_email_days (
+        day DATE NOT NULL PRIMARY KEY,
+        emails INT UNSIGNED NOT NULL
+      ) ENGINE=InnoDB
+    `, `
+      CREATE TABLE IF NOT EXISTS rollup_email_weeks (
+        week_start DATE NOT NULL PRIMARY KEY,
+        emails INT UNSIGNED NOT NULL
+      ) ENGINE=InnoDB
+    `, `
+      CREATE TABLE IF NOT EXISTS rollup_delivery_funnel (
+        company_name VARCHAR(255) NOT NULL,
+        position VARCHAR(255) NOT NULL,
+        status VARCHAR(100) NOT NULL,
+        deliveries INT UNSIGNED NOT NULL,
+        first_date DATETIME NOT NULL,
+        last_date DATETIME NOT NULL,
+        PRIMARY KEY (company_name, position, status)
+      ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    `, `
+      CREATE TABLE IF NOT EXISTS rollup_response_latency (
+        company_name VARCHAR(255) NOT NULL PRIMARY KEY,
+        applied_at DATETIME NOT NULL,
+        responded_at DATETIME DEFAULT NULL,
+        latency_hours INT UNSIGNED DEFAULT NULL
+      ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    `];
+
+// 旧版本的投递/面试表没有candidate列：自动识别的记录为待确认（与 script/email_classifier.py 一致）
+async function ensureCandidateColumn(db, table) {
+    const [columns] = await db.query(
+        "SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ? AND COLUMN_NAME = 'candidate'",
+        [table]
+    );
+    if (columns.length === 0) {
+        logMessage(`为 ${table} 表添加列 candidate`);
+        await db.query(`ALTER TABLE ${table} ADD COLUMN candidate BOOLEAN NOT NULL DEFAULT FALSE`);
+    }
+}
+
+// 重新统计指定企业的投递漏斗和首次回复耗时，来源查询与 script/analytics_rollup.py 一致（不含待确认的记录）
+async function refreshDeliveryRollups(companies) {
+    companies = [...new Set(companies.filter(Boolean))];
+    if (!emailDb || companies.length === 0) {
+        return;
+    }
+    const connection = await emailDb.getConnection();
+    try {
+        await connection.beginTransaction();
+        await connection.query('DELETE FROM rollup_delivery_funnel WHERE company_name IN (?)', [companies]);
+        await connection.query(
+            `INSERT INTO rollup_delivery_funnel (company_name, position, status, deliveries, first_date, last_date)
+             SELECT company_name, COALESCE(position, ''), status, COUNT(*), MIN(delivery_date), MAX(delivery_date)
+             FROM job_deliveries.deliveries WHERE candidate = FALSE AND company_name IN (?)
+             GROUP BY company_name, COALESCE(position, ''), status`,
+            [companies]
+        );
+        await connection.query('DELETE FROM rollup_response_latency WHERE company_name IN (?)', [companies]);
+        await connection.query(
+            `INSERT INTO rollup_response_latency (company_name, applied_at, responded_at, latency_hours)
+             SELECT a.company_name, a.applied_at, MIN(d.delivery_date), TIMESTAMPDIFF(HOUR, a.applied_at, MIN(d.delivery_date))
+             FROM (
+                 SELECT company_name, MIN(delivery_date) AS applied_at FROM job_deliveries.deliveries
+                 WHERE candidate = FALSE AND status IN ('投递完成', '简历筛选中') AND company_name IN (?)
+                 GROUP BY company_name
+             ) a
+             LEFT JOIN job_deliveries.deliveries d ON d.company_name = a.company_name AND d.delivery_date >= a.applied_at
+                 AND d.candidate = FALSE AND d.status NOT IN ('投递完成', '简历筛选中', '未知状态')
+             GROUP BY a.company_name, a.applied_at`,
+            [companies]
+        );
+        await connection.commit();
+    } catch (err) {
+        await connection.rollback();
+        logMessage(`更新投递预聚合表失败（可运行 python script/analytics_rollup.py rebuild 修正）: ${err.message}`, 'WARN');
+    } finally {
+        connection.release();
+    }
+}
+
+// 删除一封邮件后，把它所在日期（YYYY-MM-DD）和所在周的邮件数减一（与 script/analytics_rollup.py 的 add_email_days 一致）
+async function decrementEmailRollups(day) {
+    if (!day) {
+        return;
+    }
+    const connection = await emailDb.getConnection();
+    try {
+        await connection.beginTransaction();
+        await connection.query('UPDATE rollup_email_days SET emails = GREATEST(CAST(emails AS SIGNED) - 1, 0) WHERE day = ?', [day]);
+        await connection.query('DELETE FROM rollup_email_days WHERE day = ? AND emails = 0', [day]);
+        await connection.query(
+            `UPDATE rollup_email_weeks SET emails = GREATEST(CAST(emails AS SIGNED) - 1, 0)
+             WHERE week_start = DATE_SUB(?, INTERVAL WEEKDAY(?) DAY)`,
+            [day, day]
+        );
+        await connection.query(
+            'DELETE FROM rollup_email_weeks WHERE week_start = DATE_SUB(?, INTERVAL WEEKDAY(?) DAY) AND emails = 0',
+            [day, day]
+        );
+        await connection.commit();
+    } catch (err) {
+        await connection.rollback();
+        logMessage(`更新邮件预聚合表失败（可运行 python script/analytics_rollup.py rebuild 修正）: ${err.message}`, 'WARN');
+    } finally {
+        connection.release();
+    }
+}
+
 // 初始化数据库连接
 async function initDatabase() {
     try {
@@ -124,26 +503,77 @@ async function initDatabase() {
         preparation VARCHAR(50) DEFAULT '',
         completion VARCHAR(50) DEFAULT '',
         notes TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        email_id INT DEFAULT NULL,
+        candidate BOOLEAN NOT NULL DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE KEY uniq_email_id (email_id)
       )
     `);
+        await ensureCandidateColumn(interviewDb, 'interviews');
         logMessage('创建/检查 interviews 表');
     
         await emailDb.query(`
       CREATE TABLE IF NOT EXISTS all_emails (
         id INT AUTO_INCREMENT PRIMARY KEY,
         imap_id VARCHAR(255),
+        uidvalidity INT UNSIGNED DEFAULT NULL,
+        uid INT UNSIGNED DEFAULT NULL,
+        message_id_hash BINARY(16) DEFAULT NULL,
         subject TEXT,
         sender TEXT,
         recipient TEXT,
         send_date TEXT,
+        send_ts DATETIME DEFAULT NULL,
         body LONGTEXT,
         delivered BOOLEAN DEFAULT FALSE,
-        UNIQUE KEY unique_email (imap_id, subject(50), sender(50), send_date(50), delivered)
-      )
+        content_hash BINARY(16) DEFAULT NULL,
+        account VARCHAR(255) DEFAULT NULL,
+        folder VARCHAR(255) DEFAULT NULL,
+        orphaned_at DATETIME DEFAULT NULL,
+        body_hash BINARY(16) DEFAULT NULL,
+        UNIQUE KEY uniq_message_id_hash (message_id_hash),
+        KEY idx_send_ts (send_ts),
+        KEY idx_uid (uid, uidvalidity),
+        KEY idx_account_folder (account, folder),
+        KEY idx_body_hash (body_hash)
+      ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
     `);
         logMessage('创建/检查 all_emails 表');
-    
+        await ensureAllEmailsSchema();
+
+        // 去重压缩存储的正文和压缩字典（与 script/body_store.py 一致）
+        await emailDb.query(`
+      CREATE TABLE IF NOT EXISTS email_bodies (
+        body_hash BINARY(16) NOT NULL PRIMARY KEY,
+        dict_id INT UNSIGNED NOT NULL DEFAULT 0,
+        codec TINYINT UNSIGNED NOT NULL,
+        raw_size INT UNSIGNED NOT NULL,
+        data MEDIUMBLOB NOT NULL,
+        used_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+      ) ENGINE=InnoDB
+    `);
+        await emailDb.query(`
+      CREATE TABLE IF NOT EXISTS email_body_dicts (
+        id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+        data BLOB NOT NULL,
+        samples INT UNSIGNED NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+      ) ENGINE=InnoDB
+    `);
+        logMessage('创建/检查 email_bodies 表');
+
+        for (const sql of ROLLUP_TABLES_SQL) {
+            await emailDb.query(sql);
+        }
+        logMessage('创建/检查 数据分析预聚合表');
+        const [[rollupState]] = await emailDb.query(
+            'SELECT EXISTS(SELECT 1 FROM rollup_email_days) AS rolled_up, ' +
+            'EXISTS(SELECT 1 FROM all_emails WHERE send_ts IS NOT NULL) AS has_emails'
+        );
+        if (!rollupState.rolled_up && rollupState.has_emails) {
+            logMessage('数据分析预聚合表为空，请运行 python script/analytics_rollup.py rebuild 按已有数据生成', 'WARN');
+        }
+
         await deliveryDb.query(`
       CREATE TABLE IF NOT EXISTS deliveries (
         id INT AUTO_INCREMENT PRIMARY KEY,
@@ -153,9 +583,11 @@ async function initDatabase() {
         status VARCHAR(100) NOT NULL,
         notes TEXT,
         email_id INT DEFAULT NULL,
+        candidate BOOLEAN NOT NULL DEFAULT FALSE,
         UNIQUE KEY unique_delivery (company_name, delivery_date, status)
       )
     `);
+        await ensureCandidateColumn(deliveryDb, 'deliveries');
         logMessage('创建/检查 deliveries 表');
     
         // 插入默认数据（如果表为空）
@@ -197,9 +629,11 @@ app.post('/api/config', async (req, res) => {
     try {
         logMessage('收到更新配置请求');
         await saveConfig(req.body);
+        reconfigureImapWorker();
         logMessage('配置保存成功，正在重新初始化数据库连接');
         // 重新初始化数据库连接
         await initDatabase();
+        startEmailWatcher();
         res.json({ message: '配置更新成功', config });
         logMessage('配置更新完成并返回响应');
     } catch (err) {
@@ -225,7 +659,8 @@ app.get('/api/interviews', async (req, res) => {
             datetime: row.datetime,
             preparation: row.preparation,
             completion: row.completion,
-            notes: row.notes || ''
+            notes: row.notes || '',
+            candidate: Boolean(row.candidate)
         }));
         res.json(data);
         logMessage(`成功返回 ${data.length} 条面试数据`);
@@ -389,6 +824,34 @@ app.put('/api/interviews/:id/notes', async (req, res) => {
     }
 });
 
+// 确认自动识别的面试记录（待确认 -> 已确认）
+app.put('/api/interviews/:id/confirm', async (req, res) => {
+    try {
+        if (!interviewDb) {
+            logMessage('数据库未初始化', 'WARN');
+            return res.status(503).json({ error: '数据库未初始化，请先配置数据库连接信息' });
+        }
+    
+        const { id } = req.params;
+        if (!/^[0-9]+$/.test(id)) {
+            logMessage('无效的记录ID', 'WARN');
+            return res.status(400).json({ error: '无效的记录ID' });
+        }
+        
+        const [result] = await interviewDb.query('UPDATE interviews SET candidate = FALSE WHERE id = ?', [id]);
+        if (result.affectedRows === 0) {
+            logMessage('未找到要确认的记录', 'WARN');
+            return res.status(404).json({ error: '未找到要确认的记录' });
+        }
+        
+        logMessage(`确认面试记录成功，ID: ${id}`);
+        res.json({ message: '面试记录已确认' });
+    } catch (err) {
+        logMessage(`确认面试记录失败: ${err.message}`, 'ERROR');
+        res.status(500).json({ error: '确认面试记录失败: ' + err.message });
+    }
+});
+
 // 面试记录搜索API
 app.get('/api/interviews/search', async (req, res) => {
     try {
@@ -419,7 +882,8 @@ app.get('/api/interviews/search', async (req, res) => {
             datetime: row.datetime,
             preparation: row.preparation,
             completion: row.completion,
-            notes: row.notes || ''
+            notes: row.notes || '',
+            candidate: Boolean(row.candidate)
         }));
     
         res.json(data);
@@ -441,16 +905,17 @@ app.get('/api/emails', async (req, res) => {
         // 获取查询参数
         const { startDate, endDate } = req.query;
         
-        let query = 'SELECT *, delivered as is_delivered FROM all_emails';
+        let query = `SELECT ${EMAIL_LIST_COLUMNS} FROM all_emails`;
         let params = [];
         
         // 如果提供了日期范围参数，则添加过滤条件
         if (startDate && endDate) {
-            query += ' WHERE send_date >= ? AND send_date <= ?';
-            params.push(`${startDate} 00:00:00`, `${endDate} 23:59:59`);
+            // send_ts 尚未回填的旧邮件按 send_date 字符串比较，已回填的邮件仍走 idx_send_ts
+            query += ' WHERE (send_ts >= ? AND send_ts <= ?) OR (send_ts IS NULL AND send_date >= ? AND send_date <= ?)';
+            params.push(`${startDate} 00:00:00`, `${endDate} 23:59:59`, `${startDate} 00:00:00`, `${endDate} 23:59:59`);
         }
         
-        query += ' ORDER BY send_date DESC';
+        query += EMAIL_LIST_ORDER;
         
         const [rows] = await emailDb.query(query, params);
         // 处理日期格式，确保前端能正确解析
@@ -485,13 +950,39 @@ app.get('/api/emails/search', async (req, res) => {
         let rows;
     
         if (!keyword) {
-            [rows] = await emailDb.query('SELECT *, delivered as is_delivered FROM all_emails ORDER BY send_date DESC');
+            [rows] = await emailDb.query(`SELECT ${EMAIL_LIST_COLUMNS} FROM all_emails${EMAIL_LIST_ORDER}`);
             logMessage(`返回所有邮件数据，共 ${rows.length} 条记录`);
         } else {
-            [rows] = await emailDb.query(
-                'SELECT *, delivered as is_delivered FROM all_emails WHERE subject LIKE ? OR body LIKE ? OR (delivered = 1 AND ? LIKE "%已投递%") OR (delivered = 0 AND ? LIKE "%未投递%") ORDER BY send_date DESC',
-                [`%${keyword}%`, `%${keyword}%`, keyword, keyword]
-            );
+            const rankedIds = await searchEmailIds(keyword);
+            if (rankedIds === null) {
+                // 索引未建立或查询只有单个字，退回逐行匹配（压缩存储的正文不参与，只能通过索引搜索）
+                [rows] = await emailDb.query(
+                    `SELECT ${EMAIL_LIST_COLUMNS} FROM all_emails WHERE subject LIKE ? OR body LIKE ? OR (delivered = 1 AND ? LIKE "%已投递%") OR (delivered = 0 AND ? LIKE "%未投递%")${EMAIL_LIST_ORDER}`,
+                    [`%${keyword}%`, `%${keyword}%`, keyword, keyword]
+                );
+            } else {
+                // 按相关度排序；关键词包含投递状态时同时返回该状态的邮件（排在匹配结果之后）
+                const conditions = [];
+                const params = [];
+                if (rankedIds.length > 0) {
+                    conditions.push(`id IN (${rankedIds.map(() => '?').join(',')})`);
+                    params.push(...rankedIds);
+                }
+                if (keyword.includes('已投递')) {
+                    conditions.push('delivered = 1');
+                } else if (keyword.includes('未投递')) {
+                    conditions.push('delivered = 0');
+                }
+                rows = [];
+                if (conditions.length > 0) {
+                    [rows] = await emailDb.query(
+                        `SELECT ${EMAIL_LIST_COLUMNS} FROM all_emails WHERE ${conditions.join(' OR ')}${EMAIL_LIST_ORDER}`,
+                        params
+                    );
+                }
+                const rank = new Map(rankedIds.map((id, index) => [id, index]));
+                rows.sort((a, b) => (rank.has(a.id) ? rank.get(a.id) : Infinity) - (rank.has(b.id) ? rank.get(b.id) : Infinity));
+            }
             logMessage(`搜索关键词 "${keyword}"，返回 ${rows.length} 条匹配记录`);
         }
     
@@ -529,11 +1020,17 @@ app.delete('/api/emails/:id', async (req, res) => {
             return res.status(400).json({ error: '无效的邮件ID' });
         }
     
+        const [dayRows] = await emailDb.query("SELECT DATE_FORMAT(send_ts, '%Y-%m-%d') AS day FROM all_emails WHERE id = ?", [id]);
         const [result] = await emailDb.query('DELETE FROM all_emails WHERE id = ?', [id]);
         if (result.affectedRows === 0) {
             logMessage(`删除邮件失败，邮件未找到，ID: ${id}`, 'WARN');
             return res.status(404).json({ error: '邮件未找到' });
         }
+        if (searchIndexReady) {
+            await emailDb.query('DELETE FROM email_search_terms WHERE email_id = ?', [id]);
+            await emailDb.query('DELETE FROM email_search_docs WHERE email_id = ?', [id]);
+        }
+        await decrementEmailRollups(dayRows.length ? dayRows[0].day : null);
     
         res.json({ message: '邮件删除成功' });
         logMessage(`邮件删除成功，ID: ${id}`);
@@ -578,6 +1075,40 @@ app.put('/api/emails/:id/delivered', async (req, res) => {
     }
 });
 
+// 压缩字典只增不改，按id缓存
+const bodyDictionaries = new Map();
+
+async function getBodyDictionary(dictId) {
+    if (!bodyDictionaries.has(dictId)) {
+        const [rows] = await emailDb.query('SELECT data FROM email_body_dicts WHERE id = ?', [dictId]);
+        if (rows.length === 0) {
+            throw new Error(`正文字典 ${dictId} 不存在`);
+        }
+        bodyDictionaries.set(dictId, rows[0].data);
+    }
+    return bodyDictionaries.get(dictId);
+}
+
+// 读取入库时保存的正文（已截断），未压缩的在 all_emails.body，压缩存储的在 email_bodies 中解压；返回 Map(id -> 正文)
+async function readStoredBodies(ids) {
+    const [rows] = await emailDb.query(
+        'SELECT a.id, a.body, b.dict_id, b.codec, b.data FROM all_emails a ' +
+        'LEFT JOIN email_bodies b ON b.body_hash = a.body_hash WHERE a.id IN (?)',
+        [ids]
+    );
+    const bodies = new Map();
+    for (const row of rows) {
+        if (row.body !== null) {
+            bodies.set(String(row.id), row.body);
+        } else if (row.data) {
+            const data = row.codec === BODY_CODEC_RAW ? row.data
+                : zlib.inflateSync(row.data, row.dict_id ? { dictionary: await getBodyDictionary(row.dict_id) } : {});
+            bodies.set(String(row.id), data.toString('utf8'));
+        }
+    }
+    return bodies;
+}
+
 app.get('/api/emails/:id/body/realtime', async (req, res) => {
     try {
         logMessage(`收到获取邮件正文请求，邮件ID: ${req.params.id}`);
@@ -587,7 +1118,10 @@ app.get('/api/emails/:id/body/realtime', async (req, res) => {
             return res.status(400).json({ error: '无效的邮件ID' });
         }
     
-        const [rows] = await emailDb.query('SELECT imap_id FROM all_emails WHERE id = ?', [id]);
+        const [rows] = await emailDb.query(
+            'SELECT imap_id, uidvalidity, HEX(message_id_hash) AS message_id_hash, account, folder, orphaned_at FROM all_emails WHERE id = ?',
+            [id]
+        );
         if (rows.length === 0) {
             logMessage(`邮件未找到，ID: ${id}`, 'WARN');
             return res.status(404).json({ error: '邮件未找到' });
@@ -599,203 +1133,205 @@ app.get('/api/emails/:id/body/realtime', async (req, res) => {
             return res.status(404).json({ error: '该邮件没有IMAP ID' });
         }
     
-        // 使用spawn执行Python脚本获取实时邮件正文
-        const pythonPath = 'python';
-        const scriptPath = path.join(__dirname, '..', 'script', 'get_email_body_by_id.py');
-        logMessage(`正在执行邮件正文获取脚本，IMAP ID: ${imapId}`);
-    
-        const pythonProcess = spawn(pythonPath, [scriptPath, imapId, config.email.address, config.email.password, config.email.imap_server], {
-            cwd: __dirname,
-            env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
-        });
-    
-        let stdoutData = '';
-        let stderrData = '';
-    
-        pythonProcess.stdout.on('data', (data) => {
-          stdoutData += data.toString();
-          logMessage(`邮件正文脚本输出: ${data.toString().trim().substring(0, 100)}...`);
-        });
-    
-        pythonProcess.stderr.on('data', (data) => {
-          stderrData += data.toString();
-          logMessage(`邮件正文脚本日志: ${data.toString().trim()}`, 'DEBUG');
-        });
-    
-        pythonProcess.on('close', (code) => {
-            if (code === 0) {
-                logMessage(`邮件正文获取成功，ID: ${id}`);
-                res.json({ body: stdoutData });
-            } else {
-                logMessage(`邮件正文脚本执行失败，退出码: ${code}, 错误: ${stderrData}`, 'ERROR');
-                res.status(500).json({ error: '获取邮件正文失败', details: stderrData });
-            }
-        });
-    
-        pythonProcess.on('error', (error) => {
-            logMessage(`执行邮件正文脚本时出错: ${error.message}`, 'ERROR');
-            res.status(500).json({ error: '无法启动获取邮件正文脚本', details: error.message });
-        });
+        // 通过常驻的IMAP工作进程获取实时邮件正文
+        logMessage(`正在通过IMAP工作进程获取邮件正文，IMAP ID: ${imapId}`);
+        let response;
+        try {
+            // 附带UIDVALIDITY和Message-ID哈希，工作进程可以直接从原始邮件缓存读取；
+            // 账号和文件夹决定到哪个邮箱的哪个文件夹中按UID获取；
+            // 对账标记为孤儿的邮件在服务器上已不存在，只从缓存读取
+            response = await sendImapWorkerRequest({
+                op: 'body',
+                imap_id: imapId,
+                uidvalidity: rows[0].uidvalidity,
+                message_id_hash: rows[0].message_id_hash,
+                account: rows[0].account,
+                folder: rows[0].folder,
+                cache_only: Boolean(rows[0].orphaned_at)
+            });
+        } catch (error) {
+            logMessage(`调用IMAP工作进程时出错: ${error.message}`, 'ERROR');
+            response = { ok: false, error: error.message };
+        }
+
+        if (response.ok) {
+            logMessage(`邮件正文获取成功，ID: ${id}`);
+            res.json({ body: response.body });
+            return;
+        }
+        // 邮箱中取不到时（已删除、网络问题）退回入库时保存的正文
+        const stored = (await readStoredBodies([id])).get(id);
+        if (stored !== undefined) {
+            logMessage(`无法实时获取邮件正文（${response.error}），返回入库时保存的正文，ID: ${id}`, 'WARN');
+            res.json({ body: stored, stored: true });
+        } else {
+            logMessage(`邮件正文获取失败，错误: ${response.error}`, 'ERROR');
+            res.status(500).json({ error: '获取邮件正文失败', details: response.error });
+        }
     } catch (err) {
         logMessage(`获取邮件正文失败: ${err.message}`, 'ERROR');
         res.status(500).json({ error: '获取邮件正文失败' });
     }
 });
 
-// 获取邮件
+// 批量获取邮件正文（如预取一页邮件）：每个账号一次工作进程请求，
+// 工作进程在一个IMAP连接上只SELECT一次、按UID集合FETCH，而不是每封邮件一次请求
+app.post('/api/emails/bodies/realtime', async (req, res) => {
+    try {
+        const ids = Array.isArray(req.body && req.body.ids) ? req.body.ids.map(String) : [];
+        logMessage(`收到批量获取邮件正文请求，共 ${ids.length} 封`);
+        if (ids.length === 0 || ids.length > MAX_BATCH_BODY_IDS || !ids.every(id => /^[0-9]+$/.test(id))) {
+            logMessage('无效的邮件ID列表', 'WARN');
+            return res.status(400).json({ error: `邮件ID列表无效，最多 ${MAX_BATCH_BODY_IDS} 个` });
+        }
+        if (!emailDb) {
+            logMessage('数据库未初始化', 'WARN');
+            return res.status(503).json({ error: '数据库未初始化，请先配置数据库连接信息' });
+        }
+
+        const [rows] = await emailDb.query(
+            'SELECT id, imap_id, uidvalidity, HEX(message_id_hash) AS message_id_hash, account, folder, orphaned_at FROM all_emails WHERE id IN (?)',
+            [ids]
+        );
+        const byAccount = new Map();
+        for (const row of rows) {
+            if (!row.imap_id) {
+                continue;
+            }
+            const account = row.account || '';
+            if (!byAccount.has(account)) {
+                byAccount.set(account, []);
+            }
+            byAccount.get(account).push({
+                key: String(row.id),
+                imap_id: row.imap_id,
+                uidvalidity: row.uidvalidity,
+                message_id_hash: row.message_id_hash,
+                folder: row.folder,
+                cache_only: Boolean(row.orphaned_at)
+            });
+        }
+
+        const bodies = {};
+        const errors = [];
+        await Promise.all([...byAccount].map(([account, items]) => sendImapWorkerRequest(
+            { op: 'bodies', account: account || undefined, items },
+            { onEvent: (event) => { if (event.event === 'body') { bodies[event.key] = event.body; } } }
+        ).then((response) => {
+            if (!response.ok) {
+                errors.push(response.error);
+            }
+        }).catch((error) => errors.push(error.message))));
+
+        let missing = ids.filter(id => !(id in bodies));
+        if (missing.length > 0) {
+            // 邮箱中取不到的邮件退回入库时保存的正文
+            for (const [id, body] of await readStoredBodies(missing)) {
+                bodies[id] = body;
+            }
+            missing = missing.filter(id => !(id in bodies));
+        }
+        if (errors.length > 0) {
+            logMessage(`批量获取邮件正文时出错: ${errors.join('; ')}`, 'ERROR');
+        }
+        logMessage(`批量获取邮件正文完成，成功 ${ids.length - missing.length} 封，失败 ${missing.length} 封`);
+        res.json({ bodies, missing });
+    } catch (err) {
+        logMessage(`批量获取邮件正文失败: ${err.message}`, 'ERROR');
+        res.status(500).json({ error: '批量获取邮件正文失败' });
+    }
+});
+
+// 获取邮件：由常驻的IMAP工作进程执行导入，进度以事件形式返回
 app.post('/api/fetch-emails', async (req, res) => {
     try {
         logMessage('收到获取邮件请求');
         const { startDate, endDate } = req.body || {};
     
-        // 从请求头获取邮箱配置
-        const email = req.headers['x-email-address'] || config.email.address;
-        const password = req.headers['x-email-password'] || config.email.password;
-        const imap_server = req.headers['x-imap-server'] || config.email.imap_server;
-    
-        // 设置响应超时时间
-        res.setTimeout(300000); // 5分钟超时
-    
-        // 构建Python脚本参数
-        const pythonPath = 'python';
-        const scriptPath = path.join(__dirname, '..', 'script', 'qq_email_imap.py');
-        logMessage(`正在执行邮件获取脚本: ${scriptPath}`);
-    
-        // 基本参数
-        let args = [scriptPath, email, password, imap_server];
-    
-        // 如果提供了日期范围，则添加日期参数
+        // 从请求头获取邮箱配置；未指定账号时按配置同步所有账号的所有文件夹
+        const request = {
+            op: 'fetch',
+            email: req.headers['x-email-address'] || config.email.address,
+            password: req.headers['x-email-password'] || config.email.password,
+            imap_server: req.headers['x-imap-server'] || config.email.imap_server
+        };
+        if (!req.headers['x-email-address']) {
+            request.accounts = 'all';
+        }
         if (startDate && endDate) {
-            args.push(startDate, endDate);
+            request.start_date = startDate;
+            request.end_date = endDate;
             logMessage(`获取指定日期范围的邮件: ${startDate} 到 ${endDate}`);
         }
     
-        const pythonProcess = spawn(pythonPath, args, {
-            cwd: __dirname,
-            env: { ...process.env, PYTHONIOENCODING: 'utf-8' }
+        // 设置响应超时时间
+        res.setTimeout(FETCH_EMAILS_TIMEOUT);
+    
+        let requestId = null;
+        let finished = false;
+        // 客户端提前断开时取消任务
+        res.on('close', () => {
+            if (!finished && requestId !== null) {
+                logMessage('客户端已断开，取消邮件获取任务', 'WARN');
+                cancelImapWorkerFetch(requestId);
+            }
         });
     
-        let stdoutData = '';
-        let stderrData = '';
-    
-        // 设置子进程超时
-        const timeout = setTimeout(() => {
-            pythonProcess.kill('SIGTERM');
-            logMessage('邮件获取脚本执行超时，已发送终止信号', 'WARN');
-      
-            // 如果SIGTERM不起作用，1秒后发送SIGKILL
-            const forceKillTimeout = setTimeout(() => {
-                pythonProcess.kill('SIGKILL');
-                logMessage('邮件获取脚本强制终止', 'WARN');
-            }, 1000);
-      
-            pythonProcess.on('exit', () => {
-                clearTimeout(forceKillTimeout);
+        let response;
+        try {
+            response = await sendImapWorkerRequest(request, {
+                timeout: FETCH_EMAILS_TIMEOUT,
+                onStart: (id) => { requestId = id; },
+                onEvent: (event) => {
+                    logMessage(`邮件获取进度: 已处理 ${event.processed}/${event.total} 封，新增 ${event.inserted} 封`);
+                }
             });
-        }, 300000); // 5分钟超时
-    
-        pythonProcess.stdout.on('data', (data) => {
-            stdoutData += data.toString();
-            // 实时记录进度信息
-            const dataStr = data.toString();
-            logMessage(`邮件获取脚本输出: ${dataStr.trim().substring(0, 100)}...`);
-        });
-    
-        pythonProcess.stderr.on('data', (data) => {
-            stderrData += data.toString();
-            logMessage(`邮件获取脚本日志: ${data.toString().trim()}`, 'DEBUG');
-        });
-    
-        pythonProcess.on('close', (code, signal) => {
-            clearTimeout(timeout); // 清除超时定时器
-      
-            if (signal === 'SIGTERM' || signal === 'SIGKILL') {
-                logMessage('邮件获取脚本被终止', 'WARN');
-                res.status(408).json({ 
+        } catch (error) {
+            finished = true;
+            if (error.timeout) {
+                cancelImapWorkerFetch(requestId);
+                logMessage('邮件获取超时，已通知工作进程取消任务', 'WARN');
+                return res.status(408).json({ 
                     success: false, 
                     message: '邮件获取超时，已终止操作', 
                     error: 'Timeout' 
                 });
-                return;
-            }
-      
-            if (code === 0) {
-                let processedCount = 0;
-                let insertedCount = 0;
-                let message = '';
-                logMessage('邮件获取脚本执行完成');
-                logMessage(`[DEBUG] Python脚本输出原始数据: ${stdoutData}`);
-                
-                // 尝试匹配"总共处理 X 封邮件，新增 Y 封邮件"格式（中文）
-                const countMatch = stdoutData.match(/总共处理\s+(\d+)\s+封邮件，新增\s+(\d+)\s+封邮件/);
-                logMessage(`[DEBUG] 计数匹配结果: ${countMatch}`);
-                if (countMatch) {
-                    processedCount = parseInt(countMatch[1]);
-                    insertedCount = parseInt(countMatch[2]);
-                    logMessage(`[DEBUG] 解析得到处理邮件数: ${processedCount}, 新增邮件数: ${insertedCount}`);
-                } else {
-                    // 尝试匹配可能的其他格式
-                    const alternativeMatch = stdoutData.match(/获取到\s+(\d+)\s+封新邮件/);
-                    logMessage(`[DEBUG] 替代匹配结果: ${alternativeMatch}`);
-                    if (alternativeMatch) {
-                        insertedCount = parseInt(alternativeMatch[1]);
-                        processedCount = insertedCount;
-                        logMessage(`[DEBUG] 通过替代方式解析得到邮件数: ${processedCount}`);
-                    } else {
-                        // 尝试匹配"没有获取到任何邮件"格式（中文）
-                        const noEmailsMatch = stdoutData.match(/没有获取到任何邮件/);
-                        logMessage(`[DEBUG] 无邮件匹配结果: ${noEmailsMatch}`);
-                        if (noEmailsMatch) {
-                            processedCount = 0;
-                            insertedCount = 0;
-                            logMessage(`[DEBUG] 没有获取到任何邮件`);
-                        } else {
-                            // 如果所有匹配都失败，尝试从stdoutData中查找数字
-                            const numberMatches = stdoutData.match(/(\d+)/g);
-                            logMessage(`[DEBUG] 数字匹配结果: ${numberMatches}`);
-                            if (numberMatches && numberMatches.length > 0) {
-                                // 取最后一个数字作为邮件数量
-                                insertedCount = parseInt(numberMatches[numberMatches.length - 1]);
-                                processedCount = insertedCount;
-                                logMessage(`[DEBUG] 通过数字查找方式解析得到邮件数: ${processedCount}`);
-                            }
-                        }
-                    }
-                }
-                
-                logMessage(`邮件获取完成，处理 ${processedCount} 封邮件，新增 ${insertedCount} 封邮件`);
-        
-                // 构建消息
-                if (processedCount === 0) {
-                    message = '邮件获取完成，没有找到新邮件';
-                } else {
-                    message = `邮件获取完成，获取到 ${insertedCount} 封新邮件`;
-                }
-        
-                logMessage(`[DEBUG] 返回给前端的数据: processedCount=${insertedCount}, message=${message}`);
-                res.json({ 
-                    success: true, 
-                    message: message,
-                    processedCount: insertedCount  // 返回新增邮件数量
-                });
-            } else {
-                logMessage(`邮件获取失败或被中断，错误: ${stderrData}`, 'ERROR');
-                res.status(500).json({ 
-                    success: false, 
-                    message: '邮件获取失败或被中断', 
-                    error: stderrData 
-                });
             }
-        });
-    
-        pythonProcess.on('error', (error) => {
-            clearTimeout(timeout); // 清除超时定时器
-            logMessage(`执行邮件获取脚本时出错: ${error.message}`, 'ERROR');
-            res.status(500).json({ 
+            logMessage(`调用IMAP工作进程时出错: ${error.message}`, 'ERROR');
+            return res.status(500).json({ 
                 success: false, 
-                message: '无法启动邮件获取脚本', 
+                message: '无法启动邮件获取任务', 
                 error: error.message 
             });
+        }
+        finished = true;
+    
+        if (!response.ok) {
+            logMessage(`邮件获取失败，错误: ${response.error}`, 'ERROR');
+            return res.status(500).json({ 
+                success: false, 
+                message: '邮件获取失败或被中断', 
+                error: response.error 
+            });
+        }
+    
+        const processedCount = response.processed;
+        const insertedCount = response.inserted;
+        logMessage(`邮件获取完成，处理 ${processedCount} 封邮件，新增 ${insertedCount} 封邮件${response.cancelled ? '（已取消）' : ''}`);
+    
+        let message;
+        if (response.cancelled) {
+            message = `邮件获取已取消，已保存 ${insertedCount} 封新邮件`;
+        } else if (processedCount === 0) {
+            message = '邮件获取完成，没有找到新邮件';
+        } else {
+            message = `邮件获取完成，获取到 ${insertedCount} 封新邮件`;
+        }
+        res.json({ 
+            success: true, 
+            message: message,
+            processedCount: insertedCount,  // 返回新增邮件数量
+            cancelled: response.cancelled
         });
     } catch (err) {
         logMessage(`获取邮件失败: ${err.message}`, 'ERROR');
@@ -803,6 +1339,41 @@ app.post('/api/fetch-emails', async (req, res) => {
     }
 });
 
+// 邮件变更事件流（Server-Sent Events）
+app.get('/api/emails/events', (req, res) => {
+    res.writeHead(200, {
+        'Content-Type': 'text/event-stream; charset=utf-8',
+        'Cache-Control': 'no-cache',
+        Connection: 'keep-alive'
+    });
+    res.write(': connected\n\n');
+    emailEventClients.add(res);
+    req.on('close', () => emailEventClients.delete(res));
+});
+
+// 查询正在运行的邮件获取任务
+app.get('/api/fetch-emails/status', async (req, res) => {
+    try {
+        const response = await sendImapWorkerRequest({ op: 'status' });
+        res.json({ running: !!response.fetch, fetch: response.fetch });
+    } catch (err) {
+        logMessage(`查询邮件获取状态失败: ${err.message}`, 'ERROR');
+        res.status(500).json({ error: '查询邮件获取状态失败' });
+    }
+});
+
+// 取消正在运行的邮件获取任务，已入库的邮件会保留
+app.post('/api/fetch-emails/cancel', async (req, res) => {
+    try {
+        logMessage('收到取消获取邮件请求');
+        const response = await sendImapWorkerRequest({ op: 'cancel' });
+        res.json({ success: true, cancelled: response.cancelled });
+    } catch (err) {
+        logMessage(`取消邮件获取任务失败: ${err.message}`, 'ERROR');
+        res.status(500).json({ error: '取消邮件获取任务失败' });
+    }
+});
+
 // 投递相关API
 app.get('/api/deliveries', async (req, res) => {
     try {
@@ -818,7 +1389,8 @@ app.get('/api/deliveries', async (req, res) => {
             delivery_date: row.delivery_date,
             status: row.status,
             notes: row.notes || '',
-            email_id: row.email_id
+            email_id: row.email_id,
+            candidate: Boolean(row.candidate)
         }));
         res.json(data);
     } catch (err) {
@@ -845,6 +1417,7 @@ app.post('/api/deliveries', async (req, res) => {
             'INSERT INTO deliveries (company_name, position, delivery_date, status, notes, email_id) VALUES (?, ?, ?, ?, ?, ?)',
             [company_name, position || '', delivery_date, status, notes || '', email_id || null]
         );
+        await refreshDeliveryRollups([company_name]);
     
         res.json({ message: '投递记录添加成功', id: result.insertId });
     } catch (err) {
@@ -893,11 +1466,14 @@ app.put('/api/deliveries/:id', async (req, res) => {
         query += ' WHERE id = ?';
         params.push(id);
         
+        // 企业名称可能被修改，原企业的预聚合数据也要重新统计
+        const [previous] = await deliveryDb.query('SELECT company_name FROM deliveries WHERE id = ?', [id]);
         const [result] = await deliveryDb.query(query, params);
     
         if (result.affectedRows === 0) {
             return res.status(404).json({ error: '投递记录未找到' });
         }
+        await refreshDeliveryRollups([company_name, ...previous.map(row => row.company_name)]);
     
         res.json({ message: '投递记录更新成功' });
     } catch (err) {
@@ -921,7 +1497,7 @@ app.delete('/api/deliveries/:id', async (req, res) => {
         }
         
         // 先查询要删除的记录是否有关联的邮件ID
-        const [rows] = await deliveryDb.query('SELECT email_id FROM deliveries WHERE id = ?', [id]);
+        const [rows] = await deliveryDb.query('SELECT email_id, company_name FROM deliveries WHERE id = ?', [id]);
         if (rows.length === 0) {
             return res.status(404).json({ error: '投递记录未找到' });
         }
@@ -944,6 +1520,7 @@ app.delete('/api/deliveries/:id', async (req, res) => {
         if (result.affectedRows === 0) {
             return res.status(404).json({ error: '投递记录未找到' });
         }
+        await refreshDeliveryRollups([rows[0].company_name]);
         
         logMessage(`投递记录 ${id} 删除成功`);
         res.json({ message: '投递记录删除成功' });
@@ -984,6 +1561,38 @@ app.put('/api/deliveries/:id/notes', async (req, res) => {
     }
 });
 
+// 确认自动识别的投递记录：确认后计入数据分析统计，关联的邮件标记为已投递
+app.put('/api/deliveries/:id/confirm', async (req, res) => {
+    try {
+        if (!deliveryDb) {
+            return res.status(503).json({ error: '数据库未初始化，请先配置数据库连接信息' });
+        }
+    
+        const { id } = req.params;
+        if (!/^[0-9]+$/.test(id)) {
+            return res.status(400).json({ error: '无效的投递ID' });
+        }
+        
+        const [rows] = await deliveryDb.query('SELECT email_id, company_name FROM deliveries WHERE id = ?', [id]);
+        if (rows.length === 0) {
+            return res.status(404).json({ error: '投递记录未找到' });
+        }
+        
+        await deliveryDb.query('UPDATE deliveries SET candidate = FALSE WHERE id = ?', [id]);
+        const emailId = rows[0].email_id;
+        if (emailId && emailDb) {
+            await emailDb.query('UPDATE all_emails SET delivered = TRUE WHERE id = ?', [emailId]);
+        }
+        await refreshDeliveryRollups([rows[0].company_name]);
+        
+        logMessage(`确认投递记录 ${id}，关联的邮件ID: ${emailId}`);
+        res.json({ message: '投递记录已确认' });
+    } catch (err) {
+        logMessage(`确认投递记录失败: ${err.message}`, 'ERROR');
+        res.status(500).json({ error: '确认投递记录失败' });
+    }
+});
+
 // 投递记录搜索API
 app.get('/api/deliveries/search', async (req, res) => {
     try {
@@ -1014,7 +1623,8 @@ app.get('/api/deliveries/search', async (req, res) => {
             delivery_date: row.delivery_date,
             status: row.status,
             notes: row.notes || '',
-            email_id: row.email_id
+            email_id: row.email_id,
+            candidate: Boolean(row.candidate)
         }));
     
         res.json(data);
@@ -1024,6 +1634,58 @@ app.get('/api/deliveries/search', async (req, res) => {
     }
 });
 
+// 数据分析页面使用的预聚合数据：邮件数读预聚合表，投递/面试的每日数量在数据库中分组统计，
+// 返回的都是按日期或企业聚合后的几百行，不再返回整张表
+app.get('/api/analytics/rollups', async (req, res) => {
+    try {
+        if (!emailDb || !deliveryDb || !interviewDb) {
+            return res.status(503).json({ error: '数据库未初始化，请先配置数据库连接信息' });
+        }
+
+        const [emailDays] = await emailDb.query(
+            "SELECT DATE_FORMAT(day, '%Y-%m-%d') AS day, emails FROM rollup_email_days ORDER BY day DESC LIMIT 365"
+        );
+        const [emailWeeks] = await emailDb.query(
+            "SELECT DATE_FORMAT(week_start, '%Y-%m-%d') AS week_start, emails FROM rollup_email_weeks ORDER BY week_start DESC LIMIT 104"
+        );
+        const [deliveryDays] = await deliveryDb.query(
+            "SELECT DATE_FORMAT(delivery_date, '%Y-%m-%d') AS day, COUNT(*) AS count FROM deliveries " +
+            'WHERE candidate = FALSE GROUP BY day ORDER BY day DESC LIMIT 365'
+        );
+        const [interviewDays] = await interviewDb.query(
+            "SELECT DATE_FORMAT(datetime, '%Y-%m-%d') AS day, COUNT(*) AS count FROM interviews " +
+            'WHERE datetime IS NOT NULL AND candidate = FALSE GROUP BY day ORDER BY day DESC LIMIT 365'
+        );
+        const [funnel] = await emailDb.query(
+            'SELECT company_name, position, status, deliveries FROM rollup_delivery_funnel'
+        );
+        const [latency] = await emailDb.query(
+            `SELECT CASE
+                 WHEN latency_hours IS NULL THEN '未回复'
+                 WHEN latency_hours < 24 THEN '1天内'
+                 WHEN latency_hours < 72 THEN '1-3天'
+                 WHEN latency_hours < 168 THEN '3-7天'
+                 WHEN latency_hours < 336 THEN '7-14天'
+                 WHEN latency_hours < 720 THEN '14-30天'
+                 ELSE '30天以上'
+             END AS bucket, COUNT(*) AS companies
+             FROM rollup_response_latency GROUP BY bucket`
+        );
+
+        res.json({
+            emailDays: emailDays.reverse(),
+            emailWeeks: emailWeeks.reverse(),
+            deliveryDays: deliveryDays.reverse().map(row => ({ day: row.day, count: Number(row.count) })),
+            interviewDays: interviewDays.reverse().map(row => ({ day: row.day, count: Number(row.count) })),
+            funnel,
+            latency: latency.map(row => ({ bucket: row.bucket, companies: Number(row.companies) }))
+        });
+    } catch (err) {
+        logMessage(`获取数据分析预聚合数据失败: ${err.message}`, 'ERROR');
+        res.status(500).json({ error: '获取数据分析预聚合数据失败' });
+    }
+});
+
 // 页面路由
 app.get('/', (req, res) => {
     res.sendFile(path.join(__dirname, '..', 'public', 'index.html'));
@@ -1073,6 +1735,7 @@ loadConfig().then(() => {
     logMessage('数据库初始化完成');
     app.listen(PORT, () => {
         logMessage(`服务器运行在 http://localhost:${PORT}`);
+        startEmailWatcher();
     });
 }).catch(err => {
     logMessage(`启动服务器失败: ${err.message}`, 'ERROR');